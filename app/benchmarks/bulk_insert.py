@@ -0,0 +1,84 @@
+"""Writing the fills of a sweep through the ORM flush and through bulk_insert.
+
+A fill is a trade and its two sub trades, as the engine writes them for
+every maker. Every run is rolled back. Needs the database of the
+POSTGRES_* settings with its partitions created by migrate.py.
+
+    cd app && python -m benchmarks.bulk_insert [makers ...]
+"""
+from decimal import Decimal
+import statistics
+import sys
+import time
+import uuid
+from sqlalchemy.sql import func, select, text
+from orm import database, models
+from internal import enums
+
+REPEAT = 5
+
+
+def make_fills(db, makers: int) -> list:
+    now = db.execute(select(func.localtimestamp())).scalar()
+    objects = []
+    for _ in range(makers):
+        trade = models.Trade(
+            id=uuid.uuid4(),
+            maker_order_id=uuid.uuid4(),
+            taker_order_id=uuid.uuid4(),
+            price=Decimal('27150.5'),
+            quantity=Decimal('0.01'),
+            quote_quantity=Decimal('271.505'),
+            insert_time=now,
+        )
+        objects.append(trade)
+        for is_maker, side in [(True, enums.OrderSide.short.value), (False, enums.OrderSide.long.value)]:
+            objects.append(models.SubTrade(
+                id=uuid.uuid4(),
+                trade_id=trade.id,
+                commission=Decimal('0.1'),
+                commission_asset=enums.CollateralAsset.usdt.value,
+                side=side,
+                is_maker=is_maker,
+                insert_time=now,
+            ))
+    return objects
+
+
+def orm_flush(db, objects: list):
+    db.add_all(objects)
+    db.flush()
+
+
+def bulk(db, objects: list):
+    models.bulk_insert(db=db, objects=[obj for obj in objects if isinstance(obj, models.Trade)])
+    models.bulk_insert(db=db, objects=[obj for obj in objects if isinstance(obj, models.SubTrade)])
+
+
+def measure(write, makers: int) -> float:
+    times = []
+    for _ in range(REPEAT):
+        db = database.SessionLocal()
+        try:
+            objects = make_fills(db, makers)
+            started = time.perf_counter()
+            write(db, objects)
+            times.append(time.perf_counter() - started)
+            db.rollback()
+        finally:
+            db.close()
+    return statistics.median(times)
+
+
+if __name__ == "__main__":
+    try:
+        with database.engine.connect() as connection:
+            connection.execute(text("select 1"))
+    except Exception as e:
+        raise SystemExit(f"needs the postgres database of the settings: {e}")
+    counts = [int(arg) for arg in sys.argv[1:]] or [1, 10, 100, 1000]
+    print(f"{'makers':>7} {'orm flush ms':>13} {'bulk_insert ms':>15} {'speedup':>8}")
+    for makers in counts:
+        slow = measure(orm_flush, makers)
+        fast = measure(bulk, makers)
+        print(f"{makers:>7} {slow * 1000:>13.2f} {fast * 1000:>15.2f} {slow / fast:>7.1f}x")
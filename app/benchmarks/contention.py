@@ -0,0 +1,101 @@
+"""Balance lock and unlock throughput in both concurrency modes.
+
+Threads lock and unlock order collateral on accounts drawn from a hot set,
+fewer hot accounts means more writers on the same balances. Needs the
+database of the POSTGRES_* settings, the rows it creates are left behind.
+
+    cd app && python -m benchmarks.contention [hot accounts ...]
+"""
+from decimal import Decimal
+import os
+import random
+import sys
+import threading
+import time
+from sqlalchemy.sql import text
+from orm import database, models
+from internal import enums
+import settings
+
+THREADS = int(os.getenv("BENCHMARK_THREADS", 16))
+DURATION = float(os.getenv("BENCHMARK_DURATION", 10))
+AMOUNT = Decimal('1')
+
+
+def create_accounts(count: int) -> list:
+    db = database.SessionLocal()
+    try:
+        accounts = [models.Account(type=enums.AccountType.main.value) for _ in range(count)]
+        db.add_all(accounts)
+        db.flush()
+        account_ids = [account.id for account in accounts]
+        asset = enums.CollateralAsset.usdt.value
+        models.Balance.create_missing(db=db, account_ids=account_ids, asset=asset)
+        models.Balance.credit(
+            db=db,
+            amounts=[(account_id, Decimal('1000000')) for account_id in account_ids],
+            asset=asset,
+            reason=enums.BalanceChange.set_balance.value,
+        )
+        db.commit()
+        return account_ids
+    finally:
+        db.close()
+
+
+def lock_and_unlock(account_ids: list, deadline: float, counts: dict):
+    db = database.SessionLocal()
+    try:
+        while time.monotonic() < deadline:
+            account_id = random.choice(account_ids)
+            try:
+                models.Balance.lock(info={"account_id": account_id, "amount": AMOUNT}, db=db)
+                db.commit()
+                models.Balance.unlock(info={
+                    "account_id": account_id,
+                    "asset": enums.CollateralAsset.usdt.value,
+                    "amount": AMOUNT,
+                }, db=db)
+                db.commit()
+                counts["ok"] += 1
+            except models.ConcurrentUpdateError:
+                db.rollback()
+                counts["gave_up"] += 1
+    finally:
+        db.close()
+
+
+def run(mode: str, account_ids: list) -> tuple:
+    settings.CONCURRENCY_MODE = mode
+    # cached balances from the other mode would skip the first reads
+    models.Balance._cache.clear()
+    # one counter per thread, summed once they are done
+    counts = [{"ok": 0, "gave_up": 0} for _ in range(THREADS)]
+    deadline = time.monotonic() + DURATION
+    threads = [
+        threading.Thread(target=lock_and_unlock, args=(account_ids, deadline, thread_counts))
+        for thread_counts in counts
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    return sum(c["ok"] for c in counts) / elapsed, sum(c["gave_up"] for c in counts)
+
+
+if __name__ == "__main__":
+    try:
+        with database.engine.connect() as connection:
+            connection.execute(text("select 1"))
+    except Exception as e:
+        raise SystemExit(f"needs the postgres database of the settings: {e}")
+    hot_sizes = [int(arg) for arg in sys.argv[1:]] or [1, 8, 64, 1024]
+    print(f"{THREADS} threads, {DURATION:.0f} s per run")
+    print(f"{'hot accounts':>12} {'mode':>12} {'pairs/s':>9} {'gave up':>8}")
+    for size in hot_sizes:
+        account_ids = create_accounts(size)
+        for mode in [enums.ConcurrencyMode.pessimistic.value, enums.ConcurrencyMode.optimistic.value]:
+            rate, gave_up = run(mode, account_ids)
+            print(f"{size:>12} {mode:>12} {rate:>9.0f} {gave_up:>8}")
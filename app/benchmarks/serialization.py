@@ -0,0 +1,85 @@
+"""Order history lists through pydantic and through the fast_json path.
+
+    cd app && python -m benchmarks.serialization [rows ...]
+"""
+from datetime import datetime
+from decimal import Decimal
+from types import SimpleNamespace
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+# the models before schemas, as the app imports them
+from orm import models  # noqa: F401
+from internal import enums, fast_json, schemas
+import statistics
+import timeit
+import uuid
+import sys
+
+
+class Result:
+    """The keys and row tuples of a query result, without a database."""
+
+    def __init__(self, keys: list, rows: list) -> None:
+        self._keys = keys
+        self._rows = rows
+
+    def keys(self) -> list:
+        return self._keys
+
+    def __iter__(self):
+        return iter(self._rows)
+
+
+def make_rows(count: int) -> tuple:
+    now = datetime.utcnow()
+    account_id = uuid.uuid4()
+    rows = []
+    for idx in range(count):
+        rows.append({
+            "account_id": account_id,
+            "symbol": "BTCUSDT",
+            "side": enums.OrderSide.long.value,
+            "type": enums.OrderType.limit.value,
+            "post_only": False,
+            "reduce_only": False,
+            "quantity": Decimal('0.125'),
+            "price": Decimal('27150.5') + idx,
+            "quote_quantity": Decimal('0.0'),
+            "id": uuid.uuid4(),
+            "status": enums.OrderStatus.filled.value,
+            "filled_quantity": Decimal('0.125'),
+            "filled_quote": Decimal('3393.8125'),
+            "insert_time": now,
+            "update_time": now,
+            "leverage": 5,
+        })
+    keys = list(schemas.OrderOut.__fields__)
+    return keys, rows
+
+
+def pydantic_path(keys: list, rows: list) -> bytes:
+    # what response_model does: validate every row, then jsonable_encoder
+    objects = [SimpleNamespace(**row) for row in rows]
+    orders = [schemas.OrderOut.from_orm(obj) for obj in objects]
+    return JSONResponse(jsonable_encoder(orders)).body
+
+
+def fast_path(keys: list, rows: list) -> bytes:
+    result = Result(keys, [tuple(row[key] for key in keys) for row in rows])
+    return fast_json.response(result).body
+
+
+def measure(func, keys: list, rows: list, repeat: int = 5) -> float:
+    number = max(1, 20000 // len(rows))
+    times = timeit.repeat(lambda: func(keys, rows), number=number, repeat=repeat)
+    return statistics.median(times) / number
+
+
+if __name__ == "__main__":
+    counts = [int(arg) for arg in sys.argv[1:]] or [100, 1000, 10000]
+    print(f"{'rows':>8} {'pydantic ms':>12} {'fast_json ms':>13} {'speedup':>8}")
+    for count in counts:
+        keys, rows = make_rows(count)
+        slow = measure(pydantic_path, keys, rows)
+        fast = measure(fast_path, keys, rows)
+        print(f"{count:>8} {slow * 1000:>12.2f} {fast * 1000:>13.2f} {slow / fast:>7.1f}x")
@@ -0,0 +1,76 @@
+"""Requests per second of the gunicorn serving mode by number of workers.
+
+Starts gunicorn with gunicorn_conf.py for every worker count and keeps a
+fixed number of connections busy on "/" for a while. The load generator
+runs on the same machine, leave it a core when reading the numbers.
+
+    cd app && python -m benchmarks.serving [workers ...]
+"""
+import asyncio
+import os
+import signal
+import subprocess
+import sys
+import time
+import httpx
+
+PORT = int(os.getenv("BENCHMARK_PORT", 8099))
+CONNECTIONS = int(os.getenv("BENCHMARK_CONNECTIONS", 64))
+DURATION = float(os.getenv("BENCHMARK_DURATION", 10))
+URL = f"http://127.0.0.1:{PORT}/"
+
+
+def start_server(workers: int) -> subprocess.Popen:
+    env = dict(os.environ, WEB_CONCURRENCY=str(workers), SERVICE_PORT=str(PORT),
+               PROFILER_ENABLED="false")
+    server = subprocess.Popen(
+        [sys.executable, "-m", "gunicorn", "-c", "gunicorn_conf.py", "main:app"],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(URL).status_code == 200:
+                # the first worker answered, give the others a moment
+                time.sleep(1.0)
+                return server
+        except httpx.TransportError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError(f"gunicorn with {workers} workers did not start")
+
+
+async def load(duration: float) -> tuple:
+    limits = httpx.Limits(max_connections=CONNECTIONS, max_keepalive_connections=CONNECTIONS)
+    async with httpx.AsyncClient(limits=limits) as client:
+        deadline = time.monotonic() + duration
+        counts = {"ok": 0, "failed": 0}
+
+        async def worker():
+            while time.monotonic() < deadline:
+                try:
+                    response = await client.get(URL)
+                    counts["ok" if response.status_code == 200 else "failed"] += 1
+                except httpx.TransportError:
+                    counts["failed"] += 1
+        started = time.monotonic()
+        await asyncio.gather(*[worker() for _ in range(CONNECTIONS)])
+        return counts["ok"] / (time.monotonic() - started), counts["failed"]
+
+
+if __name__ == "__main__":
+    cores = os.cpu_count() or 1
+    counts = [int(arg) for arg in sys.argv[1:]] or sorted({1, 2, 4, cores})
+    print(f"{cores} cores, {CONNECTIONS} connections, {DURATION:.0f} s per run")
+    print(f"{'workers':>8} {'req/s':>10} {'failed':>7}")
+    for workers in counts:
+        server = start_server(workers)
+        try:
+            rate, failed = asyncio.run(load(DURATION))
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait(timeout=30)
+        print(f"{workers:>8} {rate:>10.0f} {failed:>7}")
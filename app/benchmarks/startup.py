@@ -0,0 +1,51 @@
+"""Time from a fresh interpreter to a worker answering its first request.
+
+Every run is a new process, so nothing is cached from the previous one.
+Postgres and kafka do not have to be up, the startup does not wait for them.
+
+    cd app && python -m benchmarks.startup [runs]
+"""
+import statistics
+import subprocess
+import sys
+import json
+import os
+
+PROBE = """
+import time
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+from fastapi.testclient import TestClient
+with TestClient(main.app) as client:
+    started_up = time.perf_counter()
+    client.get("/")
+    served = time.perf_counter()
+import json
+print(json.dumps({
+    "import": imported - started,
+    "startup": started_up - imported,
+    "first_request": served - started_up,
+    "total": served - started,
+}))
+"""
+
+
+def run_once() -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", PROBE],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    results = [run_once() for _ in range(runs)]
+    print(f"{'stage':>14} {'median ms':>10} {'max ms':>8}")
+    for stage in ["import", "startup", "first_request", "total"]:
+        times = [result[stage] * 1000 for result in results]
+        print(f"{stage:>14} {statistics.median(times):>10.1f} {max(times):>8.1f}")
@@ -1,88 +1,286 @@
 import settings
 from orm import database, models
-from internal import enums
-import json
-import requests
-import time
+from internal import enums, schemas
+from kafka import producer
+from internal.rate_limit import TokenBucket
+import asyncio
+import collections
+import httpx
+
+
+class RateLimitError(Exception):
+    pass
+
+
+# ends the pages of a block range
+_range_done = object()
+
+
+class RequestLimiter:
+    """Caps the requests in flight to one explorer and paces them with a token bucket."""
+
+    def __init__(self, concurrency: int, rate: float) -> None:
+        self.concurrency = concurrency
+        self.rate = rate
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate=rate, capacity=max(rate, 1.0))
+
+    async def __aenter__(self):
+        await self.semaphore.acquire()
+        while not self.bucket.consume():
+            await asyncio.sleep(1 / self.rate)
+
+    async def __aexit__(self, *exc_info):
+        self.semaphore.release()
+
+    def pause(self):
+        # the explorer rejected a request, nothing is sent until the bucket
+        # refills
+        self.bucket.tokens = 0.0
 
 
 class Network:
-    def __init__(self, network) -> None:
-        self.network = network
+    """Scans the transfers of one asset on one network, with its own checkpoint."""
+
+    def __init__(self, network: models.Network, asset: models.Asset,
+                 client: httpx.AsyncClient, limiter: RequestLimiter) -> None:
+        self.asset_id = asset.id
+        self.name = f"{network.name} {asset.symbol}"
         self.address = network.address
         self.confirmations = network.confirmations
-        self.last_confirmed_block = network.last_updated_block
+        self.last_confirmed_block = asset.last_updated_block or network.last_updated_block
         self.base_url = network.rpc_url
         self.apikey = settings.ETHERSCAN_APIKEY
-        self.contract_address = self.get_asset_contract_address()
-
-    def get_asset_contract_address(self):
-        db = next(database.get_db())
-        asset = db.query(models.Asset).filter(
-            models.Asset.network == self.network
-        ).one()
-        return asset.contract_address
+        self.contract_address = asset.contract_address
+        self.timeout = network.request_timeout or settings.EXPLORER_REQUEST_TIMEOUT
+        self.client = client
+        self.limiter = limiter
 
-    def send_request(self, params):
+    async def send_request(self, params):
         params['apikey'] = self.apikey
-        response = requests.get(url=self.base_url, params=params)
-        return response.json()
+        for attempt in range(settings.EXPLORER_MAX_RETRIES):
+            async with self.limiter:
+                response = await self.client.get(
+                    self.base_url, params=params, timeout=self.timeout)
+            if response.status_code == 429 or _is_rate_limited(response):
+                self.limiter.pause()
+                await asyncio.sleep(2 ** attempt / self.limiter.rate)
+                continue
+            response.raise_for_status()
+            return response.json()
+        raise RateLimitError(
+            f"{self.name} still rate limited after {settings.EXPLORER_MAX_RETRIES} attempts")
 
-    def get_transactions(self):
-        block_number = self.get_last_block_number()
-        last_valid_block = block_number - self.confirmations
+    async def get_page(self, start_block: int, end_block: int, page: int) -> list:
         params = {
             "module": "account",
             "action": "tokentx",
             "contractaddress": self.contract_address,
             "address": self.address,
-            "page": 1,
-            "offset": 100,
-            "startblock": self.last_confirmed_block,
-            "endblock": last_valid_block,
-            "sort": "desc",
+            "page": page,
+            "offset": settings.EXPLORER_PAGE_SIZE,
+            "startblock": start_block,
+            "endblock": end_block,
+            "sort": "asc",
         }
-        trxs = self.get_all_results(params=params)
-        return trxs
-
-    def get_all_results(self, params):
-        pages = self.send_request(params=params)
+        pages = await self.send_request(params=params)
+        if not isinstance(pages['result'], list):
+            raise ValueError(f"{self.name} explorer error: {pages['result']}")
         return pages['result']
 
-    def get_last_block_number(self):
+    async def iter_transactions(self, start_block: int, end_block: int):
+        """Yield (transactions, checkpoint) pages from start_block to end_block.
+
+        Every transaction up to checkpoint has been yielded once the page is.
+        The blocks are split in EXPLORER_BLOCK_RANGE sub-ranges and as many of
+        them as the network's concurrency allows are fetched at once, each
+        only EXPLORER_PREFETCH_PAGES pages ahead of the caller. Pages are
+        still yielded in block order.
+        """
+        ranges = iter([
+            (range_start, min(range_start + settings.EXPLORER_BLOCK_RANGE - 1, end_block))
+            for range_start in range(start_block, end_block + 1, settings.EXPLORER_BLOCK_RANGE)
+        ])
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < self.limiter.concurrency:
+                    block_range = next(ranges, None)
+                    if block_range is None:
+                        break
+                    pages = asyncio.Queue(maxsize=settings.EXPLORER_PREFETCH_PAGES)
+                    task = asyncio.create_task(self._fill_range(*block_range, pages))
+                    pending.append((task, pages))
+                if not pending:
+                    return
+                task, pages = pending[0]
+                while True:
+                    page = await pages.get()
+                    if page is _range_done:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    yield page
+                pending.popleft()
+        finally:
+            for task, pages in pending:
+                task.cancel()
+
+    async def _fill_range(self, start_block: int, end_block: int, pages: asyncio.Queue):
+        # blocks while the queue is full, so a range is never fetched further
+        # ahead than the queue holds
+        try:
+            async for page in self._iter_range(start_block, end_block):
+                await pages.put(page)
+        except Exception as e:
+            await pages.put(e)
+            return
+        await pages.put(_range_done)
+
+    async def _iter_range(self, start_block: int, end_block: int):
+        size = settings.EXPLORER_PAGE_SIZE
+        cursor, page = start_block, 1
+        # hashes of the last block seen, it is fetched again when the query
+        # restarts from it
+        last_block, last_hashes = None, set()
+        while True:
+            result = await self.get_page(start_block=cursor, end_block=end_block, page=page)
+            transactions = [trx for trx in result if trx['hash'] not in last_hashes]
+            if len(result) < size:
+                yield transactions, end_block
+                return
+            block = int(result[-1]['blockNumber'])
+            if block != last_block:
+                last_block, last_hashes = block, set()
+            last_hashes.update(
+                trx['hash'] for trx in result if int(trx['blockNumber']) == block)
+            # the last block may continue on the next page
+            yield transactions, block - 1
+            if page * size < settings.EXPLORER_MAX_RESULTS:
+                page += 1
+                continue
+            # explorers only page through the first results of a query, a new
+            # one continues from the last block
+            if block == cursor:
+                raise ValueError(
+                    f"{self.name} block {block} has more transactions than one query returns")
+            cursor, page = block, 1
+
+    async def get_last_block_number(self):
         params = {
             "module": "proxy",
             "action": "eth_blockNumber",
         }
-        block = self.send_request(params=params)
+        block = await self.send_request(params=params)
         return int(block['result'], base=16)
 
 
+def _is_rate_limited(response: httpx.Response) -> bool:
+    # etherscan like explorers answer 200 with a NOTOK body when throttling
+    try:
+        body = response.json()
+    except ValueError:
+        return False
+    return isinstance(body, dict) and body.get('status') == "0" and \
+        "rate limit" in str(body.get('result', "")).lower()
+
+
 class Explorer:
+    # chain_id -> RequestLimiter, kept across rounds so the pacing of a
+    # network carries over
+    _limiters = {}
+
+    @classmethod
+    def get_limiter(cls, network: models.Network) -> RequestLimiter:
+        concurrency = network.max_concurrency or settings.EXPLORER_MAX_CONCURRENCY
+        rate = network.rate_limit or settings.EXPLORER_RATE_LIMIT
+        limiter = cls._limiters.get(network.chain_id)
+        if limiter is None or (limiter.concurrency, limiter.rate) != (concurrency, rate):
+            limiter = cls._limiters[network.chain_id] = RequestLimiter(
+                concurrency=concurrency, rate=rate)
+        return limiter
 
     @classmethod
-    def get_networks(cls):
-        networks = []
-        db = next(database.get_db())
-        db_networks = db.query(models.Network).all()
-        for _network in db_networks:
-            networks.append(Network(network=_network))
-        return networks
+    def get_networks(cls, client: httpx.AsyncClient):
+        db = database.SessionLocal()
+        try:
+            rows = db.query(models.Network, models.Asset).join(
+                models.Asset, models.Asset.standard == models.Network.standard,
+            ).all()
+        finally:
+            db.close()
+        # one scanner per asset, the assets of a network share its limiter
+        return [
+            Network(
+                network=network,
+                asset=asset,
+                client=client,
+                limiter=cls.get_limiter(network),
+            )
+            for network, asset in rows
+        ]
 
     @classmethod
-    def explore(cls):
-        networks = cls.get_networks()
-        for network in networks:
-            raw_transactions = network.get_transactions()
-            cleaned_transactions = cls.clean_transactions(
+    def commit_chunk(cls, network: Network, transactions: list, checkpoint: int):
+        # the chunk is delivered before the checkpoint moves past it, a crash
+        # in between only sends it again
+        if transactions:
+            schemas.TransactionChunk(
+                network_address=network.address,
+                asset_contract_address=network.contract_address,
+                last_block=checkpoint,
+                transactions=transactions,
+            ).publish(event_type=enums.EventType.transactions.value)
+            producer.flush()
+        db = database.SessionLocal()
+        try:
+            models.Asset.advance_block(
+                db=db, asset_id=network.asset_id, block=checkpoint)
+            db.commit()
+        finally:
+            db.close()
+
+    @classmethod
+    async def scan(cls, network: Network) -> int:
+        # only the blocks after the checkpoint that are confirmed by now
+        block_number = await network.get_last_block_number()
+        end_block = block_number - network.confirmations
+        start_block = (network.last_confirmed_block or 0) + 1
+        count = 0
+        async for raw_transactions, checkpoint in network.iter_transactions(start_block, end_block):
+            transactions = cls.clean_transactions(
                 raw_transactions, required_confirmations=network.confirmations)
-            info = {
-                "network_address": network.address,
-                "asset_contract_address": network.contract_address,
-                "transactions": cleaned_transactions,
-            }
-            # app.send_task("tasks.create_transactions", args=[
-            #               info], queue=enums.QueueName.blockchain.value)
+            await asyncio.to_thread(
+                cls.commit_chunk, network, transactions, checkpoint)
+            network.last_confirmed_block = checkpoint
+            count += len(transactions)
+        return count
+
+    @classmethod
+    async def explore(cls, client: httpx.AsyncClient) -> dict:
+        # every network is scanned at once, a slow or failing one only
+        # delays itself
+        networks = cls.get_networks(client=client)
+        results = await asyncio.gather(
+            *[cls.scan(network) for network in networks], return_exceptions=True)
+        counts = {}
+        for network, result in zip(networks, results):
+            if isinstance(result, Exception):
+                print(f"exploring {network.name} failed: {result!r}")
+                continue
+            counts[network.name] = result
+        return counts
+
+    @classmethod
+    async def run_forever(cls):
+        limits = httpx.Limits(
+            max_connections=settings.EXPLORER_MAX_CONNECTIONS,
+            max_keepalive_connections=settings.EXPLORER_MAX_CONNECTIONS,
+        )
+        async with httpx.AsyncClient(limits=limits) as client:
+            while True:
+                await cls.explore(client=client)
+                await asyncio.sleep(settings.EXPLORER_INTERVAL)
 
     @classmethod
     def clean_transactions(cls, transactions, required_confirmations):
@@ -126,4 +324,5 @@ class Explorer:
         pass
 
 
-# Explorer.explore()
+if __name__ == "__main__":
+    asyncio.run(Explorer.run_forever())
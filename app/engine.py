@@ -1,5 +1,6 @@
 from kafka.consumer import consume as kafka_concumer
-from internal import enums, match
+from internal import enums, match, contract_stats, fee_tiers, profiler
+import settings
 import json
 import time
 
@@ -8,10 +9,22 @@ def event_handler(event):
     t1 = time.time()
     event = json.loads(event)
     if event['topic'] == enums.EeventTopic.order_update.value:
-        match.receive_order(event['event'])
+        with profiler.profile("engine.receive_order"):
+            match.receive_order(event['event'])
+    maintain()
     t2 = time.time()
     print(f"done in {t2 - t1} s")
 
 
+def maintain():
+    contract_stats.maintain()
+    fee_tiers.maintain()
+
+
 if __name__ == "__main__":
-    kafka_concumer(event_handler)
+    profiler.start()
+    kafka_concumer(
+        event_handler,
+        group_id=settings.ENGINE_GROUP_ID,
+        on_idle=maintain,
+    )
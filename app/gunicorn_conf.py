@@ -0,0 +1,32 @@
+from uvicorn.workers import UvicornWorker
+import os
+import settings
+
+chdir = os.path.dirname(os.path.abspath(__file__))
+bind = f"0.0.0.0:{settings.SERVICE_PORT}"
+workers = settings.WEB_CONCURRENCY
+worker_class = "gunicorn_conf.TunedUvicornWorker"
+backlog = settings.SERVER_BACKLOG
+keepalive = settings.SERVER_KEEPALIVE
+timeout = settings.SERVER_TIMEOUT
+graceful_timeout = settings.SERVER_GRACEFUL_TIMEOUT
+max_requests = settings.SERVER_MAX_REQUESTS
+max_requests_jitter = settings.SERVER_MAX_REQUESTS_JITTER
+# the app is imported by every worker after fork so each one opens its own
+# database pool and kafka producer
+preload_app = False
+
+
+class TunedUvicornWorker(UvicornWorker):
+    CONFIG_KWARGS = {
+        "loop": "uvloop",
+        "http": "httptools",
+    }
+
+
+def post_fork(server, worker):
+    server.log.info(f"worker spawned (pid: {worker.pid})")
+
+
+def worker_exit(server, worker):
+    server.log.info(f"worker exited (pid: {worker.pid})")
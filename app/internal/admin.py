@@ -1 +1,16 @@
-pass
\ No newline at end of file
+from fastapi import APIRouter
+from internal import profiler
+
+router = APIRouter()
+
+
+@router.get("/db-stats")
+async def get_db_stats():
+    # per worker process, every gunicorn worker keeps its own
+    return profiler.get_stats()
+
+
+@router.delete("/db-stats")
+async def reset_db_stats():
+    profiler.reset()
+    return {"message": "db stats reset"}
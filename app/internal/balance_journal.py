@@ -0,0 +1,23 @@
+from orm import database, models
+from internal import jobs
+import settings
+
+
+@jobs.every(settings.BALANCE_ROLLUP_INTERVAL)
+def roll_up_balances():
+    # folds journal entries into the materialized balances so reading a
+    # current balance only has to sum the entries since the last roll up
+    db = database.SessionLocal()
+    try:
+        rolled_up = 0
+        while True:
+            count = models.Balance.roll_up(
+                db=db, batch_size=settings.BALANCE_ROLLUP_BATCH_SIZE)
+            db.commit()
+            rolled_up += count
+            if count < settings.BALANCE_ROLLUP_BATCH_SIZE:
+                break
+        if rolled_up:
+            print(f"rolled up {rolled_up} balances")
+    finally:
+        db.close()
@@ -0,0 +1,205 @@
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal
+from collections import deque
+from orm import database, models
+from internal import enums, stream, jobs
+import threading
+import settings
+
+INTERVALS = {
+    enums.CandleInterval.one_minute.value: 60,
+    enums.CandleInterval.five_minutes.value: 5 * 60,
+    enums.CandleInterval.one_hour.value: 60 * 60,
+    enums.CandleInterval.one_day.value: 24 * 60 * 60,
+}
+_epoch = datetime(1970, 1, 1)
+
+
+def get_open_time(time: datetime, interval: str) -> datetime:
+    seconds = INTERVALS[interval]
+    elapsed = int((time - _epoch).total_seconds())
+    return _epoch + timedelta(seconds=elapsed - elapsed % seconds)
+
+
+def get_trade_time(info: dict) -> datetime:
+    # trade times are naive utc, an aware one is converted so it can be
+    # compared with them
+    if info.get('insert_time'):
+        time = datetime.fromisoformat(info['insert_time'])
+    else:
+        time = datetime.utcfromtimestamp(info['timestamp'] / 1000)
+    if time.tzinfo is not None:
+        time = time.astimezone(timezone.utc).replace(tzinfo=None)
+    return time
+
+
+class Bar:
+    __slots__ = ["open_time", "open", "high", "low", "close", "volume",
+                 "quote_volume", "trades", "first_trade_time", "last_trade_time"]
+
+    def __init__(self, open_time: datetime) -> None:
+        self.open_time = open_time
+        self.open = self.high = self.low = self.close = None
+        self.volume = Decimal('0.0')
+        self.quote_volume = Decimal('0.0')
+        self.trades = 0
+        self.first_trade_time = self.last_trade_time = None
+
+    def add(self, price: Decimal, quantity: Decimal, time: datetime):
+        if self.trades == 0:
+            self.open = self.high = self.low = self.close = price
+            self.first_trade_time = self.last_trade_time = time
+        else:
+            # trades can arrive out of order, open and close follow their times
+            if time < self.first_trade_time:
+                self.open = price
+                self.first_trade_time = time
+            if time >= self.last_trade_time:
+                self.close = price
+                self.last_trade_time = time
+            self.high = max(self.high, price)
+            self.low = min(self.low, price)
+        self.volume += quantity
+        self.quote_volume += price * quantity
+        self.trades += 1
+
+    def merge(self, other: "Bar"):
+        if other.first_trade_time < self.first_trade_time:
+            self.open = other.open
+            self.first_trade_time = other.first_trade_time
+        if other.last_trade_time >= self.last_trade_time:
+            self.close = other.close
+            self.last_trade_time = other.last_trade_time
+        self.high = max(self.high, other.high)
+        self.low = min(self.low, other.low)
+        self.volume += other.volume
+        self.quote_volume += other.quote_volume
+        self.trades += other.trades
+
+    def to_dict(self) -> dict:
+        return {slot: getattr(self, slot) for slot in self.__slots__}
+
+
+class CandleAggregator:
+    """Per symbol and interval OHLCV bars built from the trade stream.
+
+    bars holds the latest bars of every series for serving, pending the
+    part of each bar not flushed to the candles table yet. Flushed parts
+    are merged into the stored candle, so a trade arriving after its bar
+    was flushed still corrects it.
+
+    offsets are the stream offsets of the last trades added to pending per
+    partition. They are only committed once those trades are flushed, so a
+    restart redelivers exactly the trades that never reached the table.
+    """
+
+    def __init__(self, max_bars: int, dedup_size: int) -> None:
+        self.max_bars = max_bars
+        self.bars = {}
+        self.pending = {}
+        # only the process that flushes keeps the unflushed parts
+        self.keep_pending = False
+        self.offsets = {}
+        self.seen = set()
+        self.seen_order = deque(maxlen=dedup_size)
+        # bars opened before the aggregator started miss earlier trades
+        self.started_at = datetime.utcnow()
+        self.lock = threading.Lock()
+
+    def add_trade(self, trade_id: str, symbol: str, price: Decimal, quantity: Decimal, time: datetime,
+                  offset: int = None, partition: int = None):
+        with self.lock:
+            if self.keep_pending and offset is not None:
+                self.offsets[partition] = max(offset, self.offsets.get(partition, -1))
+            if trade_id in self.seen:
+                return
+            if len(self.seen_order) == self.seen_order.maxlen:
+                self.seen.discard(self.seen_order[0])
+            self.seen_order.append(trade_id)
+            self.seen.add(trade_id)
+            for interval in INTERVALS:
+                open_time = get_open_time(time, interval)
+                series = self.bars.setdefault((symbol, interval), {})
+                bar = series.get(open_time)
+                if bar is None:
+                    bar = series[open_time] = Bar(open_time)
+                    if len(series) > self.max_bars:
+                        del series[min(series)]
+                bar.add(price, quantity, time)
+                if not self.keep_pending:
+                    continue
+                key = (symbol, interval, open_time)
+                if key not in self.pending:
+                    self.pending[key] = Bar(open_time)
+                self.pending[key].add(price, quantity, time)
+
+    def get_bars(self, symbol: str, interval: str, start: datetime, end: datetime) -> list:
+        with self.lock:
+            series = self.bars.get((symbol, interval), {})
+            return [
+                bar.to_dict() for open_time, bar in sorted(series.items())
+                if start <= open_time <= end and open_time >= self.started_at
+            ]
+
+    def take_pending(self) -> tuple:
+        """The unflushed bars and the offsets they cover."""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+            return pending, dict(self.offsets)
+
+    def restore_pending(self, pending: dict):
+        # a failed flush is retried with whatever arrived in the meantime
+        with self.lock:
+            for key, bar in pending.items():
+                newer = self.pending.get(key)
+                if newer is not None:
+                    bar.merge(newer)
+                self.pending[key] = bar
+
+
+aggregator = CandleAggregator(
+    max_bars=settings.CANDLE_MEMORY_BARS,
+    dedup_size=settings.CANDLE_DEDUP_SIZE,
+)
+
+
+def on_trade_event(event: dict):
+    info = event['event']
+    time = get_trade_time(info)
+    aggregator.add_trade(
+        trade_id=info['id'],
+        symbol=info['symbol'],
+        price=Decimal(info['price']),
+        quantity=Decimal(info['quantity']),
+        time=time,
+        offset=event.get('offset'),
+        partition=event.get('partition'),
+    )
+
+
+@jobs.every(settings.CANDLE_FLUSH_INTERVAL)
+def flush_candles():
+    pending, offsets = aggregator.take_pending()
+    if not pending:
+        return
+    rows = []
+    for (symbol, interval, open_time), bar in pending.items():
+        row = bar.to_dict()
+        row.update(symbol=symbol, interval=interval)
+        rows.append(row)
+    db = database.SessionLocal()
+    try:
+        models.Candle.merge(db=db, rows=rows)
+        db.commit()
+    except Exception:
+        aggregator.restore_pending(pending)
+        raise
+    finally:
+        db.close()
+    if offsets:
+        stream.commit(offsets)
+
+
+def start(flush: bool = False):
+    aggregator.keep_pending = flush
+    stream.register(enums.EeventTopic.trade.value, on_trade_event)
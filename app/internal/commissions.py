@@ -0,0 +1,22 @@
+from orm import database, models
+from internal import enums, schemas, jobs
+from kafka import producer
+import settings
+
+
+@jobs.every(settings.COMMISSION_PAYOUT_INTERVAL)
+def pay_out_commissions():
+    db = database.SessionLocal()
+    try:
+        while True:
+            claimed, balances = models.ExchangeIncome.pay_out(
+                db=db, batch_size=settings.COMMISSION_PAYOUT_BATCH_SIZE)
+            db.commit()
+            for balance in balances:
+                schemas.BalanceOut.from_orm(balance).publish(
+                    event_type=enums.EventType.balance.value)
+            producer.flush()
+            if not claimed:
+                break
+    finally:
+        db.close()
@@ -0,0 +1,166 @@
+from decimal import Decimal
+from orm import database, models
+from internal import enums, schemas
+from kafka import producer
+import threading
+import time
+import settings
+
+
+class ContractStats:
+    """Open interest and margin pool deltas of the matching process.
+
+    Fills add to in-memory deltas per symbol, so matching never writes the
+    contract row. The deltas are applied to contracts in one UPDATE every
+    `interval` seconds or `max_trades` trades, whichever comes first.
+    Deltas not flushed yet are lost with the process, so the symbols it
+    matched are periodically rebuilt from their positions.
+
+    Several engine processes may match the same symbol, for a while after a
+    rebalance. The fills behind another process's unflushed deltas are
+    already in the positions, so a rebuild would count them twice. A process
+    therefore holds a shared lock on a symbol from before it matches the
+    symbol until its deltas are flushed, and a rebuild skips the symbols
+    it can't lock exclusively.
+    """
+
+    def __init__(self, interval: float, max_trades: int) -> None:
+        self.interval = interval
+        self.max_trades = max_trades
+        self.deltas = {}
+        self.trades = 0
+        self.flushed_at = time.monotonic()
+        self.rebuilt_at = time.monotonic()
+        self.symbols = set()
+        # symbols whose shared lock this process holds
+        self.held = set()
+        self.lock = threading.Lock()
+
+    def add(self, symbol: str, open_interest: Decimal, margin_pool: Decimal, trades: int):
+        if not trades:
+            return
+        with self.lock:
+            delta = self.deltas.setdefault(symbol, {
+                "open_interest": Decimal('0.0'),
+                "margin_pool": Decimal('0.0'),
+            })
+            delta['open_interest'] += open_interest
+            delta['margin_pool'] += margin_pool
+            self.trades += trades
+            self.symbols.add(symbol)
+
+    def is_due(self) -> bool:
+        # held symbols without deltas are released by the next flush too
+        if not self.deltas and not self.held:
+            return False
+        return self.trades >= self.max_trades or \
+            time.monotonic() - self.flushed_at >= self.interval
+
+    def take(self) -> dict:
+        with self.lock:
+            deltas, self.deltas = self.deltas, {}
+            self.trades = 0
+            self.flushed_at = time.monotonic()
+        return deltas
+
+    def restore(self, deltas: dict):
+        # a failed flush is retried with whatever arrived in the meantime
+        with self.lock:
+            for symbol, delta in deltas.items():
+                newer = self.deltas.setdefault(symbol, {
+                    "open_interest": Decimal('0.0'),
+                    "margin_pool": Decimal('0.0'),
+                })
+                newer['open_interest'] += delta['open_interest']
+                newer['margin_pool'] += delta['margin_pool']
+
+
+stats = ContractStats(
+    interval=settings.CONTRACT_STATS_FLUSH_INTERVAL,
+    max_trades=settings.CONTRACT_STATS_FLUSH_TRADES,
+)
+
+
+def publish(rows: list):
+    for row in rows:
+        schemas.ContractStatsOut.from_orm(row).publish(
+            event_type=enums.EventType.contract_stats.value)
+    producer.flush()
+
+
+_connection = None
+
+
+def _get_connection():
+    # session locks outlive transactions, they are taken on a connection of
+    # their own that never sits idle in a transaction
+    global _connection
+    if _connection is None or _connection.closed or _connection.invalidated:
+        _connection = database.engine.connect().execution_options(
+            isolation_level="AUTOCOMMIT")
+    return _connection
+
+
+def hold(symbol: str):
+    """Hold the shared lock of a symbol before its contract row is locked for matching.
+
+    A rebuild holding the exclusive lock is waited for, the fills matched
+    afterwards are only counted by the deltas.
+    """
+    if symbol in stats.held:
+        return
+    models.Contract.hold_stats(connection=_get_connection(), symbols=[symbol])
+    stats.held.add(symbol)
+
+
+def release():
+    if not stats.held:
+        return
+    held, stats.held = stats.held, set()
+    models.Contract.release_stats(connection=_get_connection(), symbols=held)
+
+
+def flush():
+    deltas = stats.take()
+    if deltas:
+        db = database.SessionLocal()
+        try:
+            rows = models.Contract.add_stats(db=db, deltas=deltas)
+            db.commit()
+        except Exception:
+            stats.restore(deltas)
+            raise
+        finally:
+            db.close()
+        publish(rows)
+    # matching runs on the same thread, every fill of the held symbols is
+    # in the contracts now
+    release()
+
+
+def rebuild():
+    flush()
+    stats.rebuilt_at = time.monotonic()
+    if not stats.symbols:
+        return
+    db = database.SessionLocal()
+    try:
+        # symbols with deltas pending in another process wait for the next
+        # rebuild
+        symbols = models.Contract.lock_stats(db=db, symbols=stats.symbols)
+        rows = models.Contract.rebuild_stats(db=db, symbols=symbols)
+        db.commit()
+    finally:
+        db.close()
+    publish(rows)
+
+
+def maintain():
+    # runs inside the consumer loop, a failure must not stop matching
+    try:
+        if time.monotonic() - stats.rebuilt_at >= settings.CONTRACT_STATS_REBUILD_INTERVAL:
+            rebuild()
+        elif stats.is_due():
+            flush()
+    except Exception as e:
+        print(f"contract stats flush failed, kept for the next one: {e}")
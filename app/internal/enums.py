@@ -93,7 +93,8 @@ class QueueName(Enum):
     match_engine = "MATCH_ENGINE"
     publish = "PUBLISH"
     blockchain = "BLOCKCHAIN"
-    # public = "PUBLIC"
+    # the market data part of PUBLISH, for processes that need no private events
+    public = "PUBLIC"
 
 
 class EeventTopic(Enum):
@@ -103,6 +104,10 @@ class EeventTopic(Enum):
     balance = "balance"
     position = "position"
     order_book = "orderBook"
+    position_risk = "positionRisk"
+    ticker = "ticker"
+    contract_stats = "contractStats"
+    transactions = "transactions"
 
 
 class EventType(Enum):
@@ -114,3 +119,34 @@ class EventType(Enum):
     balance = "BALANCE"
     position = "POSITION"
     order_book = "ORDER_BOOK"
+    position_risk = "POSITION_RISK"
+    ticker = "TICKER"
+    contract_stats = "CONTRACT_STATS"
+    transactions = "TRANSACTIONS"
+
+
+class RateLimitBudget(Enum):
+    place = "PLACE"
+    cancel = "CANCEL"
+    read = "READ"
+
+
+class BalanceChange(Enum):
+    order_lock = "ORDER_LOCK"
+    order_unlock = "ORDER_UNLOCK"
+    trade = "TRADE"
+    set_balance = "SET_BALANCE"
+    funding = "FUNDING"
+    commission = "COMMISSION"
+
+
+class ConcurrencyMode(Enum):
+    pessimistic = "PESSIMISTIC"
+    optimistic = "OPTIMISTIC"
+
+
+class CandleInterval(Enum):
+    one_minute = "1m"
+    five_minutes = "5m"
+    one_hour = "1h"
+    one_day = "1d"
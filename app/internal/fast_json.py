@@ -0,0 +1,32 @@
+from decimal import Decimal
+from fastapi.responses import JSONResponse
+from sqlalchemy.engine import Result
+import orjson
+
+
+def _default(value):
+    # orjson encodes UUID and datetime itself; Decimal keeps the float
+    # representation that fastapi's jsonable_encoder would have produced.
+    if isinstance(value, Decimal):
+        return float(value)
+    raise TypeError
+
+
+class FastJSONResponse(JSONResponse):
+    media_type = "application/json"
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=_default)
+
+
+def columns(model, schema) -> list:
+    return [getattr(model, field).label(field) for field in schema.__fields__]
+
+
+def rows(result: Result) -> list[dict]:
+    keys = list(result.keys())
+    return [dict(zip(keys, row)) for row in result]
+
+
+def response(result: Result) -> FastJSONResponse:
+    return FastJSONResponse(rows(result))
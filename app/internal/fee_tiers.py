@@ -0,0 +1,98 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from orm import database, models
+import threading
+import time
+import settings
+
+
+class VolumeAccumulator:
+    """Traded quote volume of the matching process by account and day.
+
+    Fills are added in memory and written to the daily buckets of
+    accountvolumes in one upsert every `interval` seconds or `max_trades`
+    fills, so the 30 day volume is never summed from subtrades.
+    """
+
+    def __init__(self, interval: float, max_trades: int) -> None:
+        self.interval = interval
+        self.max_trades = max_trades
+        self.volumes = {}
+        self.trades = 0
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def add(self, fills: list):
+        if not fills:
+            return
+        day = datetime.utcnow().date()
+        with self.lock:
+            for account_id, quote_quantity in fills:
+                key = (str(account_id), day)
+                self.volumes[key] = self.volumes.get(key, Decimal('0.0')) + quote_quantity
+            self.trades += len(fills)
+
+    def is_due(self) -> bool:
+        if not self.volumes:
+            return False
+        return self.trades >= self.max_trades or \
+            time.monotonic() - self.flushed_at >= self.interval
+
+    def take(self) -> dict:
+        with self.lock:
+            volumes, self.volumes = self.volumes, {}
+            self.trades = 0
+            self.flushed_at = time.monotonic()
+        return volumes
+
+    def restore(self, volumes: dict):
+        # a failed flush is retried with whatever arrived in the meantime
+        with self.lock:
+            for key, volume in volumes.items():
+                self.volumes[key] = self.volumes.get(key, Decimal('0.0')) + volume
+
+
+volumes = VolumeAccumulator(
+    interval=settings.FEE_VOLUME_FLUSH_INTERVAL,
+    max_trades=settings.FEE_VOLUME_FLUSH_TRADES,
+)
+_refreshed_at = None
+
+
+def flush():
+    pending = volumes.take()
+    if not pending:
+        return
+    db = database.SessionLocal()
+    try:
+        models.AccountVolume.add(db=db, volumes=pending)
+        db.commit()
+    except Exception:
+        volumes.restore(pending)
+        raise
+    finally:
+        db.close()
+
+
+def refresh():
+    global _refreshed_at
+    since = datetime.utcnow().date() - timedelta(days=settings.FEE_VOLUME_DAYS - 1)
+    db = database.SessionLocal()
+    try:
+        tiers = models.AccountVolume.load_tiers(db=db, since=since)
+    finally:
+        db.close()
+    _refreshed_at = time.monotonic()
+    print(f"fee tiers refreshed, {len(tiers)} accounts above the first tier")
+
+
+def maintain():
+    # runs inside the consumer loop, a failure must not stop matching
+    try:
+        if volumes.is_due():
+            flush()
+        if _refreshed_at is None or \
+                time.monotonic() - _refreshed_at >= settings.FEE_TIER_REFRESH_INTERVAL:
+            refresh()
+    except Exception as e:
+        print(f"fee tier maintenance failed, retried on the next call: {e}")
@@ -0,0 +1,123 @@
+from datetime import datetime
+from decimal import Decimal
+from sqlalchemy import select, or_
+from orm import database, models
+from internal import enums, schemas, jobs
+from kafka import producer
+import numpy as np
+import uuid
+import time
+import settings
+
+
+def get_funding_time(now: float = None) -> datetime:
+    now = time.time() if now is None else now
+    return datetime.utcfromtimestamp(now - now % settings.FUNDING_INTERVAL)
+
+
+def compute_payments(positions: list, funding_rates: dict, mark_prices: dict) -> np.ndarray:
+    # longs pay shorts when the rate is positive and the other way round
+    sign = np.array([
+        1.0 if position.side == enums.OrderSide.long.value else -1.0 for position in positions])
+    quantity = np.array([float(position.quantity) for position in positions])
+    mark_price = np.array([float(mark_prices[position.symbol])
+                          for position in positions])
+    funding_rate = np.array([float(funding_rates[position.symbol])
+                            for position in positions])
+    return -sign * quantity * mark_price * funding_rate
+
+
+_settled_time = None
+
+
+@jobs.every(settings.FUNDING_CHECK_INTERVAL)
+def settle_funding():
+    # checks often so a round settles right after its funding time, the
+    # same round is only settled again when a previous run failed part way,
+    # and the ledger's unique (position_id, funding_time) skips what it paid
+    global _settled_time
+    funding_time = get_funding_time()
+    if funding_time == _settled_time:
+        return
+    db = database.SessionLocal()
+    try:
+        funding_rates = dict(db.execute(select(
+            models.Contract.symbol,
+            models.Contract.funding_rate,
+        ).where(
+            models.Contract.funding_rate != Decimal('0.0'),
+        )).all())
+        if not funding_rates:
+            _settled_time = funding_time
+            return
+        mark_prices = models.Trade.get_last_prices(
+            db=db, symbols=list(funding_rates))
+        # only positions already open at the funding time pay or receive
+        positions = db.execute(select(
+            models.Position.id,
+            models.Position.account_id,
+            models.Position.symbol,
+            models.Position.side,
+            models.Position.quantity,
+        ).where(
+            models.Position.quantity > Decimal('0.0'),
+            models.Position.symbol.in_(list(mark_prices)),
+            or_(
+                models.Position.opened_at.is_(None),
+                models.Position.opened_at <= funding_time,
+            ),
+        ).order_by(
+            models.Position.account_id,
+        )).all()
+        db.rollback()
+        if not positions:
+            _settled_time = funding_time
+            return
+        amounts = compute_payments(
+            positions=positions,
+            funding_rates=funding_rates,
+            mark_prices=mark_prices,
+        )
+        settled = 0
+        for start in range(0, len(positions), settings.FUNDING_CHUNK_SIZE):
+            payments = []
+            for position, amount in zip(positions[start:start + settings.FUNDING_CHUNK_SIZE], amounts[start:start + settings.FUNDING_CHUNK_SIZE]):
+                payments.append({
+                    "id": uuid.uuid4(),
+                    "position_id": position.id,
+                    "account_id": position.account_id,
+                    "symbol": position.symbol,
+                    "side": position.side,
+                    "quantity": position.quantity,
+                    "mark_price": mark_prices[position.symbol],
+                    "funding_rate": funding_rates[position.symbol],
+                    "amount": round(Decimal(float(amount)), 12),
+                    "funding_time": funding_time,
+                })
+            balances, short_positions = models.FundingPayment.settle_chunk(
+                db=db, payments=payments)
+            db.commit()
+            for balance in balances:
+                schemas.BalanceOut.from_orm(balance).publish(
+                    event_type=enums.EventType.balance.value)
+            for position in short_positions:
+                schemas.PositionOut.from_orm(position).publish(
+                    event_type=enums.EventType.position.value)
+            # free could not cover the funding of these, close them now
+            # instead of waiting for the price to reach the new liquidation price
+            for position in short_positions:
+                order = models.Position.liquidate(
+                    db=db, position_id=position.id, price=position.liquidation_price)
+                if order is None:
+                    continue
+                db.commit()
+                print(f"liquidation order {order.id} sent for position {position.id} short of funding")
+                schemas.OrderOut.from_orm(order).publish(
+                    event_type=enums.EventType.send_order.value)
+            producer.flush()
+            settled += len(balances)
+        _settled_time = funding_time
+        print(
+            f"funding {funding_time} settled for {len(positions)} positions, {settled} balances")
+    finally:
+        db.close()
@@ -0,0 +1,36 @@
+from internal import profiler
+import time
+
+_jobs = []
+
+
+def every(seconds: float):
+    def register(func: callable):
+        _jobs.append({
+            "func": func,
+            "interval": seconds,
+            "next_run": 0.0,
+        })
+        return func
+    return register
+
+
+def run_pending():
+    now = time.monotonic()
+    for job in _jobs:
+        if job['next_run'] > now:
+            continue
+        try:
+            with profiler.profile(f"job.{job['func'].__name__}"):
+                job['func']()
+        except Exception as e:
+            print(f"job {job['func'].__name__} failed: {e}")
+        job['next_run'] = time.monotonic() + job['interval']
+
+
+def run_forever():
+    print(f"scheduler started: {[job['func'].__name__ for job in _jobs]}")
+    while True:
+        run_pending()
+        next_run = min([job['next_run'] for job in _jobs], default=1.0)
+        time.sleep(max(next_run - time.monotonic(), 0.05))
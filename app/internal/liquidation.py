@@ -0,0 +1,165 @@
+from decimal import Decimal
+from sqlalchemy import select
+from orm import database, models
+from internal import enums, schemas, stream, jobs
+import threading
+import bisect
+import settings
+
+
+class LiquidationIndex:
+    """Per symbol positions ordered by how close they are to liquidation.
+
+    Longs are liquidated when the price falls to their liquidation price and
+    shorts when it rises to it. Both sides are kept as ascending lists of
+    (key, position_id) where the key is -liquidation_price for longs and
+    liquidation_price for shorts, so the crossed positions are always a
+    prefix of the list.
+    """
+
+    def __init__(self) -> None:
+        self.sides = {}
+        self.positions = {}
+        self.lock = threading.Lock()
+
+    def _side_list(self, symbol: str, side: str) -> list:
+        return self.sides.setdefault((symbol, side), [])
+
+    @staticmethod
+    def _key(side: str, liquidation_price: Decimal) -> Decimal:
+        if side == enums.OrderSide.long.value:
+            return -liquidation_price
+        return liquidation_price
+
+    def _remove(self, position_id: str):
+        entry = self.positions.pop(position_id, None)
+        if entry is None:
+            return
+        symbol, side, key = entry
+        side_list = self._side_list(symbol, side)
+        idx = bisect.bisect_left(side_list, (key, position_id))
+        if idx < len(side_list) and side_list[idx] == (key, position_id):
+            del side_list[idx]
+
+    def update(self, position_id: str, symbol: str, side: str, quantity: Decimal, liquidation_price: Decimal):
+        with self.lock:
+            self._remove(position_id)
+            if quantity <= Decimal('0.0') or liquidation_price <= Decimal('0.0'):
+                return
+            key = self._key(side, liquidation_price)
+            bisect.insort(self._side_list(symbol, side), (key, position_id))
+            self.positions[position_id] = (symbol, side, key)
+
+    def pop_crossed(self, symbol: str, price: Decimal) -> list:
+        crossed = []
+        with self.lock:
+            for side in [enums.OrderSide.long.value, enums.OrderSide.short.value]:
+                side_list = self._side_list(symbol, side)
+                limit = self._key(side, price)
+                end = bisect.bisect_right(side_list, (limit, chr(0x10FFFF)))
+                for key, position_id in side_list[:end]:
+                    self.positions.pop(position_id, None)
+                    crossed.append(position_id)
+                del side_list[:end]
+        return crossed
+
+    def load(self, rows: list):
+        # built aside and swapped in at once, so trades never see a
+        # half filled index
+        sides, positions = {}, {}
+        for row in rows:
+            if row.quantity <= Decimal('0.0') or row.liquidation_price <= Decimal('0.0'):
+                continue
+            key = self._key(row.side, row.liquidation_price)
+            position_id = str(row.id)
+            sides.setdefault((row.symbol, row.side), []).append((key, position_id))
+            positions[position_id] = (row.symbol, row.side, key)
+        for side_list in sides.values():
+            side_list.sort()
+        with self.lock:
+            self.sides = sides
+            self.positions = positions
+
+
+index = LiquidationIndex()
+
+
+def restore(db, position_id: str):
+    position = db.execute(select(
+        models.Position.symbol,
+        models.Position.side,
+        models.Position.quantity,
+        models.Position.liquidation_price,
+    ).where(
+        models.Position.id == position_id,
+    )).one_or_none()
+    if position is None:
+        return
+    index.update(
+        position_id=str(position_id),
+        symbol=position.symbol,
+        side=position.side,
+        quantity=position.quantity,
+        liquidation_price=position.liquidation_price,
+    )
+
+
+def liquidate(position_ids: list, price: Decimal):
+    db = database.SessionLocal()
+    try:
+        for position_id in position_ids:
+            order = models.Position.liquidate(
+                db=db, position_id=position_id, price=price)
+            if order is None:
+                # not liquidated after all, put it back as it is now
+                restore(db=db, position_id=position_id)
+                db.rollback()
+                continue
+            db.commit()
+            print(f"liquidation order {order.id} sent for position {position_id}")
+            schemas.OrderOut.from_orm(order).publish(
+                event_type=enums.EventType.send_order.value)
+    finally:
+        db.close()
+
+
+def on_trade_event(event: dict):
+    info = event['event']
+    price = Decimal(info['price'])
+    crossed = index.pop_crossed(symbol=info['symbol'], price=price)
+    if crossed:
+        liquidate(position_ids=crossed, price=price)
+
+
+def on_position_event(event: dict):
+    info = event['event']
+    index.update(
+        position_id=info['id'],
+        symbol=info['symbol'],
+        side=info['side'],
+        quantity=abs(Decimal(info['size'])),
+        liquidation_price=Decimal(info['liquidation_price']),
+    )
+
+
+@jobs.every(settings.LIQUIDATION_RESYNC_INTERVAL)
+def resync_index():
+    db = database.SessionLocal()
+    try:
+        rows = db.execute(select(
+            models.Position.id,
+            models.Position.symbol,
+            models.Position.side,
+            models.Position.quantity,
+            models.Position.liquidation_price,
+        ).where(
+            models.Position.quantity > Decimal('0.0'),
+        )).all()
+    finally:
+        db.close()
+    index.load(rows)
+
+
+def start():
+    stream.register(enums.EeventTopic.trade.value, on_trade_event)
+    stream.register(enums.EeventTopic.position.value, on_position_event)
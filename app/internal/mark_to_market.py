@@ -0,0 +1,134 @@
+from decimal import Decimal
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from orm import database, models
+from internal import enums, schemas, stream, jobs
+import numpy as np
+import settings
+
+last_prices = {}
+# symbols without a recent trade, not queried again until one trades
+_unpriced = set()
+
+
+class PositionBook:
+    """Open positions as columnar arrays, contiguous per symbol."""
+
+    def __init__(self, rows: list) -> None:
+        rows = sorted(rows, key=lambda row: row.symbol)
+        self.ids = [row.id for row in rows]
+        self.account_ids = [row.account_id for row in rows]
+        self.sides = [row.side for row in rows]
+        self.symbols = {}
+        for idx, row in enumerate(rows):
+            start, _ = self.symbols.get(row.symbol, (idx, idx))
+            self.symbols[row.symbol] = (start, idx + 1)
+        self.sign = np.array(
+            [1.0 if row.side == enums.OrderSide.long.value else -1.0 for row in rows])
+        self.quantity = np.array([float(row.quantity) for row in rows])
+        self.entry_price = np.array([float(row.entry_price) for row in rows])
+        self.margin = np.array([float(row.margin) for row in rows])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, db: Session, account_id=None):
+        query = select(
+            models.Position.id,
+            models.Position.account_id,
+            models.Position.symbol,
+            models.Position.side,
+            models.Position.quantity,
+            models.Position.entry_price,
+            models.Position.margin,
+        ).where(
+            models.Position.margin > Decimal('0.0'),
+        )
+        if account_id:
+            query = query.where(models.Position.account_id == account_id)
+        return cls(db.execute(query).all())
+
+    def mark(self, mark_prices: dict) -> dict:
+        mark_price = np.full(len(self), np.nan)
+        for symbol, (start, end) in self.symbols.items():
+            if symbol in mark_prices:
+                mark_price[start:end] = float(mark_prices[symbol])
+        unrealized_pnl = self.sign * self.quantity * \
+            (mark_price - self.entry_price)
+        equity = self.margin + unrealized_pnl
+        # 1.0 at entry, 0.0 at the liquidation price
+        margin_ratio = np.divide(
+            equity, self.margin, out=np.zeros(len(self)), where=self.margin > 0)
+        return {
+            "mark_price": mark_price,
+            "unrealized_pnl": unrealized_pnl,
+            "equity": equity,
+            "margin_ratio": margin_ratio,
+        }
+
+    def iter_risk(self, mark_prices: dict):
+        marked = self.mark(mark_prices)
+        for symbol, (start, end) in self.symbols.items():
+            if symbol not in mark_prices:
+                continue
+            for idx in range(start, end):
+                yield schemas.PositionRiskOut(
+                    id=self.ids[idx],
+                    account_id=self.account_ids[idx],
+                    symbol=symbol,
+                    side=self.sides[idx],
+                    quantity=self.quantity[idx],
+                    entry_price=self.entry_price[idx],
+                    margin=self.margin[idx],
+                    mark_price=marked['mark_price'][idx],
+                    unrealized_pnl=marked['unrealized_pnl'][idx],
+                    equity=marked['equity'][idx],
+                    margin_ratio=marked['margin_ratio'][idx],
+                )
+
+
+def get_mark_prices(db: Session, symbols: list) -> dict:
+    missing = [symbol for symbol in symbols
+               if symbol not in last_prices and symbol not in _unpriced]
+    if missing:
+        found = models.Trade.get_last_prices(db=db, symbols=missing)
+        last_prices.update(found)
+        _unpriced.update(symbol for symbol in missing if symbol not in found)
+    return last_prices
+
+
+def on_trade_event(event: dict):
+    info = event['event']
+    last_prices[info['symbol']] = Decimal(info['price'])
+    _unpriced.discard(info['symbol'])
+
+
+def start():
+    stream.register(enums.EeventTopic.trade.value, on_trade_event)
+
+
+_book = None
+
+
+@jobs.every(settings.POSITION_BOOK_RELOAD_INTERVAL)
+def reload_position_book():
+    global _book
+    db = database.SessionLocal()
+    try:
+        _book = PositionBook.load(db=db)
+    finally:
+        db.close()
+
+
+@jobs.every(settings.MARK_TO_MARKET_INTERVAL)
+def publish_position_risk():
+    if not _book:
+        return
+    db = database.SessionLocal()
+    try:
+        mark_prices = get_mark_prices(db=db, symbols=list(_book.symbols))
+    finally:
+        db.close()
+    for position_risk in _book.iter_risk(mark_prices):
+        position_risk.publish(event_type=enums.EventType.position_risk.value)
@@ -1,22 +1,45 @@
 from decimal import Decimal
-from sqlalchemy.orm import Session
+from sqlalchemy.orm import Session, exc, raiseload
 from orm import database, models
-from internal import enums, schemas
+from internal import enums, schemas, contract_stats, fee_tiers, profiler
+import settings
 import json
 
 
 def receive_order(event):
+    # in the optimistic concurrency mode a position changed by a concurrent
+    # writer fails the commit, nothing has been published yet so the whole
+    # order is matched again
+    for attempt in range(settings.CONCURRENCY_MAX_RETRIES):
+        try:
+            return _receive_order(event)
+        except (exc.StaleDataError, models.ConcurrentUpdateError) as e:
+            print(f"order {event['id']} conflicted, retrying: {e}")
+    print(f"order {event['id']} gave up after {settings.CONCURRENCY_MAX_RETRIES} attempts")
+    return False
+
+
+def _receive_order(event):
     # event = order_event['event']
     query = [models.Order.id == event['id']]
     if event.get('status') == enums.OrderStatus.queued.value:
         event_type = enums.EventType.send_order.value
     else:
         event_type = enums.EventType.cancel_order.value
-    db = database.SessionLocal()
+    # the events are built from the objects after the commit, expiring them
+    # would cost a SELECT per order, position and trade being published
+    db = database.SessionLocal(expire_on_commit=False)
     try:
-        order = db.query(models.Order).filter(*query).with_for_update().one()
-    except Exception as e:
+        return _process_order(db=db, query=query, event_type=event_type)
+    finally:
         db.close()
+
+
+def _process_order(db: Session, query: list, event_type: str):
+    try:
+        order = db.query(models.Order).options(
+            raiseload("*")).filter(*query).with_for_update().one()
+    except Exception as e:
         return False
     order_matched = False
     records = {
@@ -25,10 +48,16 @@ def receive_order(event):
         "sub_trades": [],
         "balances": {'makers': [], 'taker': []},
         "positions": [],
+        "contract_stats": {
+            "open_interest": Decimal('0.0'),
+            "margin_pool": Decimal('0.0'),
+        },
+        "volumes": [],
     }
     if event_type == enums.EventType.cancel_order.value:
         new_events = cancel_order(db=db, order=order, records=records)
     else:
+        contract_stats.hold(order.symbol)
         contract = db.query(models.Contract).filter(
             models.Contract.symbol == order.symbol,
         ).with_for_update().one()
@@ -45,14 +74,20 @@ def receive_order(event):
             new_events = cancel_order(db=db, order=order, records=records)
     if order_matched:
         db.commit()
+        contract_stats.stats.add(
+            symbol=order.symbol,
+            trades=len(new_events['trades']),
+            **new_events['contract_stats'],
+        )
+        fee_tiers.volumes.add(new_events['volumes'])
     new_events['orders'].append(order)
-    new_events['order_book_updates'] = get_order_book_updates(
-        db=db,
-        sub_trades=new_events['sub_trades'],
-        new_order=order,
-    )
-    publish_new_events(new_events, symbol=order.symbol)
-    db.close()
+    with profiler.profile("engine.publish"):
+        new_events['order_book_updates'] = get_order_book_updates(
+            db=db,
+            sub_trades=new_events['sub_trades'],
+            new_order=order,
+        )
+        publish_new_events(new_events, symbol=order.symbol)
 
 
 def get_order_book_updates(db: Session, sub_trades: list[models.SubTrade], new_order: models.Order) -> list:
@@ -100,7 +135,8 @@ def cancel_order(db: Session, order: models.Order, records: dict) -> dict:
                 info={
                     "account_id": order.account_id,
                     "asset": enums.CollateralAsset.usdt.value,
-                    "amount": order.locked_quantity
+                    "amount": order.locked_quantity,
+                    "ref_id": order.id,
                 },
                 db=db
             )
@@ -122,34 +158,25 @@ def cancel_order(db: Session, order: models.Order, records: dict) -> dict:
     return records
 
 
-def match_order(db: Session, order: models.Order, records: dict, contract: models.Contract, offset: int = 0) -> dict:
+def match_order(db: Session, order: models.Order, records: dict, contract: models.Contract) -> dict:
     if order.post_only:
         order.status = enums.OrderStatus.placed.value
         records['orders'].append(order)
         return records
-    if order.side == enums.OrderSide.long.value:
-        opposite_side = enums.OrderSide.short.value
-        price_order_by = models.Order.price.asc()
-    else:
-        opposite_side = enums.OrderSide.long.value
-        price_order_by = models.Order.price.desc()
-    maker_orders_query = [
-        models.Order.status.in_(enums.OrderStatus.active_orders.value),
-        models.Order.symbol == order.symbol,
-        models.Order.side == opposite_side,
-    ]
-    if order.type == enums.OrderType.limit.value:
-        if order.side == enums.OrderSide.long.value:
-            maker_orders_query.append(models.Order.price <= order.price)
-        else:
-            maker_orders_query.append(models.Order.price >= order.price)
-    maker_orders = db.query(models.Order).filter(
-        *maker_orders_query
-    ).order_by(
-        price_order_by,
-        models.Order.insert_time.desc()
-    ).offset(offset=offset).limit(10)
-    if maker_orders.count() > 0:
+    matched_ids = []
+    while True:
+        maker_orders = models.Order.get_maker_orders(
+            db=db, order=order, exclude_ids=matched_ids)
+        if not maker_orders:
+            break
+        matched_ids += [maker_order.id for maker_order in maker_orders]
+        settlement = models.Settlement(
+            db=db,
+            symbol=order.symbol,
+            account_ids=[order.account_id] +
+            [maker_order.account_id for maker_order in maker_orders],
+        )
+        trade = None
         for maker_order in maker_orders:
             trade = models.Trade.create_trade(
                 db=db,
@@ -159,17 +186,27 @@ def match_order(db: Session, order: models.Order, records: dict, contract: model
             )
             if not trade:
                 break
-            sub_trades, balances, positions = models.SubTrade.create_sub_trades(
-                db, trade)
+            sub_trades, positions = models.SubTrade.create_sub_trades(
+                db, trade, settlement)
             records['orders'].append(maker_order)
             records['trades'].append(trade)
             records['sub_trades'] += sub_trades
-            records['balances']['makers'] += balances['maker']
-            records['balances']['taker'] = balances['taker']
             records['positions'] += positions
+            records['volumes'] += [
+                (maker_order.account_id, trade.quote_quantity),
+                (order.account_id, trade.quote_quantity),
+            ]
             if order.status == enums.OrderStatus.filled.value:
-                return records
-        return match_order(db=db, order=order, records=records, offset=offset+1)
+                break
+        records['contract_stats']['open_interest'] += settlement.open_interest
+        records['contract_stats']['margin_pool'] += settlement.margin_pool
+        for balance in settlement.settle():
+            if str(balance.account_id) == str(order.account_id):
+                records['balances']['taker'] = [balance]
+            else:
+                records['balances']['makers'].append(balance)
+        if not trade or order.status == enums.OrderStatus.filled.value:
+            return records
     if order.type == enums.OrderType.limit.value and order.status == enums.OrderStatus.queued.value:
         order.status = enums.OrderStatus.placed.value
     return records
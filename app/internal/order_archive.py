@@ -0,0 +1,26 @@
+from orm import database, models
+from internal import jobs
+import settings
+
+
+@jobs.every(settings.ORDER_ARCHIVE_INTERVAL)
+def archive_orders():
+    # keeps orders down to the open and recently closed orders matching and
+    # the order book read, everything older is read through all_orders
+    db = database.SessionLocal()
+    try:
+        archived = 0
+        while True:
+            count = models.Order.archive(
+                db=db,
+                batch_size=settings.ORDER_ARCHIVE_BATCH_SIZE,
+                min_age=settings.ORDER_ARCHIVE_MIN_AGE,
+            )
+            db.commit()
+            archived += count
+            if count < settings.ORDER_ARCHIVE_BATCH_SIZE:
+                break
+        if archived:
+            print(f"archived {archived} orders")
+    finally:
+        db.close()
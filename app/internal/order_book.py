@@ -0,0 +1,199 @@
+from decimal import Decimal, ROUND_CEILING, ROUND_FLOOR
+from orm import database, models
+from starlette.concurrency import run_in_threadpool
+from internal import enums, stream
+from kafka import consumer
+import threading
+import bisect
+import time
+import settings
+
+
+class OrderBook:
+    """Price levels of one symbol, kept up to date by the order book deltas.
+
+    The sequence is the offset of the last delta on the public queue, the
+    same in every process that holds the book. A snapshot is as new as the
+    deltas before the high watermark of the book's partition when it was
+    read, deltas from before it are dropped.
+    """
+
+    def __init__(self, symbol: str) -> None:
+        self.symbol = symbol
+        self.key = f"{symbol}:{enums.EeventTopic.order_book.value}"
+        self.sequence = -1
+        self.levels = {
+            enums.OrderSide.long.value: {},
+            enums.OrderSide.short.value: {},
+        }
+        # ascending prices per side, bids are read from the end
+        self.prices = {
+            enums.OrderSide.long.value: [],
+            enums.OrderSide.short.value: [],
+        }
+        self.lock = threading.Lock()
+        self.resyncing = False
+        self.pending = []
+
+    def _set_level(self, side: str, price: Decimal, quantity: Decimal):
+        levels = self.levels[side]
+        prices = self.prices[side]
+        if quantity > Decimal('0.0'):
+            if price not in levels:
+                bisect.insort(prices, price)
+            levels[price] = quantity
+        elif price in levels:
+            del levels[price]
+            del prices[bisect.bisect_left(prices, price)]
+
+    def _apply(self, side: str, price: Decimal, quantity: Decimal, offset: int = None):
+        if offset is None:
+            # not from the public queue, nothing to order it by
+            self._set_level(side, price, quantity)
+            return
+        if offset <= self.sequence:
+            return
+        self._set_level(side, price, quantity)
+        self.sequence = offset
+
+    def apply_update(self, side: str, price: Decimal, quantity: Decimal, offset: int = None):
+        with self.lock:
+            if self.resyncing:
+                self.pending.append((side, price, quantity, offset))
+                return
+            self._apply(side, price, quantity, offset)
+
+    def resync(self):
+        with self.lock:
+            self.resyncing = True
+            self.pending = []
+        # every delta below the watermark was published, so committed,
+        # before the snapshot is read
+        high = consumer.get_high_watermark(
+            topic=enums.QueueName.public.value, key=self.key)
+        db = database.SessionLocal()
+        try:
+            rows = models.Order.get_order_book(db=db, symbol=self.symbol)
+        except Exception:
+            with self.lock:
+                self.resyncing = False
+                for update in self.pending:
+                    self._apply(*update)
+                self.pending = []
+            raise
+        finally:
+            db.close()
+        with self.lock:
+            for side in self.levels:
+                self.levels[side] = {}
+                self.prices[side] = []
+            for row in rows:
+                self._set_level(row.side, row.price, row.quantity)
+            if high is not None:
+                self.sequence = max(self.sequence, high - 1)
+            for update in self.pending:
+                self._apply(*update)
+            self.pending = []
+            self.resyncing = False
+
+    def _side_levels(self, side: str, depth: int, group: Decimal = None) -> list:
+        prices = self.prices[side]
+        levels = self.levels[side]
+        is_bid = side == enums.OrderSide.long.value
+        ordered = reversed(prices) if is_bid else iter(prices)
+        if not group:
+            book = []
+            for price in ordered:
+                if len(book) == depth:
+                    break
+                book.append({"price": price, "quantity": levels[price]})
+            return book
+        rounding = ROUND_FLOOR if is_bid else ROUND_CEILING
+        book = []
+        for price in ordered:
+            bucket = (price / group).to_integral_value(rounding) * group
+            if book and book[-1]['price'] == bucket:
+                book[-1]['quantity'] += levels[price]
+                continue
+            if len(book) == depth:
+                break
+            book.append({"price": bucket, "quantity": levels[price]})
+        return book
+
+    def snapshot(self, depth: int, group: Decimal = None) -> dict:
+        with self.lock:
+            return {
+                "symbol": self.symbol,
+                "sequence": self.sequence,
+                "bids": self._side_levels(enums.OrderSide.long.value, depth, group),
+                "asks": self._side_levels(enums.OrderSide.short.value, depth, group),
+            }
+
+
+_books = {}
+_books_lock = threading.Lock()
+_resync_thread = None
+
+
+def get_book(symbol: str) -> OrderBook:
+    # blocks on the database the first time a symbol is asked for, async
+    # callers go through load_book
+    book = _books.get(symbol)
+    if book is not None:
+        return book
+    db = database.SessionLocal()
+    try:
+        contract = db.query(models.Contract).filter(
+            models.Contract.symbol == symbol
+        ).first()
+    finally:
+        db.close()
+    if not contract:
+        return None
+    with _books_lock:
+        book = _books.get(symbol)
+        if book is None:
+            book = OrderBook(symbol=symbol)
+            book.resync()
+            _books[symbol] = book
+    return book
+
+
+async def load_book(symbol: str) -> OrderBook:
+    book = _books.get(symbol)
+    if book is not None:
+        return book
+    return await run_in_threadpool(get_book, symbol)
+
+
+def on_order_book_event(event: dict):
+    symbol = event['topic'].split(':')[0]
+    book = _books.get(symbol)
+    if book is None:
+        return
+    info = event['event']
+    book.apply_update(
+        side=info['side'],
+        price=Decimal(info['price']),
+        quantity=Decimal(info['quantity']),
+        offset=event.get('offset'),
+    )
+
+
+def _resync_forever():
+    while True:
+        time.sleep(settings.ORDER_BOOK_RESYNC_INTERVAL)
+        for book in list(_books.values()):
+            try:
+                book.resync()
+            except Exception as e:
+                print(f"order book resync failed for {book.symbol}: {e}")
+
+
+def start():
+    global _resync_thread
+    stream.register(enums.EeventTopic.order_book.value, on_order_book_event)
+    if _resync_thread is None:
+        _resync_thread = threading.Thread(
+            target=_resync_forever, name="order-book-resync", daemon=True)
+        _resync_thread.start()
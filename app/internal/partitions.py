@@ -0,0 +1,111 @@
+from datetime import datetime
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
+from orm import database
+from internal import jobs
+import settings
+import uuid
+import os
+
+# tables range partitioned by month on insert_time
+PARTITIONED_TABLES = ["trades", "subtrades"]
+
+
+def get_month(value: datetime, months: int = 0) -> datetime:
+    month = value.year * 12 + value.month - 1 + months
+    return datetime(month // 12, month % 12 + 1, 1)
+
+
+def get_partitions(db: Session, table: str) -> list:
+    # (name, upper bound) of every range partition, the default partition
+    # has no bound and is left out
+    query = """
+        select
+        child.relname as name,
+        substring(pg_get_expr(child.relpartbound, child.oid) from 'TO \\(''([^'']+)''\\)')::timestamp as upper_bound
+        from pg_inherits
+        join pg_class as child on child.oid = pg_inherits.inhrelid
+        where pg_inherits.inhparent = cast(:table as regclass)
+    """
+    rows = db.execute(text(query), {"table": table}).all()
+    return [row for row in rows if row.upper_bound is not None]
+
+
+def create_partitions(db: Session, ahead: int):
+    this_month = get_month(datetime.utcnow())
+    for table in PARTITIONED_TABLES:
+        db.execute(text(
+            f"create table if not exists {table}_default partition of {table} default"))
+        covered = max([row.upper_bound for row in get_partitions(db=db, table=table)], default=this_month)
+        start = max(covered, this_month)
+        while start <= get_month(this_month, ahead):
+            end = get_month(start, 1)
+            db.execute(text(
+                f"create table if not exists {table}_p{start:%Y%m} partition of {table} "
+                f"for values from ('{start.isoformat()}') to ('{end.isoformat()}')"
+            ))
+            start = end
+    db.commit()
+
+
+def export_partition(db: Session, name: str, directory: str) -> str:
+    """Write a detached partition to a parquet file."""
+    # imported here so only the process that exports loads pyarrow, it is a
+    # requirement and a missing one fails the export before anything is dropped
+    import pyarrow
+    import pyarrow.parquet
+    os.makedirs(directory, exist_ok=True)
+    connection = db.connection().connection
+    path = os.path.join(directory, f"{name}.parquet")
+    cursor = connection.cursor(name=f"export_{name}")
+    cursor.execute(f"select * from {name}")
+    writer = None
+    try:
+        while True:
+            rows = cursor.fetchmany(settings.TRADE_EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            columns = [desc[0] for desc in cursor.description]
+            batch = {
+                column: [str(value) if isinstance(value, uuid.UUID) else value for value in values]
+                for column, values in zip(columns, zip(*rows))
+            }
+            table = pyarrow.table(batch)
+            if writer is None:
+                writer = pyarrow.parquet.ParquetWriter(path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        cursor.close()
+        if writer is not None:
+            writer.close()
+    return path
+
+
+def detach_expired(db: Session, retention: int, directory: str):
+    # partitions entirely older than the retention are detached, exported
+    # and dropped, a failed export leaves the detached table in place
+    cutoff = get_month(datetime.utcnow(), -retention)
+    for table in PARTITIONED_TABLES:
+        for row in get_partitions(db=db, table=table):
+            if row.upper_bound > cutoff:
+                continue
+            db.execute(text(f"alter table {table} detach partition {row.name}"))
+            db.commit()
+            path = export_partition(db=db, name=row.name, directory=directory)
+            db.execute(text(f"drop table {row.name}"))
+            db.commit()
+            print(f"partition {row.name} exported to {path}")
+
+
+@jobs.every(settings.TRADE_PARTITION_INTERVAL)
+def maintain_partitions():
+    db = database.SessionLocal()
+    try:
+        create_partitions(db=db, ahead=settings.TRADE_PARTITIONS_AHEAD)
+        detach_expired(
+            db=db,
+            retention=settings.TRADE_RETENTION_MONTHS,
+            directory=settings.TRADE_EXPORT_DIR,
+        )
+    finally:
+        db.close()
@@ -0,0 +1,190 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from fastapi import Request
+from sqlalchemy import event
+from orm import database
+import heapq
+import threading
+import time
+import settings
+
+
+class Profile:
+    """Statements a request or an engine stage sent to the database.
+
+    Statements are counted on the innermost profile and every profile it
+    is nested in, so a stage inside a request still adds to the request.
+    """
+    __slots__ = ["name", "parent", "statements", "db_time", "slowest"]
+
+    def __init__(self, name: str, parent: "Profile" = None) -> None:
+        self.name = name
+        self.parent = parent
+        self.statements = 0
+        self.db_time = 0.0
+        # min heap of (duration, statement)
+        self.slowest = []
+
+    def record(self, statement: str, duration: float):
+        profile = self
+        while profile is not None:
+            profile.statements += 1
+            profile.db_time += duration
+            _keep_slowest(profile.slowest, (duration, statement))
+            profile = profile.parent
+
+
+class Stats:
+    __slots__ = ["calls", "statements", "max_statements", "db_time", "max_db_time",
+                 "over_budget", "slowest"]
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.statements = 0
+        self.max_statements = 0
+        self.db_time = 0.0
+        self.max_db_time = 0.0
+        self.over_budget = 0
+        self.slowest = []
+
+    def add(self, profile: Profile, over_budget: bool):
+        self.calls += 1
+        self.statements += profile.statements
+        self.max_statements = max(self.max_statements, profile.statements)
+        self.db_time += profile.db_time
+        self.max_db_time = max(self.max_db_time, profile.db_time)
+        self.over_budget += over_budget
+        for item in profile.slowest:
+            _keep_slowest(self.slowest, item)
+
+    def to_dict(self, name: str) -> dict:
+        return {
+            "name": name,
+            "calls": self.calls,
+            "statements": self.statements,
+            "avg_statements": self.statements / self.calls,
+            "max_statements": self.max_statements,
+            "db_time": self.db_time,
+            "avg_db_time": self.db_time / self.calls,
+            "max_db_time": self.max_db_time,
+            "over_budget": self.over_budget,
+            "slowest": [
+                {"duration": duration, "statement": statement}
+                for duration, statement in sorted(self.slowest, reverse=True)
+            ],
+        }
+
+
+_current = ContextVar("profile", default=None)
+_stats = {}
+_lock = threading.Lock()
+_route_names = {}
+_started = False
+
+
+def _keep_slowest(slowest: list, item: tuple):
+    if len(slowest) < settings.PROFILER_SLOWEST:
+        heapq.heappush(slowest, item)
+    elif item[0] > slowest[0][0]:
+        heapq.heapreplace(slowest, item)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["query_start"].pop()
+    profile = _current.get()
+    if profile is not None:
+        profile.record(statement, time.perf_counter() - started)
+
+
+def _handle_error(context):
+    # a failed statement never reaches after_cursor_execute
+    starts = context.connection.info.get("query_start") if context.connection else None
+    if starts:
+        starts.pop()
+
+
+def _finish(profile: Profile):
+    over_budget = profile.statements > settings.PROFILER_STATEMENT_BUDGET or \
+        profile.db_time > settings.PROFILER_TIME_BUDGET
+    with _lock:
+        stats = _stats.get(profile.name)
+        if stats is None:
+            stats = _stats[profile.name] = Stats()
+        stats.add(profile, over_budget)
+    if over_budget:
+        slowest = max(profile.slowest, default=(0.0, ""))
+        print(
+            f"{profile.name} over the db budget: {profile.statements} statements "
+            f"in {profile.db_time:.4f} s, slowest {slowest[0]:.4f} s: {slowest[1][:200]}")
+
+
+@contextmanager
+def profile(name: str):
+    """Profile the statements of a block, for work outside of requests."""
+    if not _started:
+        yield None
+        return
+    current = Profile(name=name, parent=_current.get())
+    token = _current.set(current)
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        _finish(current)
+
+
+def _get_route_name(request: Request) -> str:
+    # the router leaves the matched endpoint in the scope, route templates
+    # keep the stats to one entry per route instead of one per path
+    endpoint = request.scope.get("endpoint")
+    if endpoint is None:
+        return f"{request.method} unmatched"
+    if endpoint not in _route_names:
+        path = next(
+            (route.path for route in request.app.routes
+             if getattr(route, "endpoint", None) is endpoint),
+            endpoint.__name__,
+        )
+        _route_names[endpoint] = path
+    return f"{request.method} {_route_names[endpoint]}"
+
+
+async def middleware(request: Request, call_next):
+    if not _started:
+        return await call_next(request)
+    current = Profile(name="")
+    token = _current.set(current)
+    try:
+        response = await call_next(request)
+    finally:
+        _current.reset(token)
+        current.name = _get_route_name(request)
+        _finish(current)
+    response.headers["X-DB-Statements"] = str(current.statements)
+    return response
+
+
+def get_stats() -> list:
+    with _lock:
+        stats = [stats.to_dict(name) for name, stats in _stats.items()]
+    return sorted(stats, key=lambda item: item['db_time'], reverse=True)
+
+
+def reset():
+    with _lock:
+        _stats.clear()
+
+
+def start():
+    global _started
+    if _started or not settings.PROFILER_ENABLED:
+        return
+    for engine in [database.engine] + database.replica_engines:
+        event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+        event.listen(engine, "handle_error", _handle_error)
+    _started = True
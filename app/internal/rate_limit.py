@@ -0,0 +1,130 @@
+from fastapi import HTTPException, Request
+from kafka import lag
+from internal import enums
+import collections
+import importlib
+import threading
+import time
+import settings
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def consume(self, cost: float = 1.0) -> bool:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class MemoryBackend:
+    # per process buckets, a shared backend only has to provide consume()
+    def __init__(self) -> None:
+        self.buckets = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def consume(self, key: str, rate: float, capacity: float, cost: float = 1.0) -> bool:
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                # the least recently used buckets go first, they are the ones
+                # most likely refilled already so dropping them loses nothing
+                while len(self.buckets) >= settings.RATE_LIMIT_MAX_KEYS:
+                    self.buckets.popitem(last=False)
+                bucket = TokenBucket(rate=rate, capacity=capacity)
+                self.buckets[key] = bucket
+            else:
+                self.buckets.move_to_end(key)
+            return bucket.consume(cost)
+
+
+_backend = None
+_engine_lag = 0
+_lag_thread = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        module_name, class_name = settings.RATE_LIMIT_BACKEND.rsplit('.', 1)
+        _backend = getattr(importlib.import_module(module_name), class_name)()
+    return _backend
+
+
+def check(budget: str, *keys):
+    rate, capacity = settings.RATE_LIMITS[budget]
+    backend = get_backend()
+    for key in keys:
+        if not key:
+            continue
+        if not backend.consume(key=f"{budget}:{key}", rate=rate, capacity=capacity):
+            raise HTTPException(429, f"too many {budget.lower()} requests")
+
+
+def get_caller(request: Request) -> str:
+    # the wallet header is not verified here, changing it would give a
+    # fresh bucket, so callers are told apart by their address (uvicorn
+    # takes it from X-Forwarded-For of the FORWARDED_ALLOW_IPS proxies)
+    return request.client.host if request.client else ""
+
+
+def get_budget(request: Request) -> str:
+    if request.method == "GET":
+        return enums.RateLimitBudget.read.value
+    if request.method == "DELETE":
+        return enums.RateLimitBudget.cancel.value
+    return enums.RateLimitBudget.place.value
+
+
+def charge(request: Request, account_id=None, wallet: str = None):
+    """Charge one request to the budget of its method, per account and caller.
+
+    The caller is the wallet once the route has verified it may act on the
+    account, the client address otherwise.
+    """
+    check(get_budget(request), account_id, wallet or get_caller(request))
+
+
+def limit(request: Request):
+    # writes without the account in the path charge themselves once they
+    # know the account and the caller is allowed to act on it
+    account_id = request.path_params.get('account_id')
+    if account_id is None and request.method != "GET":
+        return
+    charge(request, account_id)
+
+
+def check_engine_lag():
+    if _engine_lag > settings.ENGINE_MAX_LAG:
+        raise HTTPException(429, "matching engine is overloaded, try again later")
+
+
+def _monitor_engine_lag():
+    global _engine_lag
+    while True:
+        try:
+            _engine_lag = lag.get_consumer_lag(
+                group_id=settings.ENGINE_GROUP_ID,
+                topic=enums.QueueName.match_engine.value,
+            )
+        except Exception as e:
+            print(f"engine lag check failed: {e}")
+        time.sleep(settings.ENGINE_LAG_INTERVAL)
+
+
+def start():
+    global _lag_thread
+    if _lag_thread is None:
+        _lag_thread = threading.Thread(
+            target=_monitor_engine_lag, name="engine-lag", daemon=True)
+        _lag_thread.start()
+    return _lag_thread
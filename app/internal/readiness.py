@@ -0,0 +1,68 @@
+from sqlalchemy.sql import text
+from orm import database
+from kafka import producer
+import os
+import signal
+import threading
+import time
+import settings
+
+status = {
+    "database": False,
+    "kafka": False,
+}
+_thread = None
+
+
+def check_database() -> bool:
+    with database.engine.connect() as connection:
+        connection.execute(text("select 1"))
+    return True
+
+
+def check_kafka() -> bool:
+    producer.get_producer().list_topics(timeout=settings.READINESS_TIMEOUT)
+    return True
+
+
+def is_ready() -> bool:
+    return all(status.values())
+
+
+def wait_until_ready(retries: int = None, delay: float = 0.0) -> bool:
+    # retries of 0 keeps checking until the dependencies come up, a worker
+    # that runs out of retries terminates so its supervisor restarts it
+    # instead of leaving it up and not ready for good
+    retries = settings.READINESS_RETRIES if retries is None else retries
+    delay = delay or settings.READINESS_DELAY
+    checks = {
+        "database": check_database,
+        "kafka": check_kafka,
+    }
+    attempt = 0
+    while not retries or attempt < retries:
+        for name, check in checks.items():
+            if status[name]:
+                continue
+            try:
+                status[name] = check()
+            except Exception as e:
+                print(f"{name} is not ready (attempt {attempt + 1}): {e}")
+        if is_ready():
+            return True
+        time.sleep(min(delay * 2 ** min(attempt, 32), settings.READINESS_MAX_DELAY))
+        attempt += 1
+    print(f"not ready after {retries} attempts, terminating: {status}")
+    os.kill(os.getpid(), signal.SIGTERM)
+    return False
+
+
+def start():
+    # readiness is checked off the event loop so the worker accepts
+    # connections immediately and reports not ready until checks pass
+    global _thread
+    if _thread is None:
+        _thread = threading.Thread(
+            target=wait_until_ready, name="readiness", daemon=True)
+        _thread.start()
+    return _thread
@@ -1,7 +1,6 @@
 from kafka import client as kafka_client
 from datetime import datetime
 from decimal import Decimal
-import requests
 import uuid
 import pydantic
 from orm import database, models
@@ -113,6 +112,17 @@ class ContractOut(Contract):
     status: enums.ContractStatus
     margin_pool: Decimal
     open_interest: Decimal
+    funding_rate: Decimal = Decimal('0.0')
+
+
+class ContractStatsOut(PydanticBaseModel):
+    symbol: str
+    open_interest: Decimal
+    margin_pool: Decimal
+
+
+class FundingRateIn(pydantic.BaseModel):
+    funding_rate: pydantic.condecimal(gt=Decimal('-0.01'), lt=Decimal('0.01'))
 
 
 class ContractIn(Contract):
@@ -269,6 +279,9 @@ class Network(PydanticBaseModel):
     address: pydantic.types.constr(min_length=20, max_length=50)
     last_updated_block: pydantic.conint(gt=0)
     confirmations: pydantic.conint(gt=0)
+    max_concurrency: pydantic.conint(gt=0) = None
+    request_timeout: pydantic.conint(gt=0) = None
+    rate_limit: pydantic.conint(gt=0) = None
 
     class Config:
         orm_mode = True
@@ -342,6 +355,29 @@ class PositionOut(Position):
     pass
 
 
+class PositionRiskOut(PydanticBaseModel):
+    id: pydantic.types.UUID4
+    account_id: pydantic.types.UUID4
+    symbol: pydantic.constr(max_length=20)
+    side: pydantic.constr(max_length=20)
+    quantity: float
+    entry_price: float
+    margin: float
+    mark_price: float
+    unrealized_pnl: float
+    equity: float
+    margin_ratio: float
+
+
+class AccountSnapshotOut(pydantic.BaseModel):
+    account_id: pydantic.types.UUID4
+    version: int
+    timestamp: int
+    balances: list[BalanceOut]
+    positions: list[PositionOut]
+    orders: list["OrderOut"]
+
+
 class Order(PydanticBaseModel):
     account_id: pydantic.types.UUID4
     symbol: pydantic.constr(max_length=20)
@@ -364,6 +400,9 @@ class OrderOut(Order):
     leverage: int
 
 
+AccountSnapshotOut.update_forward_refs(OrderOut=OrderOut)
+
+
 class OrderIn(Order):
     @pydantic.root_validator()
     def order_validation(cls, values):
@@ -470,6 +509,18 @@ class OrderBookOut(PydanticBaseModel):
     price: pydantic.condecimal(ge=Decimal('0.0')) = Decimal("0")
 
 
+class OrderBookLevelOut(pydantic.BaseModel):
+    price: Decimal
+    quantity: Decimal
+
+
+class OrderBookSnapshotOut(pydantic.BaseModel):
+    symbol: str
+    sequence: int
+    bids: list[OrderBookLevelOut]
+    asks: list[OrderBookLevelOut]
+
+
 class OrderCancel(PydanticBaseModel):
     id: pydantic.types.UUID4
     symbol: str
@@ -525,3 +576,35 @@ class PublicTrade(PydanticBaseModel):
     quantity: pydantic.condecimal(ge=Decimal('0.0'))
     # quote_quantity: pydantic.condecimal(gt=Decimal('0.0'))
     symbol: str = None
+    insert_time: datetime = None
+
+
+class CandleOut(pydantic.BaseModel):
+    open_time: datetime
+    open: Decimal
+    high: Decimal
+    low: Decimal
+    close: Decimal
+    volume: Decimal
+    quote_volume: Decimal
+    trades: int
+
+
+class TickerOut(PydanticBaseModel):
+    symbol: str
+    last_price: Decimal
+    open_price: Decimal
+    high: Decimal
+    low: Decimal
+    volume: Decimal
+    quote_volume: Decimal
+    trades: int
+    price_change: Decimal
+    price_change_percent: Decimal
+
+
+class TransactionChunk(PydanticBaseModel):
+    network_address: str
+    asset_contract_address: str
+    last_block: int
+    transactions: list[dict]
@@ -0,0 +1,73 @@
+from confluent_kafka import TopicPartition
+from kafka.consumer import consume, tail
+from internal import enums
+import threading
+import queue
+import json
+
+_handlers = {}
+_thread = None
+_commits = queue.Queue()
+
+
+def register(topic: str, handler: callable):
+    _handlers.setdefault(topic, []).append(handler)
+
+
+def dispatch(msg: str, offset: int = None, partition: int = None):
+    event = json.loads(msg)
+    if offset is not None:
+        event['offset'] = offset
+    if partition is not None:
+        event['partition'] = partition
+    # symbol scoped topics are published as "<symbol>:<topic>"
+    topic = event['topic'].split(':')[-1]
+    for handler in _handlers.get(topic, []):
+        try:
+            handler(event)
+        except Exception as e:
+            print(f"stream handler failed for {event['topic']}: {e}")
+
+
+def commit(offsets: dict):
+    """Commit the {partition: offset} of the last handled messages.
+
+    Only for a stream started with manual_commit, the commit itself is
+    made by the stream's thread.
+    """
+    _commits.put([
+        TopicPartition(enums.QueueName.publish.value, partition, offset + 1)
+        for partition, offset in offsets.items()
+    ])
+
+
+def start(group_id: str = "", manual_commit: bool = False):
+    global _thread
+    if _thread is not None:
+        return _thread
+    if group_id:
+        target = consume
+        kwargs = {
+            "callback": dispatch,
+            "topics": [enums.QueueName.publish.value],
+            "group_id": group_id,
+            "offset_reset": "latest",
+            "commits": _commits if manual_commit else None,
+        }
+    else:
+        # api workers only need market data, each tails the public queue
+        # without joining a group so none of them is left behind
+        target = tail
+        kwargs = {
+            "callback": dispatch,
+            "topics": [enums.QueueName.public.value],
+            "client_id": "account-api",
+        }
+    _thread = threading.Thread(
+        target=target,
+        kwargs=kwargs,
+        name="public-stream",
+        daemon=True,
+    )
+    _thread.start()
+    return _thread
@@ -0,0 +1,250 @@
+from datetime import datetime, timedelta
+from decimal import Decimal
+from collections import deque
+from sqlalchemy import select
+from orm import database, models
+from internal import enums, schemas, stream, jobs, candles
+from kafka import producer
+import threading
+import bisect
+import time
+import settings
+
+_epoch = datetime(1970, 1, 1)
+
+
+def get_minute(time: datetime) -> int:
+    return int((time - _epoch).total_seconds()) // 60
+
+
+class RollingTicker:
+    """24h statistics of one symbol over a ring buffer of minute bars.
+
+    A trade only touches the bar of its minute and the running totals, and
+    moving to a new minute expires the bars that left the window, so both
+    are O(1) amortized. The minutes of the live bars are kept in order and
+    high and low in monotonic deques, so the opening price, high and low
+    are read from the front of them. Only a trade older than the newest
+    bar rebuilds the deques.
+    """
+
+    def __init__(self, symbol: str, size: int) -> None:
+        self.symbol = symbol
+        self.size = size
+        self.bars = [None] * size
+        self.current = None
+        # minutes of the live bars, ascending
+        self.minutes = deque()
+        # (minute, price) with decreasing highs and increasing lows
+        self.highs = deque()
+        self.lows = deque()
+        self.volume = Decimal('0.0')
+        self.quote_volume = Decimal('0.0')
+        self.trades = 0
+        self.last_price = None
+        self.last_time = None
+
+    def _expire(self, slot: int):
+        bar = self.bars[slot]
+        if bar is not None:
+            self.volume -= bar.volume
+            self.quote_volume -= bar.quote_volume
+            self.trades -= bar.trades
+            self.bars[slot] = None
+
+    def _advance(self, minute: int):
+        if self.current is None:
+            self.current = minute
+            return
+        if minute <= self.current:
+            return
+        for expired in range(max(self.current + 1, minute - self.size + 1), minute + 1):
+            self._expire(expired % self.size)
+        self.current = minute
+        oldest = minute - self.size
+        for queue in (self.highs, self.lows):
+            while queue and queue[0][0] <= oldest:
+                queue.popleft()
+        while self.minutes and self.minutes[0] <= oldest:
+            self.minutes.popleft()
+
+    def _get_bar(self, minute: int) -> candles.Bar:
+        self._advance(minute)
+        if minute <= self.current - self.size:
+            # older than the window
+            return None
+        slot = minute % self.size
+        if self.bars[slot] is None:
+            self.bars[slot] = candles.Bar(_epoch + timedelta(minutes=minute))
+            if not self.minutes or minute > self.minutes[-1]:
+                self.minutes.append(minute)
+            else:
+                bisect.insort(self.minutes, minute)
+        return self.bars[slot]
+
+    def _push(self, minute: int, bar: candles.Bar):
+        if (self.highs and self.highs[-1][0] > minute) or \
+                (self.lows and self.lows[-1][0] > minute):
+            # a late trade of an older bar, the deques are rebuilt in order
+            self._rebuild()
+            return
+        while self.highs and self.highs[-1][1] <= bar.high:
+            self.highs.pop()
+        self.highs.append((minute, bar.high))
+        while self.lows and self.lows[-1][1] >= bar.low:
+            self.lows.pop()
+        self.lows.append((minute, bar.low))
+
+    def _rebuild(self):
+        self.highs.clear()
+        self.lows.clear()
+        for minute in self.minutes:
+            self._push(minute, self.bars[minute % self.size])
+
+    def add_trade(self, price: Decimal, quantity: Decimal, time: datetime):
+        minute = get_minute(time)
+        bar = self._get_bar(minute)
+        if bar is None:
+            return
+        bar.add(price, quantity, time)
+        self._push(minute, bar)
+        self.volume += quantity
+        self.quote_volume += price * quantity
+        self.trades += 1
+        if self.last_time is None or time >= self.last_time:
+            self.last_price = price
+            self.last_time = time
+
+    def add_bar(self, bar: candles.Bar):
+        minute = get_minute(bar.open_time)
+        target = self._get_bar(minute)
+        if target is None:
+            return
+        if target.trades:
+            target.merge(bar)
+        else:
+            target = self.bars[minute % self.size] = bar
+        self._push(minute, target)
+        self.volume += bar.volume
+        self.quote_volume += bar.quote_volume
+        self.trades += bar.trades
+        if self.last_time is None or bar.last_trade_time >= self.last_time:
+            self.last_price = bar.close
+            self.last_time = bar.last_trade_time
+
+    def snapshot(self, now: datetime) -> dict:
+        self._advance(get_minute(now))
+        ticker = {
+            "symbol": self.symbol,
+            "last_price": self.last_price or Decimal('0.0'),
+            "open_price": Decimal('0.0'),
+            "high": Decimal('0.0'),
+            "low": Decimal('0.0'),
+            "volume": self.volume,
+            "quote_volume": self.quote_volume,
+            "trades": self.trades,
+            "price_change": Decimal('0.0'),
+            "price_change_percent": Decimal('0.0'),
+        }
+        if not self.highs:
+            return ticker
+        first = self.bars[self.minutes[0] % self.size]
+        ticker.update(
+            open_price=first.open,
+            high=self.highs[0][1],
+            low=self.lows[0][1],
+            price_change=self.last_price - first.open,
+        )
+        if first.open:
+            ticker['price_change_percent'] = round(
+                100 * ticker['price_change'] / first.open, 4)
+        return ticker
+
+
+_tickers = {}
+_lock = threading.Lock()
+# (symbols, loaded_at) of the last contracts query
+_symbols = None
+
+
+def _get_ticker(symbol: str) -> RollingTicker:
+    ticker = _tickers.get(symbol)
+    if ticker is None:
+        ticker = _tickers[symbol] = RollingTicker(
+            symbol=symbol, size=settings.TICKER_WINDOW_MINUTES)
+    return ticker
+
+
+def get_tickers(symbols: list) -> list:
+    now = datetime.utcnow()
+    with _lock:
+        return [_get_ticker(symbol).snapshot(now) for symbol in symbols]
+
+
+def load():
+    # the window starts from the stored one minute candles, the stream
+    # adds everything after
+    since = datetime.utcnow() - timedelta(minutes=settings.TICKER_WINDOW_MINUTES)
+    db = database.SessionLocal()
+    try:
+        rows = db.execute(select(models.Candle).where(
+            models.Candle.interval == enums.CandleInterval.one_minute.value,
+            models.Candle.open_time > since,
+        ).order_by(models.Candle.open_time)).scalars().all()
+    finally:
+        db.close()
+    with _lock:
+        for row in rows:
+            bar = candles.Bar(row.open_time)
+            for field in candles.Bar.__slots__:
+                setattr(bar, field, getattr(row, field))
+            _get_ticker(row.symbol).add_bar(bar)
+
+
+def on_trade_event(event: dict):
+    info = event['event']
+    time = candles.get_trade_time(info)
+    with _lock:
+        _get_ticker(info['symbol']).add_trade(
+            price=Decimal(info['price']),
+            quantity=Decimal(info['quantity']),
+            time=time,
+        )
+
+
+def get_symbols() -> list:
+    # contracts are rarely added, the ticker endpoints and the publisher
+    # share one query per TICKER_SYMBOLS_TTL
+    global _symbols
+    cached = _symbols
+    if cached is not None and time.monotonic() - cached[1] < settings.TICKER_SYMBOLS_TTL:
+        return cached[0]
+    db = database.SessionLocal()
+    try:
+        symbols = db.execute(select(models.Contract.symbol)).scalars().all()
+    finally:
+        db.close()
+    _symbols = (symbols, time.monotonic())
+    return symbols
+
+
+@jobs.every(settings.TICKER_PUBLISH_INTERVAL)
+def publish_tickers():
+    for ticker in get_tickers(get_symbols()):
+        schemas.TickerOut(**ticker).publish(
+            event_type=enums.EventType.ticker.value)
+    producer.flush()
+
+
+def _load_and_follow():
+    try:
+        load()
+    except Exception as e:
+        print(f"ticker window not loaded, starting empty: {e}")
+    stream.register(enums.EeventTopic.trade.value, on_trade_event)
+
+
+def start():
+    # loading a day of candles must not hold up the worker's startup, the
+    # trades are followed once the window is loaded
+    threading.Thread(target=_load_and_follow, name="ticker-load", daemon=True).start()
@@ -1,4 +1,4 @@
-from kafka.producer import KafkaProducer
+from kafka.producer import get_producer
 from internal import enums
 from pydantic import BaseModel
 import time
@@ -50,19 +50,21 @@ def publish(info: BaseModel, event_type: enums.EventType, symbol: str = ""):
             "key": str(info.account_id),
         })
     elif event_type == enums.EventType.trade.value:
-        events.append({
-            "info": info_json,
-            "queue": enums.QueueName.publish.value,
-            "topic": enums.EeventTopic.trade.value,
-            "key": f"{info.symbol}:{enums.EeventTopic.trade.value}",
-        })
+        for queue in [enums.QueueName.publish.value, enums.QueueName.public.value]:
+            events.append({
+                "info": info_json,
+                "queue": queue,
+                "topic": enums.EeventTopic.trade.value,
+                "key": f"{info.symbol}:{enums.EeventTopic.trade.value}",
+            })
     elif event_type == enums.EventType.order_book.value:
-        events.append({
-            "info": info_json,
-            "queue": enums.QueueName.publish.value,
-            "topic": f"{symbol}:{enums.EeventTopic.order_book.value}",
-            "key": f"{symbol}:{enums.EeventTopic.order_book.value}",
-        })
+        for queue in [enums.QueueName.publish.value, enums.QueueName.public.value]:
+            events.append({
+                "info": info_json,
+                "queue": queue,
+                "topic": f"{symbol}:{enums.EeventTopic.order_book.value}",
+                "key": f"{symbol}:{enums.EeventTopic.order_book.value}",
+            })
     elif event_type == enums.EventType.sub_trade.value:
         events.append({
             "info": info_json,
@@ -84,6 +86,34 @@ def publish(info: BaseModel, event_type: enums.EventType, symbol: str = ""):
             "topic": enums.EeventTopic.position.value,
             "key": str(info.account_id),
         })
+    elif event_type == enums.EventType.position_risk.value:
+        events.append({
+            "info": info_json,
+            "queue": enums.QueueName.publish.value,
+            "topic": enums.EeventTopic.position_risk.value,
+            "key": str(info.account_id),
+        })
+    elif event_type == enums.EventType.ticker.value:
+        events.append({
+            "info": info_json,
+            "queue": enums.QueueName.publish.value,
+            "topic": enums.EeventTopic.ticker.value,
+            "key": f"{info.symbol}:{enums.EeventTopic.ticker.value}",
+        })
+    elif event_type == enums.EventType.contract_stats.value:
+        events.append({
+            "info": info_json,
+            "queue": enums.QueueName.publish.value,
+            "topic": enums.EeventTopic.contract_stats.value,
+            "key": f"{info.symbol}:{enums.EeventTopic.contract_stats.value}",
+        })
+    elif event_type == enums.EventType.transactions.value:
+        events.append({
+            "info": info_json,
+            "queue": enums.QueueName.blockchain.value,
+            "topic": enums.EeventTopic.transactions.value,
+            "key": info.network_address,
+        })
 
     for event in events:
         _produce(**event)
@@ -108,4 +138,7 @@ def _produce(info: dict, topic: str, key: str = "", queue: str = ""):
     #         'event': info,
     #     }
     #     app.send_task("tasks.publish_event", args=[event], queue=queue)
-    KafkaProducer.produce(queue, key=key, value=msg, callback=delivery_report)
+    producer = get_producer()
+    producer.produce(queue, key=key, value=msg, callback=delivery_report)
+    # serve delivery callbacks so the local queue never fills up
+    producer.poll(0)
@@ -1,26 +1,43 @@
-from confluent_kafka import Consumer
+from confluent_kafka import Consumer, TopicPartition, OFFSET_END
 from internal import enums
+import queue
+import zlib
+import time
 import settings
 
+_tail = None
 
-def consume(callback: callable):
+
+def consume(callback: callable, topics: list = None, group_id: str = 'match-engine', offset_reset: str = 'earliest', on_idle: callable = None, commits: queue.Queue = None):
+    # with a commits queue offsets are only committed when put on it, the
+    # callback then also gets the offset and partition of every message
     c = Consumer({
         'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
-        'group.id': 'match-engine',
-        'auto.offset.reset': 'earliest',
+        'group.id': group_id,
+        'auto.offset.reset': offset_reset,
+        'enable.auto.commit': commits is None,
     })
-    topics = [enums.QueueName.match_engine.value]
+    if topics is None:
+        topics = [enums.QueueName.match_engine.value]
     c.subscribe(topics)
     print(f"consumer subscribed: {topics}")
 
     try:
         while True:
+            while commits is not None and not commits.empty():
+                c.commit(offsets=commits.get(), asynchronous=False)
             msg = c.poll(1.0)
             if msg is None:
+                # lets the caller finish deferred work while the queue is quiet
+                if on_idle is not None:
+                    on_idle()
                 continue
             if msg.error():
                 print("Consumer error: {}".format(msg.error()))
                 continue
+            if commits is not None:
+                callback(msg.value().decode('utf-8'), msg.offset(), msg.partition())
+                continue
             msg = msg.value().decode('utf-8')
             callback(msg)
             # try:
@@ -29,3 +46,68 @@ def consume(callback: callable):
             #     print(e)
     except Exception as e:
         c.close()
+
+
+def tail(callback: callable, topics: list, client_id: str):
+    """Consume every partition of topics from its end, without a consumer group.
+
+    Partitions are assigned instead of subscribed and no offsets are
+    committed, so any number of processes can tail the same topics and none
+    leaves a group behind. callback gets the message and its offset.
+    """
+    global _tail
+    c = Consumer({
+        'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
+        # required by the client, never joined or committed to
+        'group.id': client_id,
+        'client.id': client_id,
+        'enable.auto.commit': False,
+        'auto.offset.reset': 'latest',
+    })
+    partitions = []
+    while not partitions:
+        for topic in topics:
+            metadata = c.list_topics(topic, timeout=10)
+            partitions += [
+                TopicPartition(topic, partition, OFFSET_END)
+                for partition in metadata.topics[topic].partitions
+            ]
+        if not partitions:
+            time.sleep(1.0)
+    c.assign(partitions)
+    _tail = c
+    print(f"consumer assigned: {topics}")
+
+    try:
+        while True:
+            msg = c.poll(1.0)
+            if msg is None:
+                continue
+            if msg.error():
+                print("Consumer error: {}".format(msg.error()))
+                continue
+            callback(msg.value().decode('utf-8'), msg.offset())
+    except Exception as e:
+        c.close()
+
+
+def get_high_watermark(topic: str, key: str, timeout: float = 2.0) -> int:
+    """Offset the next message of key on topic will get, None when unknown.
+
+    The producer's consistent partitioner puts a key on the partition of its
+    CRC32, the same is computed here to find it.
+    """
+    if _tail is None:
+        return None
+    try:
+        metadata = _tail.list_topics(topic, timeout=timeout)
+        partitions = sorted(metadata.topics[topic].partitions)
+        if not partitions:
+            return None
+        partition = zlib.crc32(key.encode('utf8')) % len(partitions)
+        low, high = _tail.get_watermark_offsets(
+            TopicPartition(topic, partition), timeout=timeout, cached=False)
+    except Exception as e:
+        print(f"watermark of {key} on {topic} failed: {e}")
+        return None
+    return high
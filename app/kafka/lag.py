@@ -0,0 +1,29 @@
+from confluent_kafka import Consumer, TopicPartition
+import settings
+
+_consumer = None
+
+
+def _get_consumer(group_id: str) -> Consumer:
+    global _consumer
+    if _consumer is None:
+        _consumer = Consumer({
+            'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
+            'group.id': group_id,
+            'enable.auto.commit': False,
+        })
+    return _consumer
+
+
+def get_consumer_lag(group_id: str, topic: str, timeout: float = 2.0) -> int:
+    consumer = _get_consumer(group_id)
+    metadata = consumer.list_topics(topic, timeout=timeout)
+    partitions = [
+        TopicPartition(topic, partition) for partition in metadata.topics[topic].partitions
+    ]
+    lag = 0
+    for partition in consumer.committed(partitions, timeout=timeout):
+        low, high = consumer.get_watermark_offsets(partition, timeout=timeout)
+        offset = partition.offset if partition.offset >= 0 else low
+        lag += max(high - offset, 0)
+    return lag
@@ -1,10 +1,40 @@
 from confluent_kafka import Producer
+import threading
+import os
 import settings
 
 config = {
     'bootstrap.servers': settings.KAFKA_BOOTSTRAP_SERVERS,
+    # keys always land on the partition of their CRC32, consumers rely on it
+    # to find the partition of a key
+    'partitioner': 'consistent_random',
 }
-KafkaProducer = Producer(config)
+_producer = None
+_producer_lock = threading.Lock()
+
+
+def get_producer() -> Producer:
+    # created on first use so importing this module never touches kafka
+    global _producer
+    if _producer is None:
+        with _producer_lock:
+            if _producer is None:
+                _producer = Producer(config)
+    return _producer
+
+
+def flush(timeout: float = 5.0):
+    if _producer is not None:
+        _producer.flush(timeout)
+
+
+def _reset():
+    # librdkafka threads do not survive fork, workers build their own
+    global _producer
+    _producer = None
+
+
+os.register_at_fork(after_in_child=_reset)
 
 
 # def delivery_report(err, msg):
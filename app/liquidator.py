@@ -0,0 +1,7 @@
+from internal import jobs, stream, liquidation
+
+
+if __name__ == "__main__":
+    liquidation.start()
+    stream.start(group_id="liquidator")
+    jobs.run_forever()
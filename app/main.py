@@ -1,11 +1,12 @@
-from fastapi import FastAPI
-from orm.database import engine, Base
-from routers import wallets, networks, balances, accounts, orders, trades, tokens, assets, contracts, brokers, positions
+from fastapi import FastAPI, HTTPException, Request, Depends
+from fastapi.responses import JSONResponse
+from routers import wallets, networks, balances, accounts, orders, trades, tokens, assets, contracts, brokers, positions, snapshots, klines, tickers
+from internal import stream, order_book, readiness, rate_limit, mark_to_market, candles, ticker, profiler, admin, middleware
+from kafka import producer
+from orm import models, database
 import uvicorn
 import settings
 
-Base.metadata.create_all(bind=engine)
-
 app = FastAPI()
 app.include_router(networks.router)
 app.include_router(wallets.router)
@@ -18,6 +19,42 @@ app.include_router(assets.router)
 app.include_router(contracts.router)
 app.include_router(brokers.router)
 app.include_router(positions.router)
+app.include_router(snapshots.router)
+app.include_router(klines.router)
+app.include_router(tickers.router)
+app.include_router(
+    admin.router,
+    prefix="/admin",
+    tags=["admin"],
+    dependencies=[Depends(middleware.verify_admin)],
+)
+app.middleware("http")(profiler.middleware)
+app.middleware("http")(database.mark_writes)
+
+
+@app.exception_handler(models.ConcurrentUpdateError)
+async def concurrent_update_handler(request: Request, exc: models.ConcurrentUpdateError):
+    # optimistic updates ran out of retries, the client may simply retry
+    return JSONResponse(status_code=409, content={"detail": str(exc)})
+
+
+@app.on_event("startup")
+def startup():
+    # the schema is created by migrate.py, connections are opened lazily
+    profiler.start()
+    database.start_replica_monitor()
+    readiness.start()
+    order_book.start()
+    mark_to_market.start()
+    candles.start()
+    ticker.start()
+    stream.start()
+    rate_limit.start()
+
+
+@app.on_event("shutdown")
+def shutdown():
+    producer.flush()
 
 
 @app.get("/")
@@ -25,5 +62,12 @@ async def root():
     return {"message": "API service is running."}
 
 
+@app.get("/ready")
+async def ready():
+    if not readiness.is_ready():
+        raise HTTPException(503, readiness.status)
+    return readiness.status
+
+
 if __name__ == "__main__":
     uvicorn.run("main:app", host="0.0.0.0", port=settings.SERVICE_PORT)
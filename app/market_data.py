@@ -0,0 +1,10 @@
+from internal import jobs, stream, candles, ticker
+
+
+if __name__ == "__main__":
+    candles.start(flush=True)
+    ticker.start()
+    # offsets are committed by the candle flush, trades not flushed yet
+    # are delivered again after a restart
+    stream.start(group_id="market-data", manual_commit=True)
+    jobs.run_forever()
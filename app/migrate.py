@@ -0,0 +1,102 @@
+from sqlalchemy.sql import text
+from orm.database import engine, Base, SessionLocal
+from orm import models
+from internal import partitions
+import settings
+import time
+
+# tables that existed before they were partitioned are renamed out of the
+# way before create_all creates the partitioned table
+legacy_statements = [
+    """
+    do $$
+    begin
+        if exists (select from pg_class where relname = '{table}' and relkind = 'r') then
+            alter table {table} rename constraint {table}_pkey to {table}_legacy_pkey;
+            alter table {table} rename to {table}_legacy;
+        end if;
+    end $$
+    """.format(table=table)
+    for table in partitions.PARTITIONED_TABLES
+]
+
+# create_all only creates missing tables, columns added to existing tables
+# are listed here and must be safe to run more than once
+statements = [
+    "alter table contracts add column if not exists funding_rate numeric default 0",
+    "alter table contracts alter column margin_pool type numeric",
+    "alter table contracts alter column open_interest type numeric",
+    "alter table networks add column if not exists max_concurrency integer",
+    "alter table networks add column if not exists request_timeout integer",
+    "alter table networks add column if not exists rate_limit integer",
+    "alter table assets add column if not exists last_updated_block integer",
+    "alter table exchangeincomes add column if not exists broker_id uuid",
+    "alter table exchangeincomes add column if not exists referrer_wallet varchar",
+    "alter table exchangeincomes add column if not exists paid boolean default false",
+    "create index if not exists ix_exchangeincomes_unpaid on exchangeincomes (id) where not paid",
+    "alter table balances add column if not exists journal_version bigint default 0",
+    "alter table balancejournal add column if not exists version bigint",
+    "drop index if exists ix_balancejournal_account_asset_seq",
+    "create unique index if not exists _balancejournal_account_asset_version_uc on balancejournal (account_id, asset, version)",
+    "alter table positions add column if not exists version integer not null default 1",
+    "alter table positions add column if not exists opened_at timestamp",
+    "alter table fundingpayments add column if not exists shortfall numeric default 0",
+    "create unique index if not exists _balance_account_asset_uc on balances (account_id, asset)",
+    "alter table trades drop constraint if exists trades_maker_order_id_fkey",
+    "alter table trades drop constraint if exists trades_taker_order_id_fkey",
+    "create or replace view all_orders as select {columns} from orders union all select {columns} from orders_archive".format(
+        columns=", ".join(column.name for column in models.Order.__table__.columns)),
+    "alter table exchangeincomes drop constraint if exists exchangeincomes_subtrade_id_fkey",
+    # the renamed tables become the partition of everything before next month
+    """
+    do $$
+    begin
+        if to_regclass('trades_legacy') is not null
+        and not (select relispartition from pg_class where oid = 'trades_legacy'::regclass) then
+            alter table trades_legacy drop constraint if exists trades_maker_order_id_fkey;
+            alter table trades_legacy drop constraint if exists trades_taker_order_id_fkey;
+            alter table trades_legacy drop constraint trades_legacy_pkey cascade;
+            alter table subtrades_legacy drop constraint subtrades_legacy_pkey cascade;
+            alter table subtrades_legacy add column if not exists insert_time timestamp;
+            update trades_legacy set insert_time = now() where insert_time is null;
+            update subtrades_legacy set insert_time = trades_legacy.insert_time
+            from trades_legacy where trades_legacy.id = subtrades_legacy.trade_id;
+            update subtrades_legacy set insert_time = now() where insert_time is null;
+            alter table trades_legacy add primary key (id, insert_time);
+            alter table subtrades_legacy add primary key (id, insert_time);
+            alter table trades attach partition trades_legacy
+            for values from (minvalue) to (date_trunc('month', now()) + interval '1 month');
+            alter table subtrades attach partition subtrades_legacy
+            for values from (minvalue) to (date_trunc('month', now()) + interval '1 month');
+        end if;
+    end $$
+    """,
+]
+
+
+def create_schema(retries: int = 10, delay: float = 1.0):
+    for attempt in range(retries):
+        try:
+            with engine.begin() as connection:
+                for statement in legacy_statements:
+                    connection.execute(text(statement))
+            Base.metadata.create_all(bind=engine)
+            with engine.begin() as connection:
+                for statement in statements:
+                    connection.execute(text(statement))
+            db = SessionLocal()
+            try:
+                partitions.create_partitions(
+                    db=db, ahead=settings.TRADE_PARTITIONS_AHEAD)
+            finally:
+                db.close()
+            print("schema is up to date")
+            return
+        except Exception as e:
+            print(f"schema creation failed (attempt {attempt + 1}): {e}")
+            time.sleep(delay)
+    raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    create_schema()
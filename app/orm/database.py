@@ -1,6 +1,12 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm import sessionmaker, Session
+from starlette.requests import Request
+import collections
+import itertools
+import threading
+import os
+import time
 import settings
 
 
@@ -14,13 +20,134 @@ SQLALCHEMY_DATABASE_URL = "postgresql://{}:{}@{}:{}/{}".format(
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
 )
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+LAST_WRITE_HEADER = "X-Last-Write"
+LAST_WRITE_COOKIE = "last_write"
+replica_engines = [create_engine(url) for url in settings.DB_REPLICA_URLS]
+_replicas = itertools.cycle(replica_engines)
+# (time, lsn) samples of the primary's current wal position, oldest first
+_primary_lsns = collections.deque()
+# replica engine -> time of the newest primary sample it has replayed
+_caught_up_at = {}
+_monitor = None
+
+
+def _dispose_engines():
+    # pooled connections must never be shared with a forked worker, the
+    # child only drops its copies, closing them would end the parent's
+    # sessions on the server
+    engine.dispose(close=False)
+    for replica in replica_engines:
+        replica.dispose(close=False)
+
+
+os.register_at_fork(after_in_child=_dispose_engines)
+
+
+class RoutingSession(Session):
+    def get_bind(self, mapper=None, clause=None, **kw):
+        # flushes come without a clause, they and any DML go to the primary
+        replica = self.info.get('replica')
+        if replica is not None and clause is not None and not getattr(clause, 'is_dml', False):
+            return replica
+        return super().get_bind(mapper=mapper, clause=clause, **kw)
+
+
+SessionLocal = sessionmaker(
+    autocommit=False, autoflush=False, bind=engine, class_=RoutingSession)
 
 Base = declarative_base()
 
 
-def get_db():
+def _parse_lsn(value: str) -> int:
+    high, low = value.split('/')
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def poll_replicas():
+    """Record how far every replica has replayed the primary's wal.
+
+    A replica whose replay position reached a primary sample has every
+    commit made before that sample, from any process.
+    """
+    now = time.time()
+    with engine.connect() as conn:
+        primary = conn.execute(text("select pg_current_wal_lsn()::text")).scalar()
+    _primary_lsns.append((now, _parse_lsn(primary)))
+    while _primary_lsns and _primary_lsns[0][0] < now - 2 * settings.DB_REPLICA_MAX_LAG:
+        _primary_lsns.popleft()
+    for replica in replica_engines:
+        try:
+            with replica.connect() as conn:
+                replayed = conn.execute(text("select pg_last_wal_replay_lsn()::text")).scalar()
+        except Exception as e:
+            print(f"replica {replica.url.host} unavailable: {e}")
+            _caught_up_at[replica] = 0.0
+            continue
+        if replayed is None:
+            # not in recovery, reads see everything
+            _caught_up_at[replica] = now
+            continue
+        replayed = _parse_lsn(replayed)
+        _caught_up_at[replica] = max(
+            [sampled_at for sampled_at, lsn in _primary_lsns if lsn <= replayed],
+            default=_caught_up_at.get(replica, 0.0),
+        )
+
+
+def _monitor_replicas():
+    while True:
+        try:
+            poll_replicas()
+        except Exception as e:
+            print(f"replica monitor failed: {e}")
+        time.sleep(settings.DB_REPLICA_POLL_INTERVAL)
+
+
+def start_replica_monitor():
+    global _monitor
+    if _monitor is not None or not replica_engines:
+        return
+    _monitor = threading.Thread(
+        target=_monitor_replicas, name="replica-monitor", daemon=True)
+    _monitor.start()
+
+
+def get_replica(since: float):
+    """A replica that has every commit made before since, or None."""
+    fresh = [replica for replica in replica_engines if _caught_up_at.get(replica, 0.0) >= since]
+    if not fresh:
+        return None
+    for replica in _replicas:
+        if replica in fresh:
+            return replica
+
+
+def get_last_write(request: Request) -> float:
+    # clients send back the time of their last write, or of the newest event
+    # they received, in milliseconds so a read never goes behind it
+    value = request.headers.get(LAST_WRITE_HEADER) or request.cookies.get(LAST_WRITE_COOKIE)
+    try:
+        return int(value) / 1000
+    except (TypeError, ValueError):
+        return 0.0
+
+
+async def mark_writes(request: Request, call_next):
+    response = await call_next(request)
+    if request.method != "GET" and response.status_code < 400:
+        response.set_cookie(LAST_WRITE_COOKIE, str(int(1000 * time.time())), httponly=True)
+    return response
+
+
+def get_db(request: Request = None):
     db = SessionLocal()
+    # reads go to a replica that has replayed everything up to the client's
+    # last write, and is at most DB_REPLICA_MAX_LAG behind anyway
+    if replica_engines and request is not None and request.method == "GET":
+        since = max(get_last_write(request), time.time() - settings.DB_REPLICA_MAX_LAG)
+        replica = get_replica(since)
+        if replica is not None:
+            db.info['replica'] = replica
     try:
         yield db
     finally:
@@ -1,13 +1,22 @@
-from sqlalchemy import DECIMAL, INTEGER, Boolean, Column, ForeignKey, String, UniqueConstraint, TIMESTAMP, Integer
+from sqlalchemy import DECIMAL, INTEGER, Boolean, Column, ForeignKey, String, UniqueConstraint, TIMESTAMP, Date, Integer, Index, BigInteger, event, insert, select, update, values, MetaData, Table
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.dialects.postgresql import UUID
-from sqlalchemy.orm import relationship, Session, exc
-from sqlalchemy.sql import func, text
+from sqlalchemy.orm import relationship, raiseload, Session, exc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.engine import Result
+from sqlalchemy.sql import func, text, case
 from decimal import Decimal
 import uuid
 import math
+import bisect
+import collections
+import datetime
+import time
+import psycopg2.extras
 import settings
 from internal import enums, schemas
-from .database import Base
+from .database import Base, RoutingSession
 
 
 class Network(Base):
@@ -24,6 +33,10 @@ class Network(Base):
     block_explorer_url = Column(String)
     last_updated_block = Column(Integer)
     confirmations = Column(Integer)
+    # explorer limits, the EXPLORER_* settings apply when unset
+    max_concurrency = Column(Integer, nullable=True)
+    request_timeout = Column(Integer, nullable=True)
+    rate_limit = Column(Integer, nullable=True)
 
 
 class Asset(Base):
@@ -37,6 +50,17 @@ class Asset(Base):
     digits = Column(Integer, default=18)
     status = Column(String, default=enums.AssetStatus.active.value)
     contract_address = Column(String)
+    # explorer checkpoint of this asset's transfers, scanning starts from
+    # the network's last_updated_block until it is set
+    last_updated_block = Column(Integer)
+
+    @classmethod
+    def advance_block(cls, db: Session, asset_id: uuid.UUID, block: int):
+        """Move the explorer checkpoint forward, never back."""
+        db.query(cls).filter(
+            cls.id == asset_id,
+            (cls.last_updated_block.is_(None)) | (cls.last_updated_block < block),
+        ).update({cls.last_updated_block: block}, synchronize_session=False)
 
 
 class Contract(Base):
@@ -52,8 +76,74 @@ class Contract(Base):
     min_base_quantity = Column(DECIMAL(20, 18))
     min_quote_quantity = Column(DECIMAL(20, 18))
     status = Column(String)
-    margin_pool = Column(DECIMAL(20, 18), default=Decimal('0.0'))
-    open_interest = Column(DECIMAL(20, 18), default=Decimal('0.0'))
+    margin_pool = Column(DECIMAL, default=Decimal('0.0'))
+    open_interest = Column(DECIMAL, default=Decimal('0.0'))
+    funding_rate = Column(DECIMAL, default=Decimal('0.0'))
+
+    @classmethod
+    def add_stats(cls, db: Session, deltas: dict) -> list:
+        """Add open interest and margin pool deltas of many symbols in one UPDATE."""
+        changes = values(
+            Column("symbol", String),
+            Column("open_interest", DECIMAL),
+            Column("margin_pool", DECIMAL),
+            name="changes",
+        ).data([
+            (symbol, delta['open_interest'], delta['margin_pool'])
+            for symbol, delta in sorted(deltas.items())
+        ])
+        statement = update(cls).where(
+            cls.symbol == changes.c.symbol,
+        ).values(
+            open_interest=cls.open_interest + changes.c.open_interest,
+            margin_pool=cls.margin_pool + changes.c.margin_pool,
+        ).returning(cls.symbol, cls.open_interest, cls.margin_pool)
+        return db.execute(statement).all()
+
+    @staticmethod
+    def hold_stats(connection, symbols: list):
+        """Take a shared session lock per symbol while its deltas are not flushed."""
+        connection.execute(text("""
+            select pg_advisory_lock_shared(hashtext('contract_stats:' || symbol))
+            from (select unnest(cast(:symbols as text[])) as symbol order by symbol) as symbols
+        """), {"symbols": sorted(symbols)})
+
+    @staticmethod
+    def release_stats(connection, symbols: list):
+        connection.execute(text("""
+            select pg_advisory_unlock_shared(hashtext('contract_stats:' || symbol))
+            from unnest(cast(:symbols as text[])) as symbol
+        """), {"symbols": sorted(symbols)})
+
+    @staticmethod
+    def lock_stats(db: Session, symbols: list) -> list:
+        """Symbols no process holds unflushed deltas of, locked until the commit."""
+        return db.execute(text("""
+            select symbol
+            from (select unnest(cast(:symbols as text[])) as symbol order by symbol) as symbols
+            where pg_try_advisory_xact_lock(hashtext('contract_stats:' || symbol))
+        """), {"symbols": sorted(symbols)}).scalars().all()
+
+    @classmethod
+    def rebuild_stats(cls, db: Session, symbols: list) -> list:
+        """Set open interest and margin pool of symbols from their positions.
+
+        Both sides of the book hold a position, so the open interest is half
+        of the summed position quantities.
+        """
+        open_interest = select(
+            func.coalesce(func.sum(Position.quantity), 0) / 2
+        ).where(Position.symbol == cls.symbol).scalar_subquery()
+        margin_pool = select(
+            func.coalesce(func.sum(Position.margin), 0)
+        ).where(Position.symbol == cls.symbol).scalar_subquery()
+        statement = update(cls).where(
+            cls.symbol.in_(symbols),
+        ).values(
+            open_interest=open_interest,
+            margin_pool=margin_pool,
+        ).returning(cls.symbol, cls.open_interest, cls.margin_pool)
+        return db.execute(statement).all()
 
 
 class Wallet(Base):
@@ -94,7 +184,44 @@ class Account(Base):
     leverage = Column(INTEGER, default=5)
 
 
+class ConcurrentUpdateError(Exception):
+    pass
+
+
+class MissingBalanceError(Exception):
+    def __init__(self, account_ids: list) -> None:
+        super().__init__(f"no balances for {account_ids}")
+        self.account_ids = account_ids
+
+
+class BalanceState:
+    def __init__(self, account_id: uuid.UUID, asset: str, free: Decimal, locked: Decimal, version: int = 0) -> None:
+        self.account_id = account_id
+        self.asset = asset
+        self.free = free
+        self.locked = locked
+        self.version = version
+
+    @property
+    def key(self) -> tuple:
+        return (str(self.account_id), self.asset)
+
+
 class Balance(Base):
+    """Materialized balances, rolled up from the balance journal.
+
+    Balance changes never update this table on the hot path. They append
+    signed deltas to BalanceJournal, numbering the entries of every
+    (account_id, asset) with consecutive versions. The current balance is
+    the materialized row plus every journal entry after its journal_version,
+    and processes keep the current balances they touched in an in-memory
+    cache that only has to fold in the entries written since.
+
+    In the pessimistic concurrency mode writers hold a transaction scoped
+    advisory lock on the keys they change. In the optimistic mode they
+    don't, and the unique (account_id, asset, version) of the journal makes
+    the second of two writers that read the same version fail and retry.
+    """
     __tablename__ = "balances"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
@@ -103,6 +230,11 @@ class Balance(Base):
     asset = Column(String)
     free = Column(DECIMAL, default=Decimal('0.0'))
     locked = Column(DECIMAL, default=Decimal('0.0'))
+    journal_version = Column(BigInteger, default=0)
+    __table_args__ = (UniqueConstraint(
+        'account_id', 'asset', name='_balance_account_asset_uc'),)
+
+    _cache = {}
 
     @classmethod
     def get_lock_amount(cls, amount):
@@ -113,88 +245,330 @@ class Balance(Base):
         amount /= digit_factor
         return amount
 
+    @classmethod
+    def lock_keys(cls, db: Session, keys: list):
+        # always in the same order so two writers can never deadlock
+        keys = sorted(set(f"{account_id}:{asset}" for account_id, asset in keys))
+        db.execute(text("""
+            select pg_advisory_xact_lock(hashtext(key))
+            from (select unnest(cast(:keys as text[])) as key order by key) as keys
+        """), {"keys": keys})
+
+    @classmethod
+    def get_current(cls, db: Session, account_id: uuid.UUID) -> Result:
+        query = """
+            select
+            balances.account_id,
+            balances.asset,
+            balances.free + coalesce(sum(balancejournal.free), 0) as free,
+            balances.locked + coalesce(sum(balancejournal.locked), 0) as locked
+            from balances
+            left join balancejournal
+            on balancejournal.account_id = balances.account_id
+            and balancejournal.asset = balances.asset
+            and balancejournal.version > balances.journal_version
+            where balances.account_id = :account_id
+            group by balances.id
+            order by balances.asset
+        """
+        return db.execute(text(query), {"account_id": str(account_id)})
+
+    @classmethod
+    def _load(cls, db: Session, keys: list) -> dict:
+        query = """
+            select
+            balances.account_id,
+            balances.asset,
+            balances.free + coalesce(sum(balancejournal.free), 0) as free,
+            balances.locked + coalesce(sum(balancejournal.locked), 0) as locked,
+            coalesce(max(balancejournal.version), balances.journal_version) as version
+            from balances
+            join unnest(cast(:account_ids as uuid[]), cast(:assets as text[])) as k(account_id, asset)
+            on balances.account_id = k.account_id and balances.asset = k.asset
+            left join balancejournal
+            on balancejournal.account_id = balances.account_id
+            and balancejournal.asset = balances.asset
+            and balancejournal.version > balances.journal_version
+            group by balances.id
+        """
+        rows = db.execute(text(query), {
+            "account_ids": [key[0] for key in keys],
+            "assets": [key[1] for key in keys],
+        }).all()
+        states = {}
+        for row in rows:
+            state = BalanceState(row.account_id, row.asset,
+                                 row.free, row.locked, row.version)
+            states[state.key] = state
+        return states
+
+    @classmethod
+    def _fold(cls, db: Session, states: list) -> None:
+        # bring cached balances up to date with entries other processes
+        # appended since they were cached
+        query = """
+            select
+            balancejournal.account_id,
+            balancejournal.asset,
+            sum(balancejournal.free) as free,
+            sum(balancejournal.locked) as locked,
+            max(balancejournal.version) as version
+            from balancejournal
+            join unnest(cast(:account_ids as uuid[]), cast(:assets as text[]), cast(:versions as bigint[])) as k(account_id, asset, version)
+            on balancejournal.account_id = k.account_id
+            and balancejournal.asset = k.asset
+            and balancejournal.version > k.version
+            group by balancejournal.account_id, balancejournal.asset
+        """
+        by_key = {state.key: state for state in states}
+        rows = db.execute(text(query), {
+            "account_ids": [state.key[0] for state in states],
+            "assets": [state.asset for state in states],
+            "versions": [state.version for state in states],
+        }).all()
+        for row in rows:
+            state = by_key[(str(row.account_id), row.asset)]
+            state.free += row.free
+            state.locked += row.locked
+            state.version = row.version
+
+    @classmethod
+    def get_states(cls, db: Session, keys: list) -> dict:
+        keys = [(str(account_id), asset) for account_id, asset in keys]
+        pending = db.info.setdefault('balances', {})
+        states, cached, missing = {}, [], []
+        for key in keys:
+            if key in pending:
+                states[key] = pending[key]
+            elif key in cls._cache:
+                cached_state = cls._cache[key]
+                state = BalanceState(
+                    cached_state.account_id, cached_state.asset,
+                    cached_state.free, cached_state.locked, cached_state.version)
+                states[key] = state
+                cached.append(state)
+            else:
+                missing.append(key)
+        if cached:
+            cls._fold(db=db, states=cached)
+        if missing:
+            states.update(cls._load(db=db, keys=missing))
+        pending.update(states)
+        return states
+
+    @classmethod
+    def _forget(cls, db: Session, keys: list):
+        pending = db.info.get('balances', {})
+        for account_id, asset in keys:
+            pending.pop((str(account_id), asset), None)
+            cls._cache.pop((str(account_id), asset), None)
+
+    @classmethod
+    def append(cls, db: Session, changes: list) -> list:
+        states = cls.get_states(
+            db=db, keys=[(change['account_id'], change['asset']) for change in changes])
+        versions = {key: state.version for key, state in states.items()}
+        rows = []
+        for change in changes:
+            key = (str(change['account_id']), change['asset'])
+            versions[key] += 1
+            rows.append({
+                "account_id": change['account_id'],
+                "asset": change['asset'],
+                "version": versions[key],
+                "free": change.get('free', Decimal('0.0')),
+                "locked": change.get('locked', Decimal('0.0')),
+                "reason": change['reason'],
+                "ref_id": change.get('ref_id'),
+            })
+        db.execute(insert(BalanceJournal).values(rows))
+        updated = {}
+        for row in rows:
+            state = states[(str(row['account_id']), row['asset'])]
+            state.free += row['free']
+            state.locked += row['locked']
+            state.version = row['version']
+            updated[state.key] = state
+        return list(updated.values())
+
+    @classmethod
+    def apply(cls, db: Session, keys: list, get_changes) -> list:
+        """Append the changes get_changes returns for the current balances of keys.
+
+        get_changes receives the current states by key and returns the
+        changes to append, or nothing to leave the balances untouched.
+        """
+        if settings.CONCURRENCY_MODE == enums.ConcurrencyMode.pessimistic.value:
+            cls.lock_keys(db=db, keys=keys)
+            changes = get_changes(cls.get_states(db=db, keys=keys))
+            if not changes:
+                return []
+            return cls.append(db=db, changes=changes)
+        for attempt in range(settings.CONCURRENCY_MAX_RETRIES):
+            changes = get_changes(cls.get_states(db=db, keys=keys))
+            if not changes:
+                return []
+            try:
+                with db.begin_nested():
+                    return cls.append(db=db, changes=changes)
+            except IntegrityError:
+                # another writer appended the same version first
+                cls._forget(db=db, keys=keys)
+        raise ConcurrentUpdateError(f"balances {keys} kept changing")
+
     @classmethod
     def lock(cls, info: dict, db: Session):
-        try:
-            db_balance = db.query(cls).filter(
-                cls.account_id == info['account_id'],
-                cls.asset == enums.CollateralAsset.usdt.value
-            ).with_for_update().one()
-            lock_amount = cls.get_lock_amount(info['amount'])
-            if db_balance.free >= lock_amount:
-                db_balance.locked += lock_amount
-                db_balance.free -= lock_amount
-                return db_balance
-        except exc.NoResultFound:
-            pass
-        return None
+        key = (str(info['account_id']), enums.CollateralAsset.usdt.value)
+        lock_amount = cls.get_lock_amount(info['amount'])
+
+        def get_changes(states):
+            state = states.get(key)
+            if state is None or state.free < lock_amount:
+                return None
+            return [{
+                "account_id": info['account_id'],
+                "asset": key[1],
+                "free": -lock_amount,
+                "locked": lock_amount,
+                "reason": enums.BalanceChange.order_lock.value,
+                "ref_id": info.get('ref_id'),
+            }]
+        balances = cls.apply(db=db, keys=[key], get_changes=get_changes)
+        return balances[0] if balances else None
 
     @classmethod
     def unlock(cls, info: dict, db: Session):
-        try:
-            db_balance = db.query(cls).filter(
-                cls.account_id == info['account_id'],
-                cls.asset == info['asset']
-            ).with_for_update().one()
-            lock_amount = cls.get_lock_amount(info['amount'])
-            if db_balance.locked >= lock_amount:
-                db_balance.free += lock_amount
-                db_balance.locked -= lock_amount
-                return db_balance
-        except exc.NoResultFound:
-            pass
-        return None
+        key = (str(info['account_id']), info['asset'])
+        lock_amount = cls.get_lock_amount(info['amount'])
+
+        def get_changes(states):
+            state = states.get(key)
+            if state is None or state.locked < lock_amount:
+                return None
+            return [{
+                "account_id": info['account_id'],
+                "asset": key[1],
+                "free": lock_amount,
+                "locked": -lock_amount,
+                "reason": enums.BalanceChange.order_unlock.value,
+                "ref_id": info.get('ref_id'),
+            }]
+        balances = cls.apply(db=db, keys=[key], get_changes=get_changes)
+        return balances[0] if balances else None
 
     @classmethod
-    def update_or_create(cls, balance_in: schemas.BalanceIn, db: Session):
-        db_balance = cls._update(balance_in=balance_in, db=db)
-        if not db_balance:
-            db_balance = cls._create(balance_in=balance_in, db=db)
-        return db_balance
+    def create_missing(cls, db: Session, account_ids: list, asset: str):
+        """Insert empty balance rows of asset for accounts that have none."""
+        if not account_ids:
+            return
+        db.execute(
+            pg_insert(cls).values([{
+                "id": uuid.uuid4(),
+                "account_id": account_id,
+                "asset": asset,
+                "free": Decimal('0.0'),
+                "locked": Decimal('0.0'),
+                "journal_version": 0,
+            } for account_id in account_ids]).on_conflict_do_nothing()
+        )
 
     @classmethod
-    def _update(cls, balance_in: schemas.BalanceIn, db: Session):
-        try:
-            db_balance = db.query(cls).filter(
-                cls.account_id == balance_in.account_id,
-                cls.asset == balance_in.asset,
-            ).with_for_update().one()
-        except exc.NoResultFound:
-            db_balance = None
-        if db_balance:
-            db_balance.free = balance_in.free
-            db_balance.locked = balance_in.locked
-            db.commit()
-            db.refresh(db_balance)
-        return db_balance
-
-    @classmethod
-    def _create(cls, balance_in: schemas.BalanceIn, db: Session):
-        db_balance = cls(**balance_in.dict())
-        db.add(db_balance)
+    def update_or_create(cls, balance_in: schemas.BalanceIn, db: Session):
+        cls.create_missing(
+            db=db, account_ids=[balance_in.account_id], asset=balance_in.asset)
+        key = (str(balance_in.account_id), balance_in.asset)
+
+        def get_changes(states):
+            return [{
+                "account_id": balance_in.account_id,
+                "asset": balance_in.asset,
+                "free": balance_in.free - states[key].free,
+                "locked": balance_in.locked - states[key].locked,
+                "reason": enums.BalanceChange.set_balance.value,
+            }]
+        state = cls.apply(db=db, keys=[key], get_changes=get_changes)[0]
         db.commit()
-        db.refresh(db_balance)
-        return db_balance
+        return state
 
     @classmethod
-    def exchange(cls, db: Session, account_id: uuid.UUID, collateral: dict) -> bool:
-        asset = db.query(cls).filter(
-            cls.account_id == account_id,
-            cls.asset == collateral['asset']
-        ).with_for_update().one()
-        _locked = collateral['locked']
-        _free = collateral['free']
-        _rebate = collateral['rebate']
-        if asset.locked >= _locked:
-            asset.locked -= _locked
-        else:
-            raise
-        asset.free += _free
-        asset.free += collateral['rebate']
-        print(
-            f"free+: {_free}, locked-: {_locked}, rebate: {_rebate}")
-        db.add(asset)
-        return [asset]
+    def credit(cls, db: Session, amounts: list, asset: str, reason: str) -> list:
+        """Add (account_id, amount) pairs to the free balances of asset."""
+        if not amounts:
+            return []
+        return cls.apply(
+            db=db,
+            keys=[(account_id, asset) for account_id, amount in amounts],
+            get_changes=lambda states: [{
+                "account_id": account_id,
+                "asset": asset,
+                "free": amount,
+                "reason": reason,
+            } for account_id, amount in amounts],
+        )
+
+    @classmethod
+    def roll_up(cls, db: Session, batch_size: int) -> int:
+        # from_version makes a concurrent roll up of the same row a no-op
+        # instead of adding the same entries twice
+        query = """
+            update balances
+            set
+            free = balances.free + deltas.free,
+            locked = balances.locked + deltas.locked,
+            journal_version = deltas.version
+            from (
+                select
+                balances.id,
+                balances.journal_version as from_version,
+                sum(balancejournal.free) as free,
+                sum(balancejournal.locked) as locked,
+                max(balancejournal.version) as version
+                from balances
+                join balancejournal
+                on balancejournal.account_id = balances.account_id
+                and balancejournal.asset = balances.asset
+                and balancejournal.version > balances.journal_version
+                group by balances.id
+                limit :batch_size
+            ) as deltas
+            where balances.id = deltas.id
+            and balances.journal_version = deltas.from_version
+        """
+        return db.execute(text(query), {"batch_size": batch_size}).rowcount
+
+
+class BalanceJournal(Base):
+    __tablename__ = "balancejournal"
+
+    seq = Column(BigInteger, primary_key=True, autoincrement=True)
+    account_id = Column(UUID(as_uuid=True), ForeignKey("accounts.id"))
+    asset = Column(String)
+    version = Column(BigInteger)
+    free = Column(DECIMAL, default=Decimal('0.0'))
+    locked = Column(DECIMAL, default=Decimal('0.0'))
+    reason = Column(String)
+    ref_id = Column(UUID(as_uuid=True), nullable=True)
+    insert_time = Column(TIMESTAMP, server_default=func.now())
+    __table_args__ = (UniqueConstraint(
+        'account_id', 'asset', 'version', name='_balancejournal_account_asset_version_uc'),)
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _cache_committed_balances(session):
+    if session.in_nested_transaction():
+        # a released savepoint, the balances are not committed yet
+        return
+    committed = session.info.pop('balances', None)
+    if not committed:
+        return
+    if len(Balance._cache) > settings.BALANCE_CACHE_SIZE:
+        Balance._cache.clear()
+    Balance._cache.update(committed)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _discard_pending_balances(session):
+    session.info.pop('balances', None)
 
 
 class Order(Base):
@@ -224,9 +598,15 @@ class Order(Base):
     insert_time = Column(TIMESTAMP, server_default=func.now())
     update_time = Column(TIMESTAMP, server_default=func.now(),
                          onupdate=func.current_timestamp())
+    # insert and update times come back with RETURNING, so a flushed order
+    # can be published without a SELECT to refresh them
+    __mapper_args__ = {"eager_defaults": True}
 
     def lock_balance(self, db: Session) -> Balance:
         collateral = self._get_collateral()
+        if self.id is None:
+            self.id = uuid.uuid4()
+        collateral['ref_id'] = self.id
         if self.reduce_only:
             locked_balance = Position.lock(info=collateral, db=db)
         else:
@@ -260,6 +640,75 @@ class Order(Base):
         }
         return collateral
 
+    @classmethod
+    def get_maker_orders(cls, db: Session, order: "Order", exclude_ids: list = None) -> list:
+        """Makers order can match in priority order, prefetched in one query.
+
+        Makers are taken up to the first one whose cumulative remaining
+        quantity covers what is left of the order, so a match knows every
+        account it touches before settling any fill.
+        """
+        if order.side == enums.OrderSide.long.value:
+            opposite_side = enums.OrderSide.short.value
+            price_order_by = cls.price.asc()
+        else:
+            opposite_side = enums.OrderSide.long.value
+            price_order_by = cls.price.desc()
+        query = [
+            cls.status.in_(enums.OrderStatus.active_orders.value),
+            cls.symbol == order.symbol,
+            cls.side == opposite_side,
+        ]
+        if order.type == enums.OrderType.limit.value:
+            if order.side == enums.OrderSide.long.value:
+                query.append(cls.price <= order.price)
+            else:
+                query.append(cls.price >= order.price)
+        if exclude_ids:
+            query.append(cls.id.notin_(exclude_ids))
+        if order.quantity:
+            remaining = cls.quantity - cls.filled_quantity
+            needed = order.quantity - order.filled_quantity
+        else:
+            remaining = (cls.quantity - cls.filled_quantity) * cls.price
+            needed = order.quote_quantity - order.filled_quote
+        priority = [price_order_by, cls.insert_time.desc(), cls.id]
+        makers = select(
+            cls.id,
+            (func.sum(remaining).over(order_by=priority) - remaining).label('ahead'),
+        ).where(*query).subquery()
+        return db.query(cls).options(raiseload("*")).join(
+            makers, cls.id == makers.c.id
+        ).filter(
+            makers.c.ahead < needed
+        ).order_by(*priority).all()
+
+    @classmethod
+    def archive(cls, db: Session, batch_size: int, min_age: float) -> int:
+        # moves a batch of orders that reached a terminal status at least
+        # min_age seconds ago to orders_archive in one statement
+        columns = ", ".join(column.name for column in cls.__table__.columns)
+        query = f"""
+            with moved as (
+                delete from orders
+                where id in (
+                    select id from orders
+                    where status = any(:statuses)
+                    and update_time < now() - make_interval(secs => :min_age)
+                    limit :batch_size
+                    for update skip locked
+                )
+                returning {columns}
+            )
+            insert into orders_archive ({columns})
+            select {columns} from moved
+        """
+        return db.execute(text(query), {
+            "statuses": [enums.OrderStatus.filled.value, enums.OrderStatus.canceled.value],
+            "min_age": min_age,
+            "batch_size": batch_size,
+        }).rowcount
+
     @classmethod
     def filter_open_orders(cls, db: Session, account_id: uuid.UUID, symbol: str = ""):
         query = [
@@ -300,18 +749,61 @@ class Order(Base):
         ).all()
 
 
+class OrderArchive(Base):
+    """Orders in a terminal status, moved out of orders by Order.archive."""
+    __tablename__ = "orders_archive"
+
+    id = Column(UUID(as_uuid=True), primary_key=True)
+    account_id = Column(UUID(as_uuid=True), index=True)
+    symbol = Column(String)
+    base = Column(String)
+    quote = Column(String)
+    side = Column(String)
+    position_mode = Column(String)
+    type = Column(String)
+    status = Column(String)
+    price = Column(DECIMAL)
+    quantity = Column(DECIMAL)
+    quote_quantity = Column(DECIMAL)
+    filled_quantity = Column(DECIMAL)
+    filled_quote = Column(DECIMAL)
+    leverage = Column(INTEGER)
+    post_only = Column(Boolean)
+    reduce_only = Column(Boolean)
+    locked_asset = Column(String)
+    locked_quantity = Column(DECIMAL)
+    insert_time = Column(TIMESTAMP)
+    update_time = Column(TIMESTAMP)
+
+
+# read only union of orders and orders_archive for history reads, the view
+# is created by migrate.py and kept out of Base.metadata so create_all
+# doesn't turn it into a table
+all_orders = Table(
+    "all_orders",
+    MetaData(),
+    *[Column(column.name, column.type) for column in Order.__table__.columns],
+)
+
+
 class Trade(Base):
     __tablename__ = "trades"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    maker_order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id"))
-    maker_order = relationship("Order", foreign_keys=[maker_order_id])
-    taker_order_id = Column(UUID(as_uuid=True), ForeignKey("orders.id"))
-    taker_order = relationship("Order", foreign_keys=[taker_order_id])
+    # no foreign keys, the orders may have been moved to orders_archive
+    maker_order_id = Column(UUID(as_uuid=True))
+    maker_order = relationship(
+        "Order", primaryjoin="foreign(Trade.maker_order_id) == Order.id")
+    taker_order_id = Column(UUID(as_uuid=True))
+    taker_order = relationship(
+        "Order", primaryjoin="foreign(Trade.taker_order_id) == Order.id")
     quantity = Column(DECIMAL, default=Decimal('0.0'))
     price = Column(DECIMAL, default=Decimal('0.0'))
     quote_quantity = Column(DECIMAL, default=Decimal('0.0'))
-    insert_time = Column(TIMESTAMP, server_default=func.now())
+    # partition key, see internal/partitions.py
+    insert_time = Column(TIMESTAMP, primary_key=True,
+                         server_default=func.now())
+    __table_args__ = {"postgresql_partition_by": "RANGE (insert_time)"}
 
     @classmethod
     def create_trade(cls, db: Session, maker: Order, taker: Order, contract: Contract) -> bool:
@@ -345,52 +837,81 @@ class Trade(Base):
             else:
                 if taker_remained_quote_quantity == trade_quote_quantity:
                     taker.status = enums.OrderStatus.filled.value
+            # not added to the session, the settlement writes the fills of a
+            # batch in bulk so the ids are set here
             trade = cls(
+                id=uuid.uuid4(),
+                maker_order_id=maker.id,
                 maker_order=maker,
+                taker_order_id=taker.id,
                 taker_order=taker,
                 price=maker.price,
                 quantity=trade_quantity,
                 quote_quantity=trade_quote_quantity
             )
-            db.add(trade)
         return trade
 
+    @classmethod
+    def get_last_prices(cls, db: Session, symbols: list = None) -> dict:
+        # only the recent partitions are read, a symbol without a trade in
+        # LAST_PRICE_WINDOW has no price
+        query = """
+            select distinct on (orders.symbol)
+            orders.symbol,
+            trades.price
+            from trades
+            join all_orders as orders
+            on trades.maker_order_id = orders.id
+            where orders.symbol = ANY(:symbols)
+            and trades.insert_time > :since
+            order by orders.symbol, trades.insert_time desc
+        """
+        since = datetime.datetime.utcnow() - \
+            datetime.timedelta(seconds=settings.LAST_PRICE_WINDOW)
+        rows = db.execute(
+            text(query), {"symbols": symbols or [], "since": since}).all()
+        return {row.symbol: row.price for row in rows}
+
 
 class SubTrade(Base):
     __tablename__ = "subtrades"
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    trade_id = Column(UUID(as_uuid=True), ForeignKey("trades.id"))
-    trade = relationship("Trade", foreign_keys=[trade_id])
+    # partitioned tables can't be referenced by a foreign key on id alone
+    trade_id = Column(UUID(as_uuid=True))
+    trade = relationship(
+        "Trade", primaryjoin="foreign(SubTrade.trade_id) == Trade.id")
     commission = Column(DECIMAL, default=Decimal('0.0'))
     commission_asset = Column(String)
     side = Column(String)
     is_maker = Column(Boolean)
+    # now() is the transaction start, so a sub trade lands in the same
+    # partition and has the same insert_time as its trade
+    insert_time = Column(TIMESTAMP, primary_key=True,
+                         server_default=func.now())
+    __table_args__ = {"postgresql_partition_by": "RANGE (insert_time)"}
 
     @classmethod
-    def create_sub_trades(cls, db: Session, trade: Trade) -> list:
+    def create_sub_trades(cls, db: Session, trade: Trade, settlement: "Settlement") -> list:
         sub_trades = []
-        balances = {
-            "taker": [],
-            "maker": []
-        }
         positions = []
-        # contract = db.query(Contract).filter(
-        #     Contract.symbol == trade.maker_order.symbol,
-        # ).with_for_update().one()
         open_interest = Decimal('0.0')
+        trade.insert_time = settlement.get_now()
         for idx, order in enumerate([trade.maker_order, trade.taker_order]):
             is_maker = idx == 0
             order.filled_quantity += trade.quantity
             order.filled_quote += trade.quote_quantity
-            trade_fee = settings.FEES[enums.OrderRole.maker.value if is_maker else enums.OrderRole.taker.value]
+            trade_fee = AccountVolume.get_fee(
+                account_id=order.account_id,
+                role=enums.OrderRole.maker.value if is_maker else enums.OrderRole.taker.value,
+            )
             trade_commission = trade.quote_quantity * trade_fee
             trade_rebate = Decimal('0.0')
             if trade_commission < Decimal('0.0'):
                 trade_rebate = -1 * trade_commission
                 trade_commission = Decimal('0.0')
 
-            position = Position.get_order_position(db=db, order=order)
+            position = settlement.get_position(order=order)
             # position_margin = position.margin
             margin_to_free_balance = Decimal('0.0')
             locked_balance_to_margin = Decimal('0.0')
@@ -399,10 +920,12 @@ class SubTrade(Base):
             if position.side == order.side:
                 # increase position size by order on the same size
                 transfering_collateral_dir = enums.PositionMarginAction.add_to_margin.value
+                if position.quantity == Decimal('0.0'):
+                    position.opened_at = settlement.get_now()
                 position.quantity += trade.quantity
                 open_interest += trade.quantity
                 margin_change_quantity = trade.quote_quantity / order.leverage
-                # contract.margin_pool += margin_change_quantity
+                settlement.margin_pool += margin_change_quantity
                 position.margin += margin_change_quantity
                 locked_balance_to_margin = margin_change_quantity + trade_commission
             else:
@@ -423,14 +946,15 @@ class SubTrade(Base):
                     pnl *= -1
                 margin_to_free_balance += pnl + margin_change_quantity
                 margin_to_free_balance -= trade_commission
-                # contract.margin_pool -= margin_change_quantity
+                settlement.margin_pool -= margin_change_quantity
                 position.margin -= margin_change_quantity
                 remained_quantity = trade.quantity - max_lowering_quantity
                 if remained_quantity > Decimal('0.0'):
                     position.side = order.side
                     position.quantity = remained_quantity
+                    position.opened_at = settlement.get_now()
                     margin_change_quantity = remained_quantity * trade.price / order.leverage
-                    # contract.margin_pool += margin_change_quantity
+                    settlement.margin_pool += margin_change_quantity
                     position.margin += margin_change_quantity
                     locked_balance_to_margin += margin_change_quantity + trade_commission
 
@@ -475,20 +999,21 @@ class SubTrade(Base):
             free = margin_to_free_balance + locked_balance_to_free_balance
             unlocked = locked_balance_to_margin + locked_balance_to_free_balance
 
-            updated_balances = Balance.exchange(
-                db=db,
+            settlement.exchange(
                 account_id=order.account_id,
                 collateral={
                     "locked": unlocked,
                     "free": free,
-                    "asset": enums.CollateralAsset.usdt.value,
-                    "rebate": trade_rebate
+                    "rebate": trade_rebate,
+                    "ref_id": order.id,
                 },
             )
-            balances['maker' if is_maker else 'taker'] = updated_balances
             sub_trades.append(
                 SubTrade(
+                    id=uuid.uuid4(),
+                    trade_id=trade.id,
                     trade=trade,
+                    insert_time=trade.insert_time,
                     commission=trade_commission,
                     commission_asset=enums.CollateralAsset.usdt.value,
                     side=order.side,
@@ -496,14 +1021,17 @@ class SubTrade(Base):
                 )
             )
             positions.append(position)
-        # contract.open_interest += open_interest / Decimal('2.0')
-        # db.add(contract)
-        db.add_all(sub_trades)
+        # both sides of the fill are counted, the contract row itself is
+        # only updated by the batched flush in internal/contract_stats.py
+        settlement.open_interest += open_interest / Decimal('2.0')
         db.add_all(positions)
+        settlement.trades.append(trade)
+        settlement.sub_trades += sub_trades
         for sub_trade in sub_trades:
             if sub_trade.commission > Decimal('0.0'):
-                ExchangeIncome.pay_commissions(db=db, sub_trade=sub_trade)
-        return sub_trades, balances, positions
+                settlement.incomes.append(
+                    ExchangeIncome.pay_commissions(db=db, sub_trade=sub_trade))
+        return sub_trades, positions
 
 
 class Position(Base):
@@ -524,8 +1052,13 @@ class Position(Base):
     margin = Column(DECIMAL, default=Decimal('0.0'))
     margin_type = Column(String, default=enums.MarginType.isolated.value)
     position_mode = Column(String, default=enums.PositionMode.ony_way.value)
+    # when the current side was opened, a funding round only charges
+    # positions that were already open at its funding time
+    opened_at = Column(TIMESTAMP)
+    version = Column(Integer, nullable=False, default=1)
+    __mapper_args__ = {"version_id_col": version}
 
-    @property
+    @hybrid_property
     def size(self):
         if self.side == enums.OrderSide.long.value:
             _size = self.quantity
@@ -533,33 +1066,60 @@ class Position(Base):
             _size = -self.quantity
         return _size
 
+    @size.expression
+    def size(cls):
+        return case(
+            (cls.side == enums.OrderSide.long.value, cls.quantity),
+            else_=-cls.quantity,
+        )
+
+    @classmethod
+    def _compare_and_swap(cls, db: Session, query, update):
+        """Apply update to the single row of query.
+
+        In the optimistic mode the row is read without a lock and written
+        back with a version check inside a savepoint, rereading it when a
+        concurrent update won.
+        """
+        if settings.CONCURRENCY_MODE == enums.ConcurrencyMode.pessimistic.value:
+            db_position = query.with_for_update().one_or_none()
+            if db_position is None:
+                return None
+            return update(db_position)
+        for attempt in range(settings.CONCURRENCY_MAX_RETRIES):
+            try:
+                with db.begin_nested():
+                    db_position = query.populate_existing().one_or_none()
+                    if db_position is None:
+                        return None
+                    return update(db_position)
+            except exc.StaleDataError:
+                continue
+        raise ConcurrentUpdateError("position kept changing")
+
+    @classmethod
+    def _opposite_query(cls, info: dict, db: Session):
+        return db.query(cls).filter(
+            cls.account_id == info['account_id'],
+            cls.symbol == info['symbol'],
+            # cls.position_mode == enums.PositionMode.ony_way.value,
+            cls.side == enums.OrderSide.long.value if info[
+                'side'] == enums.OrderSide.short.value else enums.OrderSide.short.value,
+        )
+
     @classmethod
     def lock(cls, info: dict, db: Session):
-        try:
-            db_position = db.query(cls).filter(
-                cls.account_id == info['account_id'],
-                cls.symbol == info['symbol'],
-                # cls.position_mode == enums.PositionMode.ony_way.value,
-                cls.side == enums.OrderSide.long.value if info[
-                    'side'] == enums.OrderSide.short.value else enums.OrderSide.short.value,
-            ).with_for_update().one()
+        def update(db_position):
             if db_position.quantity - db_position.locked_quantity >= info['amount'] > 0:
                 db_position.locked_quantity += info['amount']
                 return db_position
-        except exc.NoResultFound:
-            pass
-        return None
+            return None
+        return cls._compare_and_swap(
+            db=db, query=cls._opposite_query(info=info, db=db), update=update)
 
     @classmethod
     def unlock(cls, info: dict, db: Session):
-        try:
-            db_position = db.query(cls).filter(
-                cls.account_id == info['account_id'],
-                cls.symbol == info['symbol'],
-                # cls.position_mode == enums.PositionMode.ony_way.value,
-                cls.side == enums.OrderSide.long.value if info[
-                    'side'] == enums.OrderSide.short.value else enums.OrderSide.short.value,
-            ).with_for_update().one()
+        def update(db_position):
             if db_position.side == enums.OrderSide.long.value:
                 if db_position.quantity - db_position.locked_quantity >= info['amount'] > 0:
                     db_position.locked_quantity += info['amount']
@@ -570,9 +1130,9 @@ class Position(Base):
                     return db_position
             else:
                 pass
-        except exc.NoResultFound:
-            pass
-        return None
+            return None
+        return cls._compare_and_swap(
+            db=db, query=cls._opposite_query(info=info, db=db), update=update)
 
     @classmethod
     def get_open_positions(cls, account_id, db):
@@ -584,14 +1144,122 @@ class Position(Base):
         ).all()
 
     @classmethod
-    def get_order_position(cls, db: Session, order: Order):
-        try:
-            position = db.query(Position).filter(
-                Position.account_id == order.account_id,
-                Position.symbol == order.symbol,
-                Position.position_mode == enums.PositionMode.ony_way.value,
-            ).with_for_update().one()
-        except Exception as e:
+    def lock_positions(cls, db: Session, symbol: str, account_ids: list) -> dict:
+        query = db.query(cls).options(raiseload("*")).filter(
+            cls.account_id.in_(account_ids),
+            cls.symbol == symbol,
+            cls.position_mode == enums.PositionMode.ony_way.value,
+        ).order_by(cls.account_id)
+        if settings.CONCURRENCY_MODE == enums.ConcurrencyMode.pessimistic.value:
+            # in the optimistic mode the version check at flush catches a
+            # concurrent update and the engine retries the whole order
+            query = query.with_for_update()
+        return {str(position.account_id): position for position in query}
+
+    @classmethod
+    def liquidate(cls, db: Session, position_id: uuid.UUID, price: Decimal) -> Order:
+        def update(position):
+            if position.quantity <= Decimal('0.0'):
+                return None
+            if position.side == enums.OrderSide.long.value:
+                crossed = price <= position.liquidation_price
+                side = enums.OrderSide.short.value
+            else:
+                crossed = price >= position.liquidation_price
+                side = enums.OrderSide.long.value
+            quantity = position.quantity - position.locked_quantity
+            if not crossed or quantity <= Decimal('0.0'):
+                return None
+            contract = db.query(Contract).filter(
+                Contract.symbol == position.symbol,
+            ).one()
+            order = Order(
+                account_id=position.account_id,
+                symbol=position.symbol,
+                base=contract.base_asset,
+                quote=contract.quote_asset,
+                side=side,
+                position_mode=position.position_mode,
+                type=enums.OrderType.market.value,
+                quantity=quantity,
+                leverage=position.leverage,
+                reduce_only=True,
+                locked_asset=enums.CollateralType.position.value,
+                locked_quantity=quantity,
+            )
+            position.locked_quantity += quantity
+            db.add(order)
+            db.flush()
+            return order
+        return cls._compare_and_swap(
+            db=db,
+            query=db.query(cls).filter(cls.id == position_id),
+            update=update,
+        )
+
+
+def bulk_insert(db: Session, objects: list):
+    """Insert transient objects of one model in a single multi-row INSERT.
+
+    The objects are never added to the session, so primary keys and any
+    server side values have to be set on them beforehand. Runs on the
+    session's connection, inside its transaction.
+    """
+    if not objects:
+        return
+    table = objects[0].__table__
+    columns = list(table.columns)
+    rows = []
+    for obj in objects:
+        row = []
+        for column in columns:
+            value = getattr(obj, column.key)
+            if value is None and column.default is not None and column.default.is_scalar:
+                value = column.default.arg
+            if isinstance(value, uuid.UUID):
+                value = str(value)
+            row.append(value)
+        rows.append(row)
+    cursor = db.connection().connection.cursor()
+    try:
+        psycopg2.extras.execute_values(
+            cursor,
+            f"insert into {table.name} ({', '.join(column.name for column in columns)}) values %s",
+            rows,
+            page_size=len(rows),
+        )
+    finally:
+        cursor.close()
+
+
+class Settlement:
+    """Positions and balances of every account a set of fills touches.
+
+    The positions are locked up front with one FOR UPDATE ordered by
+    account, so two matches touching the same accounts can't deadlock, and
+    the balance changes of every fill are appended in one batch by settle.
+    """
+
+    def __init__(self, db: Session, symbol: str, account_ids: list) -> None:
+        self.db = db
+        self.symbol = symbol
+        self.asset = enums.CollateralAsset.usdt.value
+        self.account_ids = sorted(set(str(account_id) for account_id in account_ids))
+        self.positions = Position.lock_positions(
+            db=db, symbol=symbol, account_ids=self.account_ids)
+        self.changes = []
+        # fills are kept out of the session and inserted in bulk by settle
+        self.trades = []
+        self.sub_trades = []
+        self.incomes = []
+        self.now = None
+        # contract totals moved by the fills, applied after the commit
+        self.open_interest = Decimal('0.0')
+        self.margin_pool = Decimal('0.0')
+
+    def get_position(self, order: Order) -> Position:
+        position = self.positions.get(str(order.account_id))
+        if position is None:
             position = Position(
                 account_id=order.account_id,
                 symbol=order.symbol,
@@ -601,33 +1269,414 @@ class Position(Base):
                 quantity=Decimal('0.0'),
                 margin=Decimal('0.0'),
             )
-            db.add(position)
+            self.db.add(position)
+            self.positions[str(order.account_id)] = position
         return position
 
+    def exchange(self, account_id: uuid.UUID, collateral: dict):
+        self.changes.append({
+            "account_id": account_id,
+            "asset": self.asset,
+            "free": collateral['free'] + collateral['rebate'],
+            "locked": -collateral['locked'],
+            "reason": enums.BalanceChange.trade.value,
+            "ref_id": collateral.get('ref_id'),
+        })
+
+    def _get_changes(self, states: dict) -> list:
+        missing = sorted(set(
+            str(change['account_id']) for change in self.changes
+            if (str(change['account_id']), change['asset']) not in states))
+        if missing:
+            raise MissingBalanceError(missing)
+        locked = {key: state.locked for key, state in states.items()}
+        for change in self.changes:
+            key = (str(change['account_id']), change['asset'])
+            if locked[key] + change['locked'] < Decimal('0.0'):
+                raise ValueError(
+                    f"locked balance of {change['account_id']} is lower than {-change['locked']}")
+            locked[key] += change['locked']
+        return self.changes
+
+    def get_now(self) -> datetime.datetime:
+        # the transaction start as the naive timestamp the insert_time server
+        # default stores, now() itself would come back timezone aware
+        if self.now is None:
+            self.now = self.db.execute(select(func.localtimestamp())).scalar()
+        return self.now
+
+    def _persist_fills(self):
+        for objects in (self.trades, self.sub_trades, self.incomes):
+            bulk_insert(db=self.db, objects=objects)
+
+    def settle(self) -> list:
+        self._persist_fills()
+        if not self.changes:
+            return []
+        keys = [(account_id, self.asset) for account_id in self.account_ids]
+        try:
+            return Balance.apply(db=self.db, keys=keys, get_changes=self._get_changes)
+        except MissingBalanceError as e:
+            # an account that never held the asset gets an empty row, only
+            # then can its changes be appended
+            Balance.create_missing(db=self.db, account_ids=e.account_ids, asset=self.asset)
+            return Balance.apply(db=self.db, keys=keys, get_changes=self._get_changes)
+
+
+class AccountVolume(Base):
+    __tablename__ = "accountvolumes"
+
+    account_id = Column(UUID(as_uuid=True), primary_key=True)
+    day = Column(Date, primary_key=True)
+    volume = Column(DECIMAL, default=Decimal('0.0'))
+
+    # account id -> index in settings.FEE_TIERS, accounts in the first tier
+    # are left out
+    _tiers = {}
+
+    @classmethod
+    def get_fee(cls, account_id: uuid.UUID, role: str) -> Decimal:
+        tier = cls._tiers.get(str(account_id), 0)
+        return settings.FEE_TIERS[tier][role]
+
+    @classmethod
+    def add(cls, db: Session, volumes: dict):
+        """Add traded quote volume to the daily buckets, keyed by (account_id, day)."""
+        rows = [
+            {"account_id": account_id, "day": day, "volume": volume}
+            for (account_id, day), volume in sorted(volumes.items())
+        ]
+        statement = pg_insert(cls).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.account_id, cls.day],
+            set_={"volume": cls.volume + statement.excluded.volume},
+        )
+        db.execute(statement)
+
+    @classmethod
+    def load_tiers(cls, db: Session, since: datetime.date) -> dict:
+        # only accounts that reached the second tier are kept
+        if len(settings.FEE_TIERS) < 2:
+            cls._tiers = {}
+            return cls._tiers
+        total = func.sum(cls.volume)
+        rows = db.query(cls.account_id, total).filter(
+            cls.day >= since,
+        ).group_by(cls.account_id).having(
+            total >= settings.FEE_TIERS[1]['VOLUME'],
+        ).all()
+        thresholds = [tier['VOLUME'] for tier in settings.FEE_TIERS]
+        cls._tiers = {
+            str(account_id): bisect.bisect_right(thresholds, volume) - 1
+            for account_id, volume in rows
+        }
+        return cls._tiers
+
 
 class ExchangeIncome(Base):
     __tablename__ = "exchangeincomes"
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    subtrade_id = Column(UUID(as_uuid=True), ForeignKey("subtrades.id"))
-    subtrade = relationship("SubTrade", foreign_keys=[subtrade_id])
+    subtrade_id = Column(UUID(as_uuid=True))
+    subtrade = relationship(
+        "SubTrade", primaryjoin="foreign(ExchangeIncome.subtrade_id) == SubTrade.id")
     commission = Column(DECIMAL, default=Decimal('0.0'))
     commission_asset = Column(String)
     exchange_income = Column(DECIMAL, default=Decimal('0.0'))
     broker_income = Column(DECIMAL, default=Decimal('0.0'))
     referral_income = Column(DECIMAL, default=Decimal('0.0'))
+    broker_id = Column(UUID(as_uuid=True), nullable=True)
+    referrer_wallet = Column(String, nullable=True)
+    paid = Column(Boolean, default=False)
+    __table_args__ = (Index(
+        'ix_exchangeincomes_unpaid', 'id', postgresql_where=paid.is_(False)),)
+
+    # account id -> (broker_id, referrer_wallet, loaded_at), least recently
+    # used first
+    _beneficiaries = collections.OrderedDict()
+
+    @classmethod
+    def get_beneficiaries(cls, db: Session, account_id: uuid.UUID) -> tuple:
+        # brokers and referrers rarely change, cache them for a while so the
+        # matching path does not query them on every fill
+        key = str(account_id)
+        cached = cls._beneficiaries.get(key)
+        if cached is not None and time.monotonic() - cached[2] < settings.BENEFICIARY_CACHE_TTL:
+            cls._beneficiaries.move_to_end(key)
+            return cached[:2]
+        row = db.query(Account.broker_id, Wallet.referred_wallet).join(
+            Wallet, Account.wallet_id == Wallet.id
+        ).filter(
+            Account.id == account_id
+        ).one()
+        cls._beneficiaries[key] = (row.broker_id, row.referred_wallet, time.monotonic())
+        cls._beneficiaries.move_to_end(key)
+        while len(cls._beneficiaries) > settings.BENEFICIARY_CACHE_SIZE:
+            cls._beneficiaries.popitem(last=False)
+        return row.broker_id, row.referred_wallet
 
     @classmethod
     def pay_commissions(cls, db: Session, sub_trade: SubTrade):
-        pass
-        # commission = sub_trade.commission
-        # income = cls(
-        #     subtrade_id=sub_trade.id,
-        #     commission=commission,
-        #     commission_asset=sub_trade.commission_asset,
-        #     exchange_income=,
-        #     broker_income=,
-        #     referral_income=,
-        # )
+        # only writes a record, brokers and referrers are paid in batches by
+        # pay_out so no balance row is locked on the matching path
+        trade = sub_trade.trade
+        order = trade.maker_order if sub_trade.is_maker else trade.taker_order
+        broker_id, referrer_wallet = cls.get_beneficiaries(
+            db=db, account_id=order.account_id)
+        commission = sub_trade.commission
+        broker_income = Decimal('0.0')
+        referral_income = Decimal('0.0')
+        if broker_id:
+            broker_income = trade.quote_quantity * settings.FEES['BROKER']
+        if referrer_wallet:
+            referral_income = trade.quote_quantity * settings.FEES['REFERRAL']
+        # a tier with a positive maker fee charges the maker, no rebate
+        maker_fee = AccountVolume.get_fee(
+            account_id=trade.maker_order.account_id,
+            role=enums.OrderRole.maker.value,
+        )
+        maker_rebate = trade.quote_quantity * max(-maker_fee, Decimal('0.0'))
+        income = cls(
+            id=uuid.uuid4(),
+            subtrade_id=sub_trade.id,
+            subtrade=sub_trade,
+            commission=commission,
+            commission_asset=sub_trade.commission_asset,
+            exchange_income=commission - maker_rebate - broker_income - referral_income,
+            broker_income=broker_income,
+            referral_income=referral_income,
+            broker_id=broker_id,
+            referrer_wallet=referrer_wallet,
+            paid=not (broker_id or referrer_wallet),
+        )
+        return income
+
+    @classmethod
+    def pay_out(cls, db: Session, batch_size: int) -> tuple:
+        """Credit a batch of unpaid incomes to the main account of every broker and referrer.
+
+        Only incomes whose beneficiaries all have a main account are claimed,
+        the others stay unpaid until they do. Returns the number of claimed
+        incomes and the credited balances.
+        """
+        query = """
+            with beneficiaries as (
+                select
+                exchangeincomes.id,
+                exchangeincomes.broker_income,
+                exchangeincomes.referral_income,
+                broker_accounts.id as broker_account_id,
+                referrer_accounts.id as referrer_account_id
+                from exchangeincomes
+                left join brokers on brokers.id = exchangeincomes.broker_id
+                left join accounts as broker_accounts
+                on broker_accounts.wallet_id = brokers.wallet_id
+                and broker_accounts.type = :account_type
+                left join wallets on wallets.address = exchangeincomes.referrer_wallet
+                left join accounts as referrer_accounts
+                on referrer_accounts.wallet_id = wallets.id
+                and referrer_accounts.type = :account_type
+                where not exchangeincomes.paid
+                and (exchangeincomes.broker_income <= 0 or broker_accounts.id is not null)
+                and (exchangeincomes.referral_income <= 0 or referrer_accounts.id is not null)
+                limit :batch_size
+                for update of exchangeincomes skip locked
+            ),
+            due as (
+                update exchangeincomes
+                set paid = true
+                from beneficiaries
+                where exchangeincomes.id = beneficiaries.id
+                returning beneficiaries.*
+            ),
+            amounts as (
+                select broker_account_id as account_id, broker_income as amount
+                from due
+                where broker_income > 0
+                union all
+                select referrer_account_id, referral_income
+                from due
+                where referral_income > 0
+            )
+            select
+            (select count(*) from due) as claimed,
+            amounts.account_id,
+            amounts.amount
+            from (select 1) as one
+            left join (
+                select account_id, sum(amount) as amount
+                from amounts
+                group by account_id
+            ) as amounts on true
+        """
+        rows = db.execute(text(query), {
+            "batch_size": batch_size,
+            "account_type": enums.AccountType.main.value,
+        }).all()
+        claimed = rows[0].claimed
+        totals = [(row.account_id, row.amount) for row in rows if row.account_id is not None]
+        asset = enums.CollateralAsset.usdt.value
+        # credited amounts have to land on a balance row to be rolled up
+        Balance.create_missing(
+            db=db, account_ids=[account_id for account_id, amount in totals], asset=asset)
+        return claimed, Balance.credit(
+            db=db,
+            amounts=totals,
+            asset=asset,
+            reason=enums.BalanceChange.commission.value,
+        )
+
+
+class FundingPayment(Base):
+    __tablename__ = "fundingpayments"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    position_id = Column(UUID(as_uuid=True), ForeignKey("positions.id"))
+    account_id = Column(UUID(as_uuid=True), ForeignKey("accounts.id"))
+    symbol = Column(String, ForeignKey("contracts.symbol"))
+    side = Column(String)
+    quantity = Column(DECIMAL, default=Decimal('0.0'))
+    mark_price = Column(DECIMAL, default=Decimal('0.0'))
+    funding_rate = Column(DECIMAL, default=Decimal('0.0'))
+    amount = Column(DECIMAL, default=Decimal('0.0'))
+    # what the free balance could not cover of a payment
+    shortfall = Column(DECIMAL, default=Decimal('0.0'))
+    funding_time = Column(TIMESTAMP, index=True)
+    __table_args__ = (UniqueConstraint(
+        'position_id', 'funding_time', name='_position_funding_time_uc'),)
+
+    @classmethod
+    def settle_chunk(cls, db: Session, payments: list) -> tuple:
+        """Write a chunk of a funding round to the ledger and settle it.
+
+        Payments skip rows already settled in this round and are taken from
+        free balances down to zero. What free can not cover is recorded as
+        the shortfall of the account's paying payments and their positions
+        get the mark price as liquidation price, to be closed right away.
+        Returns the changed balances and positions.
+        """
+        values, params = [], {}
+        for idx, payment in enumerate(payments):
+            values.append(
+                f"(cast(:id{idx} as uuid), cast(:position_id{idx} as uuid), "
+                f"cast(:account_id{idx} as uuid), :symbol{idx}, :side{idx}, "
+                f"cast(:quantity{idx} as numeric), cast(:mark_price{idx} as numeric), "
+                f"cast(:funding_rate{idx} as numeric), cast(:amount{idx} as numeric), "
+                f"cast(:funding_time{idx} as timestamp))"
+            )
+            for key, value in payment.items():
+                params[f"{key}{idx}"] = str(value)
+        query = """
+            with v (
+                id, position_id, account_id, symbol, side,
+                quantity, mark_price, funding_rate, amount, funding_time
+            ) as (values {})
+            insert into fundingpayments (
+                id, position_id, account_id, symbol, side,
+                quantity, mark_price, funding_rate, amount, funding_time
+            )
+            select * from v
+            on conflict (position_id, funding_time) do nothing
+            returning id, position_id, account_id, amount, mark_price
+        """
+        paid = db.execute(text(query.format(", ".join(values))), params).all()
+        if not paid:
+            return [], []
+        asset = enums.CollateralAsset.usdt.value
+        totals = collections.defaultdict(Decimal)
+        for row in paid:
+            totals[str(row.account_id)] += row.amount
+        Balance.create_missing(db=db, account_ids=list(totals), asset=asset)
+        shortfalls = {}
+
+        def get_changes(states):
+            shortfalls.clear()
+            changes = []
+            for account_id, amount in totals.items():
+                free = max(states[(account_id, asset)].free, Decimal('0.0'))
+                if free + amount < Decimal('0.0'):
+                    shortfalls[account_id] = -(free + amount)
+                    amount = -free
+                if amount:
+                    changes.append({
+                        "account_id": account_id,
+                        "asset": asset,
+                        "free": amount,
+                        "reason": enums.BalanceChange.funding.value,
+                    })
+            return changes
+        balances = Balance.apply(
+            db=db,
+            keys=[(account_id, asset) for account_id in totals],
+            get_changes=get_changes,
+        )
+        positions = []
+        for row in paid:
+            shortfall = shortfalls.get(str(row.account_id), Decimal('0.0'))
+            if row.amount >= Decimal('0.0') or shortfall <= Decimal('0.0'):
+                continue
+            unpaid = min(shortfall, -row.amount)
+            shortfalls[str(row.account_id)] = shortfall - unpaid
+            db.execute(update(cls).where(cls.id == row.id).values(shortfall=unpaid))
+
+            def force_liquidation(position):
+                if position.quantity <= Decimal('0.0'):
+                    return None
+                position.liquidation_price = row.mark_price
+                return position
+            position = Position._compare_and_swap(
+                db=db,
+                query=db.query(Position).filter(Position.id == row.position_id),
+                update=force_liquidation,
+            )
+            if position is not None:
+                positions.append(position)
+        return balances, positions
+
+
+class Candle(Base):
+    __tablename__ = "candles"
+
+    symbol = Column(String, primary_key=True)
+    interval = Column(String, primary_key=True)
+    open_time = Column(TIMESTAMP, primary_key=True)
+    open = Column(DECIMAL)
+    high = Column(DECIMAL)
+    low = Column(DECIMAL)
+    close = Column(DECIMAL)
+    volume = Column(DECIMAL, default=Decimal('0.0'))
+    quote_volume = Column(DECIMAL, default=Decimal('0.0'))
+    trades = Column(Integer, default=0)
+    # times of the first and last trade decide which open and close win
+    # when a late batch of trades is merged into a stored candle
+    first_trade_time = Column(TIMESTAMP)
+    last_trade_time = Column(TIMESTAMP)
+
+    @classmethod
+    def merge(cls, db: Session, rows: list):
+        """Upsert partial candles, merging them into the stored ones."""
+        statement = pg_insert(cls).values(rows)
+        excluded = statement.excluded
+        statement = statement.on_conflict_do_update(
+            index_elements=[cls.symbol, cls.interval, cls.open_time],
+            set_={
+                "open": case(
+                    (excluded.first_trade_time < cls.first_trade_time, excluded.open),
+                    else_=cls.open,
+                ),
+                "close": case(
+                    (excluded.last_trade_time >= cls.last_trade_time, excluded.close),
+                    else_=cls.close,
+                ),
+                "high": func.greatest(cls.high, excluded.high),
+                "low": func.least(cls.low, excluded.low),
+                "volume": cls.volume + excluded.volume,
+                "quote_volume": cls.quote_volume + excluded.quote_volume,
+                "trades": cls.trades + excluded.trades,
+                "first_trade_time": func.least(cls.first_trade_time, excluded.first_trade_time),
+                "last_trade_time": func.greatest(cls.last_trade_time, excluded.last_trade_time),
+            },
+        )
+        db.execute(statement)
 
 
 class Transaction(Base):
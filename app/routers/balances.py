@@ -1,7 +1,7 @@
 from fastapi import APIRouter, HTTPException, Depends, Header
 from sqlalchemy.orm import Session
 from orm import database, models
-from internal import schemas, middleware, enums
+from internal import schemas, middleware, enums, fast_json
 import uuid
 from decimal import Decimal
 
@@ -14,7 +14,7 @@ router = APIRouter(
 
 @router.get("/{account_id}", response_model=list[schemas.BalanceOut])
 async def get_all(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
-    return db.query(models.Balance).filter(models.Balance.account_id == account_id).all()
+    return fast_json.response(models.Balance.get_current(db=db, account_id=account_id))
 
 
 # @router.post("/", response_model=schemas.BalanceOut, dependencies=[Depends(middleware.verify_admin)])
@@ -36,3 +36,16 @@ async def create(contract_in: schemas.ContractIn, db: Session = Depends(database
     db.commit()
     db.refresh(db_contract)
     return db_contract
+
+
+@router.put("/{symbol}/fundingRate", response_model=schemas.ContractOut, dependencies=[Depends(middleware.verify_admin)])
+async def set_funding_rate(symbol: str, funding_rate_in: schemas.FundingRateIn, db: Session = Depends(database.get_db)):
+    db_contract = db.query(models.Contract).filter(
+        models.Contract.symbol == symbol
+    ).first()
+    if not db_contract:
+        raise HTTPException(status_code=404, detail="Not found")
+    db_contract.funding_rate = funding_rate_in.funding_rate
+    db.commit()
+    db.refresh(db_contract)
+    return db_contract
@@ -0,0 +1,47 @@
+from datetime import datetime, timedelta
+from fastapi import APIRouter, Depends, Query
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from orm import database, models
+from internal import schemas, enums, fast_json, candles
+import settings
+
+
+router = APIRouter(
+    prefix="/kline",
+    tags=["kline"],
+    responses={404: {"description": "Not found"}},
+)
+
+candle_columns = fast_json.columns(models.Candle, schemas.CandleOut)
+
+
+@router.get("/{symbol}", response_model=list[schemas.CandleOut])
+async def get_klines(
+    symbol: str,
+    interval: enums.CandleInterval = enums.CandleInterval.one_minute,
+    start: datetime = None,
+    end: datetime = None,
+    limit: int = Query(500, ge=1, le=settings.CANDLE_MAX_LIMIT),
+    db: Session = Depends(database.get_db),
+):
+    # stored candles, overridden by the complete bars this process built
+    # from the trade stream, which also cover what isn't flushed yet
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(
+        seconds=candles.INTERVALS[interval.value] * limit)
+    rows = fast_json.rows(db.execute(
+        select(*candle_columns).where(
+            models.Candle.symbol == symbol,
+            models.Candle.interval == interval.value,
+            models.Candle.open_time.between(start, end),
+        ).order_by(
+            models.Candle.open_time.desc()
+        ).limit(limit)
+    ))
+    klines = {row['open_time']: row for row in rows}
+    for bar in candles.aggregator.get_bars(symbol, interval.value, start, end):
+        klines[bar['open_time']] = {
+            field: bar[field] for field in schemas.CandleOut.__fields__}
+    return fast_json.FastJSONResponse(
+        [klines[open_time] for open_time in sorted(klines)][-limit:])
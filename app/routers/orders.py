@@ -1,22 +1,33 @@
 import uuid
-from fastapi import APIRouter, HTTPException, Depends, Header
+from decimal import Decimal
+from fastapi import APIRouter, HTTPException, Depends, Header, Query, Request
+from sqlalchemy import select
 from sqlalchemy.orm import Session
 from orm import database, models
-from internal import schemas, middleware, enums
+from internal import schemas, middleware, enums, fast_json, order_book, rate_limit
+import settings
 
 
 router = APIRouter(
     prefix="/order",
     tags=["order"],
     responses={404: {"description": "Not found"}},
+    dependencies=[Depends(rate_limit.limit)],
 )
 
+order_out_columns = fast_json.columns(models.Order, schemas.OrderOut)
+history_columns = fast_json.columns(models.all_orders.c, schemas.OrderOut)
+
 
 @router.get("/byId/{order_id}", response_model=schemas.OrderOut)
 async def get_all_by_account_symbol(order_id: uuid.UUID, db: Session = Depends(database.get_db)):
     db_order = db.query(models.Order).filter(
         models.Order.id == order_id
     ).first()
+    if not db_order:
+        db_order = db.query(models.OrderArchive).filter(
+            models.OrderArchive.id == order_id
+        ).first()
     if not db_order:
         raise HTTPException(404)
     return db_order
@@ -24,53 +35,70 @@ async def get_all_by_account_symbol(order_id: uuid.UUID, db: Session = Depends(d
 
 @router.get("/open/{account_id}", response_model=list[schemas.OrderOut])
 async def get_all_by_account(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
-    return db.query(models.Order).filter(
-        models.Order.account_id == account_id,
-        models.Order.status.in_(enums.OrderStatus.open_orders.value),
-    ).order_by(
-        models.Order.insert_time.desc()
-    ).all()
+    return fast_json.response(db.execute(
+        select(*order_out_columns).where(
+            models.Order.account_id == account_id,
+            models.Order.status.in_(enums.OrderStatus.open_orders.value),
+        ).order_by(
+            models.Order.insert_time.desc()
+        )
+    ))
 
 
 @router.get("/open/{account_id}/{symbol}", response_model=list[schemas.OrderOut])
 async def get_all_by_account_symbol(account_id: uuid.UUID, symbol: str, db: Session = Depends(database.get_db)):
-    return db.query(models.Order).filter(
-        models.Order.account_id == account_id,
-        models.Order.status.in_(enums.OrderStatus.open_orders.value),
-        models.Order.symbol == symbol,
-    ).order_by(
-        models.Order.insert_time.desc()
-    ).all()
-
-
-@router.get("/book/{symbol}", response_model=list[schemas.OrderBookOut])
-async def get_symbol_order_book(symbol: str, db: Session = Depends(database.get_db)):
-    return models.Order.get_order_book(db=db, symbol=symbol)
+    return fast_json.response(db.execute(
+        select(*order_out_columns).where(
+            models.Order.account_id == account_id,
+            models.Order.status.in_(enums.OrderStatus.open_orders.value),
+            models.Order.symbol == symbol,
+        ).order_by(
+            models.Order.insert_time.desc()
+        )
+    ))
+
+
+@router.get("/book/{symbol}", response_model=schemas.OrderBookSnapshotOut)
+async def get_symbol_order_book(
+    symbol: str,
+    depth: int = Query(100, ge=1, le=settings.ORDER_BOOK_MAX_DEPTH),
+    group: Decimal = Query(None, gt=0),
+):
+    book = await order_book.load_book(symbol)
+    if book is None:
+        raise HTTPException(404)
+    return fast_json.FastJSONResponse(book.snapshot(depth=depth, group=group))
 
 
 @router.get("/{account_id}", response_model=list[schemas.OrderOut])
 async def get_all_by_account(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
-    return db.query(models.Order).filter(
-        models.Order.account_id == account_id,
-    ).order_by(
-        models.Order.insert_time.desc()
-    ).all()
+    return fast_json.response(db.execute(
+        select(*history_columns).where(
+            models.all_orders.c.account_id == account_id,
+        ).order_by(
+            models.all_orders.c.insert_time.desc()
+        )
+    ))
 
 
 @router.get("/{account_id}/{symbol}", response_model=list[schemas.OrderOut])
 async def get_all_by_account_symbol(account_id: uuid.UUID, symbol: str, db: Session = Depends(database.get_db)):
-    return db.query(models.Order).filter(
-        models.Order.account_id == account_id,
-        models.Order.symbol == symbol,
-    ).order_by(
-        models.Order.insert_time.desc()
-    ).all()
+    return fast_json.response(db.execute(
+        select(*history_columns).where(
+            models.all_orders.c.account_id == account_id,
+            models.all_orders.c.symbol == symbol,
+        ).order_by(
+            models.all_orders.c.insert_time.desc()
+        )
+    ))
 
 
 @router.post("/", response_model=schemas.OrderOut)
-async def create(order_in: schemas.OrderIn, wallet: str = Header(), db: Session = Depends(database.get_db)):
+async def create(request: Request, order_in: schemas.OrderIn, wallet: str = Header(), db: Session = Depends(database.get_db)):
     if not order_in.is_account_valid(wallet):
         raise HTTPException(403, 'access denied for this account id')
+    rate_limit.charge(request, order_in.account_id, wallet=wallet)
+    rate_limit.check_engine_lag()
     order_in = order_in.dict()
     db_order = models.Order(**order_in)
     locked_balance = db_order.lock_balance(db=db)
@@ -87,13 +115,14 @@ async def create(order_in: schemas.OrderIn, wallet: str = Header(), db: Session
 
 
 @router.delete("/byId/{order_id}", response_model=schemas.OrderCancel)
-async def get_all_by_account_symbol(order_id: uuid.UUID, db: Session = Depends(database.get_db)):
+async def get_all_by_account_symbol(request: Request, order_id: uuid.UUID, db: Session = Depends(database.get_db)):
     db_order = db.query(models.Order).filter(
         models.Order.id == order_id,
         models.Order.status.in_(enums.OrderStatus.open_orders.value),
     ).first()
     if not db_order:
         raise HTTPException(404)
+    rate_limit.charge(request, db_order.account_id)
     order = schemas.OrderCancel.from_orm(db_order)
     order.cancel_order()
     return order
@@ -3,7 +3,7 @@ from decimal import Decimal
 from fastapi import APIRouter, HTTPException, Depends, Header
 from sqlalchemy.orm import Session
 from orm import database, models
-from internal import schemas, middleware, enums
+from internal import schemas, middleware, enums, mark_to_market
 
 
 router = APIRouter(
@@ -13,6 +13,14 @@ router = APIRouter(
 )
 
 
+@router.get("/risk/{account_id}", response_model=list[schemas.PositionRiskOut])
+async def get_risk_by_account(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
+    book = mark_to_market.PositionBook.load(db=db, account_id=account_id)
+    mark_prices = mark_to_market.get_mark_prices(
+        db=db, symbols=list(book.symbols))
+    return list(book.iter_risk(mark_prices))
+
+
 @router.get("/{account_id}", response_model=list[schemas.PositionOut])
 async def get_all_by_account(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
     return models.Position.get_open_positions(account_id=account_id, db=db)
@@ -0,0 +1,61 @@
+import uuid
+from fastapi import APIRouter, Depends
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import text
+from orm import database, models
+from internal import schemas, enums, fast_json
+
+
+router = APIRouter(
+    prefix="/account",
+    tags=["account"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/{account_id}/snapshot", response_model=schemas.AccountSnapshotOut)
+async def get_snapshot(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
+    # every query runs inside one read only repeatable read transaction so
+    # balances, positions and orders come from the same database snapshot,
+    # the connection is opened on the engine reads are routed to so every
+    # statement below runs on it
+    db.connection(
+        bind_arguments={"bind": db.info.get('replica') or database.engine},
+        execution_options={"isolation_level": "REPEATABLE READ"},
+    )
+    db.execute(text("set transaction read only"))
+    version, timestamp = db.execute(text("""
+        select
+        pg_snapshot_xmax(pg_current_snapshot())::text::bigint,
+        (extract(epoch from now()) * 1000)::bigint
+    """)).one()
+    balances = fast_json.rows(
+        models.Balance.get_current(db=db, account_id=account_id))
+    positions = db.execute(
+        select(*fast_json.columns(models.Position, schemas.PositionOut)).where(
+            models.Position.account_id == account_id,
+            models.Position.margin > 0,
+        ).order_by(
+            models.Position.margin.desc()
+        )
+    )
+    positions = fast_json.rows(positions)
+    orders = db.execute(
+        select(*fast_json.columns(models.Order, schemas.OrderOut)).where(
+            models.Order.account_id == account_id,
+            models.Order.status.in_(enums.OrderStatus.open_orders.value),
+        ).order_by(
+            models.Order.insert_time.desc()
+        )
+    )
+    orders = fast_json.rows(orders)
+    db.rollback()
+    return fast_json.FastJSONResponse({
+        "account_id": account_id,
+        "version": version,
+        "timestamp": timestamp,
+        "balances": balances,
+        "positions": positions,
+        "orders": orders,
+    })
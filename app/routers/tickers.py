@@ -0,0 +1,21 @@
+from fastapi import APIRouter, HTTPException
+from internal import schemas, fast_json, ticker
+
+
+router = APIRouter(
+    prefix="/ticker",
+    tags=["ticker"],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/", response_model=list[schemas.TickerOut])
+async def get_all():
+    return fast_json.FastJSONResponse(ticker.get_tickers(ticker.get_symbols()))
+
+
+@router.get("/{symbol}", response_model=schemas.TickerOut)
+async def get_by_symbol(symbol: str):
+    if symbol not in ticker.get_symbols():
+        raise HTTPException(404)
+    return fast_json.FastJSONResponse(ticker.get_tickers([symbol])[0])
@@ -2,8 +2,10 @@ import uuid
 from fastapi import APIRouter, HTTPException, Depends, Header
 from sqlalchemy.orm import Session
 from orm import database, models
-from internal import schemas, middleware, enums
+from internal import schemas, middleware, enums, fast_json
 from sqlalchemy.sql import text
+from datetime import datetime, timedelta
+import settings
 
 
 router = APIRouter(
@@ -29,7 +31,8 @@ base_query = """
     from subtrades
     left join trades 
     on trade_id = trades.id
-    left JOIN orders
+    and subtrades.insert_time = trades.insert_time
+    left JOIN all_orders as orders
     on 
     case
         when is_maker then trades.maker_order_id = orders.id
@@ -37,15 +40,29 @@ base_query = """
         trades.taker_order_id = orders.id
     end
     where {}
+    and subtrades.insert_time between :start and :end
+    and trades.insert_time between :start and :end
     order by trades.insert_time desc;
 """
 
 
+def get_bounds(start: datetime = None, end: datetime = None) -> dict:
+    # trades and subtrades are partitioned by insert_time, bounding it lets
+    # postgres skip every partition outside the range
+    end = end or datetime.utcnow()
+    start = start or end - timedelta(days=settings.TRADE_HISTORY_DAYS)
+    return {'start': start, 'end': end}
+
+
 @router.get("/byId/{trade_id}", response_model=schemas.SubTradeOut)
 async def get_by_id(trade_id: uuid.UUID, db: Session = Depends(database.get_db)):
     where = "subtrades.id = :trade_id"
     query = base_query.format(where)
-    db_query = db.execute(text(query), {'trade_id': str(trade_id)})
+    db_query = db.execute(text(query), {
+        'trade_id': str(trade_id),
+        'start': datetime.min,
+        'end': datetime.max,
+    })
     db_sub_trade = db_query.first()
     if not db_sub_trade:
         raise HTTPException(404)
@@ -53,21 +70,21 @@ async def get_by_id(trade_id: uuid.UUID, db: Session = Depends(database.get_db))
 
 
 @router.get("/byOrder/{order_id}", response_model=list[schemas.SubTradeOut])
-async def get_all_by_order(order_id: uuid.UUID, db: Session = Depends(database.get_db)):
+async def get_all_by_order(order_id: uuid.UUID, bounds: dict = Depends(get_bounds), db: Session = Depends(database.get_db)):
     where = "orders.id = :order_id"
     query = base_query.format(where)
-    return db.execute(text(query), {'order_id': str(order_id)}).all()
+    return fast_json.response(db.execute(text(query), {'order_id': str(order_id), **bounds}))
 
 
 @router.get("/{account_id}", response_model=list[schemas.SubTradeOut])
-async def get_all_by_account(account_id: uuid.UUID, db: Session = Depends(database.get_db)):
+async def get_all_by_account(account_id: uuid.UUID, bounds: dict = Depends(get_bounds), db: Session = Depends(database.get_db)):
     where = "orders.account_id = :account_id"
     query = base_query.format(where)
-    return db.execute(text(query), {'account_id': str(account_id)}).all()
+    return fast_json.response(db.execute(text(query), {'account_id': str(account_id), **bounds}))
 
 
 @router.get("/{account_id}/{symbol}", response_model=list[schemas.SubTradeOut])
-async def get_all_by_account_symbol(account_id: uuid.UUID, symbol: str, db: Session = Depends(database.get_db)):
+async def get_all_by_account_symbol(account_id: uuid.UUID, symbol: str, bounds: dict = Depends(get_bounds), db: Session = Depends(database.get_db)):
     where = "orders.account_id = :account_id and orders.symbol = :symbol"
     query = base_query.format(where)
-    return db.execute(text(query), {'account_id': str(account_id), 'symbol': symbol}).all()
+    return fast_json.response(db.execute(text(query), {'account_id': str(account_id), 'symbol': symbol, **bounds}))
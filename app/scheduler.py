@@ -0,0 +1,8 @@
+from internal import jobs, stream, mark_to_market, funding, commissions, balance_journal, order_archive, partitions, profiler
+
+
+if __name__ == "__main__":
+    profiler.start()
+    mark_to_market.start()
+    stream.start(group_id="scheduler")
+    jobs.run_forever()
@@ -9,10 +9,21 @@ DBUSER = os.getenv("POSTGRES_USER", "dbuser")
 DBPASS = os.getenv("POSTGRES_PASSWORD", "dbpass")
 DBHOST = os.getenv("POSTGRES_HOST", "localhost")
 DBPORT = os.getenv("POSTGRES_PORT", "5432")
+DB_REPLICA_URLS = [url for url in os.getenv(
+    "POSTGRES_REPLICA_URLS", "").split(",") if url]
+DB_REPLICA_MAX_LAG = float(os.getenv("POSTGRES_REPLICA_MAX_LAG", 5))
+DB_REPLICA_POLL_INTERVAL = float(os.getenv("POSTGRES_REPLICA_POLL_INTERVAL", 0.2))
 
 RABBITMQ_CRED = os.getenv("RABBITMQ_CRED", "guest")
 RABBITMQ_HOST = os.getenv("RABBITMQ_HOST", "127.0.0.1")
 SERVICE_PORT = int(os.getenv("SERVICE_PORT", 8000))
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+SERVER_BACKLOG = int(os.getenv("SERVER_BACKLOG", 2048))
+SERVER_KEEPALIVE = int(os.getenv("SERVER_KEEPALIVE", 5))
+SERVER_TIMEOUT = int(os.getenv("SERVER_TIMEOUT", 30))
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv("SERVER_GRACEFUL_TIMEOUT", 30))
+SERVER_MAX_REQUESTS = int(os.getenv("SERVER_MAX_REQUESTS", 0))
+SERVER_MAX_REQUESTS_JITTER = int(os.getenv("SERVER_MAX_REQUESTS_JITTER", 0))
 SECRET_TOKEN = os.getenv("SECRET_TOKEN", "SECRET_TOKEN")
 SERVICE_HOSTS = {
     "market": os.getenv('MARKET_HOST', 'http://127.0.0.1:8001'),
@@ -21,8 +32,88 @@ SERVICE_HOSTS = {
 TOKEN_EXPIRE_TIME = int(os.getenv("TOKEN_EXPIRE_TIME", 4 * 3600 * 1000))
 API_TOKEN_EXPIRE_TIME = int(
     os.getenv("API_TOKEN_EXPIRE_TIME", 365 * 24 * 3600 * 1000))
+READINESS_RETRIES = int(os.getenv("READINESS_RETRIES", 0))
+READINESS_DELAY = float(os.getenv("READINESS_DELAY", 0.2))
+READINESS_MAX_DELAY = float(os.getenv("READINESS_MAX_DELAY", 5))
+READINESS_TIMEOUT = float(os.getenv("READINESS_TIMEOUT", 2))
+ORDER_BOOK_RESYNC_INTERVAL = float(os.getenv("ORDER_BOOK_RESYNC_INTERVAL", 30))
+ORDER_BOOK_MAX_DEPTH = int(os.getenv("ORDER_BOOK_MAX_DEPTH", 1000))
+TRADE_PARTITION_INTERVAL = float(os.getenv("TRADE_PARTITION_INTERVAL", 3600))
+# monthly partitions created ahead of time and kept attached
+TRADE_PARTITIONS_AHEAD = int(os.getenv("TRADE_PARTITIONS_AHEAD", 3))
+TRADE_RETENTION_MONTHS = int(os.getenv("TRADE_RETENTION_MONTHS", 12))
+TRADE_EXPORT_DIR = os.getenv("TRADE_EXPORT_DIR", "/data/trades")
+TRADE_EXPORT_BATCH_SIZE = int(os.getenv("TRADE_EXPORT_BATCH_SIZE", 100000))
+# trade history endpoints default to this many days back
+TRADE_HISTORY_DAYS = int(os.getenv("TRADE_HISTORY_DAYS", 90))
+CANDLE_FLUSH_INTERVAL = float(os.getenv("CANDLE_FLUSH_INTERVAL", 5))
+# bars kept in memory per symbol and interval
+CANDLE_MEMORY_BARS = int(os.getenv("CANDLE_MEMORY_BARS", 1500))
+CANDLE_MAX_LIMIT = int(os.getenv("CANDLE_MAX_LIMIT", 1500))
+# recent trade ids remembered to drop redelivered trade events
+CANDLE_DEDUP_SIZE = int(os.getenv("CANDLE_DEDUP_SIZE", 100000))
+CONTRACT_STATS_FLUSH_INTERVAL = float(os.getenv("CONTRACT_STATS_FLUSH_INTERVAL", 1))
+CONTRACT_STATS_FLUSH_TRADES = int(os.getenv("CONTRACT_STATS_FLUSH_TRADES", 500))
+CONTRACT_STATS_REBUILD_INTERVAL = float(os.getenv("CONTRACT_STATS_REBUILD_INTERVAL", 300))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "true").lower() == "true"
+PROFILER_STATEMENT_BUDGET = int(os.getenv("PROFILER_STATEMENT_BUDGET", 20))
+PROFILER_TIME_BUDGET = float(os.getenv("PROFILER_TIME_BUDGET", 0.1))
+PROFILER_SLOWEST = int(os.getenv("PROFILER_SLOWEST", 5))
+TICKER_WINDOW_MINUTES = int(os.getenv("TICKER_WINDOW_MINUTES", 24 * 60))
+TICKER_PUBLISH_INTERVAL = float(os.getenv("TICKER_PUBLISH_INTERVAL", 1))
+TICKER_SYMBOLS_TTL = float(os.getenv("TICKER_SYMBOLS_TTL", 30))
+ORDER_ARCHIVE_INTERVAL = float(os.getenv("ORDER_ARCHIVE_INTERVAL", 60))
+ORDER_ARCHIVE_BATCH_SIZE = int(os.getenv("ORDER_ARCHIVE_BATCH_SIZE", 5000))
+# seconds a filled or canceled order stays in orders before it is archived
+ORDER_ARCHIVE_MIN_AGE = float(os.getenv("ORDER_ARCHIVE_MIN_AGE", 3600))
+MARK_TO_MARKET_INTERVAL = float(os.getenv("MARK_TO_MARKET_INTERVAL", 1))
+# seconds of trades searched for the last price of a symbol
+LAST_PRICE_WINDOW = float(os.getenv("LAST_PRICE_WINDOW", 24 * 3600))
+POSITION_BOOK_RELOAD_INTERVAL = float(
+    os.getenv("POSITION_BOOK_RELOAD_INTERVAL", 5))
+LIQUIDATION_RESYNC_INTERVAL = float(
+    os.getenv("LIQUIDATION_RESYNC_INTERVAL", 60))
+FUNDING_INTERVAL = int(os.getenv("FUNDING_INTERVAL", 8 * 3600))
+FUNDING_CHUNK_SIZE = int(os.getenv("FUNDING_CHUNK_SIZE", 1000))
+FUNDING_CHECK_INTERVAL = float(os.getenv("FUNDING_CHECK_INTERVAL", 60))
+COMMISSION_PAYOUT_INTERVAL = float(
+    os.getenv("COMMISSION_PAYOUT_INTERVAL", 60))
+COMMISSION_PAYOUT_BATCH_SIZE = int(
+    os.getenv("COMMISSION_PAYOUT_BATCH_SIZE", 5000))
+BENEFICIARY_CACHE_SIZE = int(os.getenv("BENEFICIARY_CACHE_SIZE", 100000))
+BENEFICIARY_CACHE_TTL = float(os.getenv("BENEFICIARY_CACHE_TTL", 300))
+# PESSIMISTIC locks balances and positions before changing them, OPTIMISTIC
+# writes them with a version check and retries when a concurrent update won
+CONCURRENCY_MODE = os.getenv("CONCURRENCY_MODE", "PESSIMISTIC")
+CONCURRENCY_MAX_RETRIES = int(os.getenv("CONCURRENCY_MAX_RETRIES", 5))
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", 100000))
+BALANCE_ROLLUP_INTERVAL = float(os.getenv("BALANCE_ROLLUP_INTERVAL", 10))
+BALANCE_ROLLUP_BATCH_SIZE = int(os.getenv("BALANCE_ROLLUP_BATCH_SIZE", 5000))
+RATE_LIMIT_BACKEND = os.getenv(
+    "RATE_LIMIT_BACKEND", "internal.rate_limit.MemoryBackend")
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", 100000))
+# budget: (tokens per second, burst)
+RATE_LIMITS = {
+    "PLACE": (float(os.getenv("RATE_LIMIT_PLACE", 10)), float(os.getenv("RATE_LIMIT_PLACE_BURST", 20))),
+    "CANCEL": (float(os.getenv("RATE_LIMIT_CANCEL", 20)), float(os.getenv("RATE_LIMIT_CANCEL_BURST", 40))),
+    "READ": (float(os.getenv("RATE_LIMIT_READ", 20)), float(os.getenv("RATE_LIMIT_READ_BURST", 50))),
+}
+ENGINE_GROUP_ID = os.getenv("ENGINE_GROUP_ID", "match-engine")
+ENGINE_MAX_LAG = int(os.getenv("ENGINE_MAX_LAG", 5000))
+ENGINE_LAG_INTERVAL = float(os.getenv("ENGINE_LAG_INTERVAL", 1))
 ETHERSCAN_APIKEY = os.getenv(
     "ETHERSCAN_APIKEY", "")
+EXPLORER_INTERVAL = float(os.getenv("EXPLORER_INTERVAL", 15))
+EXPLORER_MAX_CONNECTIONS = int(os.getenv("EXPLORER_MAX_CONNECTIONS", 20))
+EXPLORER_MAX_CONCURRENCY = int(os.getenv("EXPLORER_MAX_CONCURRENCY", 2))
+EXPLORER_REQUEST_TIMEOUT = int(os.getenv("EXPLORER_REQUEST_TIMEOUT", 10))
+EXPLORER_RATE_LIMIT = int(os.getenv("EXPLORER_RATE_LIMIT", 5))
+EXPLORER_PAGE_SIZE = int(os.getenv("EXPLORER_PAGE_SIZE", 1000))
+# explorers stop paging after this many results of one query
+EXPLORER_MAX_RESULTS = int(os.getenv("EXPLORER_MAX_RESULTS", 10000))
+EXPLORER_BLOCK_RANGE = int(os.getenv("EXPLORER_BLOCK_RANGE", 100000))
+EXPLORER_PREFETCH_PAGES = int(os.getenv("EXPLORER_PREFETCH_PAGES", 2))
+EXPLORER_MAX_RETRIES = int(os.getenv("EXPLORER_MAX_RETRIES", 4))
 FEES = {
     "TAKER": Decimal("0.003"),
     "MAKER": Decimal("-0.0015"),
@@ -36,6 +127,21 @@ assert FEES["EXCHANGE"] > Decimal('0.0') and FEES["BROKER"] > Decimal(
     '0.0') and FEES["REFERRAL"] > Decimal('0.0')
 assert FEES["TAKER"] - abs(FEES["MAKER"]) == FEES["EXCHANGE"] + \
     FEES["BROKER"] + FEES["REFERRAL"]
+# maker and taker fees by trailing 30 day quote volume, the first tier is
+# the default schedule and every tier must still leave the exchange a share
+FEE_TIERS = [
+    {"VOLUME": Decimal("0"), "MAKER": FEES["MAKER"], "TAKER": FEES["TAKER"]},
+    {"VOLUME": Decimal("1000000"), "MAKER": Decimal("-0.0016"), "TAKER": Decimal("0.0029")},
+    {"VOLUME": Decimal("10000000"), "MAKER": Decimal("-0.0017"), "TAKER": Decimal("0.0028")},
+]
+assert FEE_TIERS[0]["VOLUME"] == Decimal("0")
+assert all(a["VOLUME"] < b["VOLUME"] for a, b in zip(FEE_TIERS, FEE_TIERS[1:]))
+assert min(tier["TAKER"] for tier in FEE_TIERS) - max(abs(tier["MAKER"]) for tier in FEE_TIERS) >= \
+    FEES["BROKER"] + FEES["REFERRAL"]
+FEE_VOLUME_DAYS = int(os.getenv("FEE_VOLUME_DAYS", 30))
+FEE_VOLUME_FLUSH_INTERVAL = float(os.getenv("FEE_VOLUME_FLUSH_INTERVAL", 5))
+FEE_VOLUME_FLUSH_TRADES = int(os.getenv("FEE_VOLUME_FLUSH_TRADES", 1000))
+FEE_TIER_REFRESH_INTERVAL = float(os.getenv("FEE_TIER_REFRESH_INTERVAL", 300))
 
 _KAFKA_SERVERS = [
     {
@@ -0,0 +1,49 @@
+"""Exchange income of a fill under the maker fee tiers, no database needed:
+
+    cd app && python -m pytest tests
+"""
+from decimal import Decimal
+import uuid
+import pytest
+from orm import models
+import settings
+
+QUOTE_QUANTITY = Decimal('1000')
+COMMISSION = Decimal('3')
+
+
+@pytest.fixture(autouse=True)
+def tiers(monkeypatch):
+    monkeypatch.setattr(settings, "FEE_TIERS", [
+        {"VOLUME": Decimal("0"), "MAKER": Decimal("-0.0015"), "TAKER": Decimal("0.003")},
+        {"VOLUME": Decimal("1000000"), "MAKER": Decimal("0.0005"), "TAKER": Decimal("0.003")},
+    ])
+    monkeypatch.setattr(models.AccountVolume, "_tiers", {})
+    monkeypatch.setattr(
+        models.ExchangeIncome, "get_beneficiaries",
+        classmethod(lambda cls, db, account_id: (None, None)))
+
+
+def _pay(maker_tier: int) -> models.ExchangeIncome:
+    maker = models.Order(id=uuid.uuid4(), account_id=uuid.uuid4())
+    taker = models.Order(id=uuid.uuid4(), account_id=uuid.uuid4())
+    if maker_tier:
+        models.AccountVolume._tiers[str(maker.account_id)] = maker_tier
+    trade = models.Trade(
+        id=uuid.uuid4(), maker_order=maker, taker_order=taker,
+        quote_quantity=QUOTE_QUANTITY)
+    sub_trade = models.SubTrade(
+        id=uuid.uuid4(), trade=trade, commission=COMMISSION,
+        commission_asset="USDT", is_maker=False)
+    return models.ExchangeIncome.pay_commissions(db=None, sub_trade=sub_trade)
+
+
+def test_negative_maker_fee_is_paid_out_of_the_income():
+    income = _pay(maker_tier=0)
+    assert income.exchange_income == COMMISSION - QUOTE_QUANTITY * Decimal("0.0015")
+
+
+def test_positive_maker_fee_pays_no_rebate():
+    income = _pay(maker_tier=1)
+    assert income.exchange_income == COMMISSION
+    assert income.paid
@@ -0,0 +1,149 @@
+"""Statements the engine sends to match one order, counted by the profiler.
+
+Needs the database of the POSTGRES_* settings and is skipped without one:
+
+    cd app && python -m pytest tests
+"""
+from decimal import Decimal
+import uuid
+import pytest
+from sqlalchemy.sql import text
+from orm import database, models
+from internal import enums, match, profiler
+import migrate
+import settings
+
+# the fills of a match are written in batches, only the UPDATEs of the
+# maker orders and positions are still one statement per maker
+MAX_STATEMENTS_PER_MAKER = 3
+
+
+def _database_available() -> bool:
+    try:
+        with database.engine.connect() as connection:
+            connection.execute(text("select 1"))
+    except Exception:
+        return False
+    return True
+
+
+pytestmark = pytest.mark.skipif(
+    not _database_available(), reason="needs the postgres database of the settings")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def schema():
+    migrate.create_schema(retries=1)
+    settings.PROFILER_ENABLED = True
+    profiler.start()
+
+
+@pytest.fixture(autouse=True)
+def no_publish(monkeypatch):
+    monkeypatch.setattr(match, "publish_new_events", lambda new_events, symbol: None)
+
+
+def _create_account(db, amount: Decimal) -> models.Account:
+    account = models.Account(type=enums.AccountType.main.value, leverage=5)
+    db.add(account)
+    db.flush()
+    asset = enums.CollateralAsset.usdt.value
+    models.Balance.create_missing(db=db, account_ids=[account.id], asset=asset)
+    models.Balance.credit(
+        db=db,
+        amounts=[(account.id, amount)],
+        asset=asset,
+        reason=enums.BalanceChange.set_balance.value,
+    )
+    return account
+
+
+def _place(db, account: models.Account, symbol: str, side: str, quantity: Decimal,
+           status: str) -> models.Order:
+    order = models.Order(
+        account_id=account.id,
+        symbol=symbol,
+        base="BTC",
+        quote=enums.CollateralAsset.usdt.value,
+        side=side,
+        position_mode=enums.PositionMode.ony_way.value,
+        type=enums.OrderType.limit.value,
+        status=status,
+        price=Decimal('100'),
+        quantity=quantity,
+        leverage=5,
+    )
+    assert order.lock_balance(db=db)
+    db.add(order)
+    return order
+
+
+def _create_book(makers: int) -> uuid.UUID:
+    """A contract with makers resting shorts of 1 and a long taking all of them."""
+    db = database.SessionLocal()
+    try:
+        asset = enums.CollateralAsset.usdt.value
+        if db.query(models.Asset).filter(models.Asset.symbol == asset).first() is None:
+            db.add(models.Asset(symbol=asset, name="Tether USD", digits=6))
+            db.flush()
+        symbol = f"T{uuid.uuid4().hex[:8].upper()}"
+        db.add(models.Contract(
+            symbol=symbol,
+            base_asset="BTC",
+            quote_asset=asset,
+            base_precision=3,
+            quote_precision=2,
+            min_base_quantity=Decimal('0.001'),
+            min_quote_quantity=Decimal('0.01'),
+            status=enums.ContractStatus.trading.value,
+        ))
+        db.flush()
+        for _ in range(makers):
+            _place(
+                db=db,
+                account=_create_account(db=db, amount=Decimal('1000')),
+                symbol=symbol,
+                side=enums.OrderSide.short.value,
+                quantity=Decimal('1'),
+                status=enums.OrderStatus.placed.value,
+            )
+        taker = _place(
+            db=db,
+            account=_create_account(db=db, amount=Decimal('1000') * makers),
+            symbol=symbol,
+            side=enums.OrderSide.long.value,
+            quantity=Decimal(makers),
+            status=enums.OrderStatus.queued.value,
+        )
+        db.commit()
+        return taker.id
+    finally:
+        db.close()
+
+
+def _count_statements(makers: int) -> int:
+    taker_id = _create_book(makers=makers)
+    with profiler.profile("test.match") as profile:
+        match.receive_order({
+            "id": str(taker_id),
+            "status": enums.OrderStatus.queued.value,
+        })
+    db = database.SessionLocal()
+    try:
+        taker = db.get(models.Order, taker_id)
+        assert taker.status == enums.OrderStatus.filled.value
+    finally:
+        db.close()
+    return profile.statements
+
+
+def test_single_maker_match_is_within_the_statement_budget():
+    assert _count_statements(makers=1) <= settings.PROFILER_STATEMENT_BUDGET
+
+
+@pytest.mark.parametrize("makers", [5, 20])
+def test_statements_grow_at_most_linearly_with_makers(makers):
+    single = _count_statements(makers=1)
+    statements = _count_statements(makers=makers)
+    assert statements - single <= (makers - 1) * MAX_STATEMENTS_PER_MAKER, \
+        f"{statements} statements for {makers} makers, {single} for one"